@@ -0,0 +1,107 @@
+import asyncio
+import functools
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import db
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Количество потоков, в которых выполняются запросы к базе данных.
+# В режиме WAL читатели работают параллельно, запись идет через db.WriteQueue.
+DB_EXECUTOR_WORKERS = int(os.getenv('DB_EXECUTOR_WORKERS', '4'))
+
+# Функции db.py, для которых репозиторий предоставляет асинхронные версии
+REPOSITORY_FUNCTIONS = (
+    'create_tables',
+    'get_tools',
+    'get_issued_tools',
+    'get_admin_issued_tools',
+    'get_issued_tool_by_id',
+    'get_return_info',
+    'complete_return',
+    'return_tool',
+    'get_tool_history',
+    'get_overdue_tools',
+    'is_tool_issued',
+    'issue_tool',
+    'create_tool_request',
+    'get_issue_request_info',
+    'approve_issue_request',
+    'reject_issue_request',
+    'create_tool',
+    'get_tool_by_id',
+    'update_tool_status',
+    'add_tool_history',
+    'get_all_issue_requests',
+    'get_tools_with_availability',
+    'get_available_tools',
+    'search_tools',
+    'get_tools_page',
+    'issue_tool_for_period',
+    'get_tools_for_return',
+    'return_tool_with_photo',
+    'get_recent_history',
+    'get_history_page',
+    'get_report_stats',
+    'get_overdue_report',
+    'get_pending_due_dates',
+    'claim_overdue_loans',
+    'get_pending_return_photos',
+    'save_media',
+    'get_telegram_file_ids',
+    'save_telegram_file_id',
+)
+
+
+class AsyncToolRepository:
+    """
+    Асинхронный доступ к базе данных.
+    Запросы выполняются в отдельном пуле потоков, поэтому не блокируют цикл событий aiogram.
+    """
+
+    def __init__(self, max_workers=DB_EXECUTOR_WORKERS):
+        self.max_workers = max_workers
+        self._executor = None
+
+    def _get_executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.max_workers,
+                thread_name_prefix='db'
+            )
+        return self._executor
+
+    async def run(self, func, *args, **kwargs):
+        """Выполняет синхронную функцию в потоке базы данных (с замером для /metrics)"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._get_executor(),
+            functools.partial(metrics.timed_db_call, func, *args, **kwargs)
+        )
+
+    def close(self):
+        """Останавливает потоки базы данных"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+
+def _make_async(name):
+    async def method(self, *args, **kwargs):
+        # Берем функцию из модуля при каждом вызове, чтобы не кэшировать устаревшие ссылки
+        return await self.run(getattr(db, name), *args, **kwargs)
+
+    method.__name__ = name
+    method.__qualname__ = f'AsyncToolRepository.{name}'
+    method.__doc__ = getattr(db, name).__doc__
+    return method
+
+
+for _name in REPOSITORY_FUNCTIONS:
+    setattr(AsyncToolRepository, _name, _make_async(_name))
+
+# Общий репозиторий для обработчиков бота
+repo = AsyncToolRepository()
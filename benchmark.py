@@ -0,0 +1,1677 @@
+"""
+Бенчмарки бота.
+
+Запуск:
+    python benchmark.py webhook-latency --tools 2000 --loans 200000 --updates 200
+    python benchmark.py write-contention --threads 16 --operations 50
+    python benchmark.py stock --units 100 --threads 16 --operations 50 --updates 200
+    python benchmark.py search --catalog 100000
+    python benchmark.py import --catalog 1000000
+    python benchmark.py cold-start --tools 100000 --loans 200000
+    python benchmark.py fsm --updates 2000
+    python benchmark.py throttling --catalog 1000000
+    python benchmark.py ingestion --updates 1000 --interval 0.002
+    python benchmark.py dedup --updates 100000
+    python benchmark.py report --tools 2000 --loans 200000
+    python benchmark.py history --tools 2000 --loans 200000
+    python benchmark.py overdue --tools 2000 --loans 200000
+    python benchmark.py notifications --updates 200 --interval 0.01
+    python benchmark.py media --updates 500
+    python benchmark.py logging --tools 2000 --updates 2000
+    python benchmark.py cluster --tools 2000 --loans 100000 --updates 5000 --workers 4
+    python benchmark.py load --tools 2000 --loans 100000 --users 50 --rounds 3 --output load.json
+    python benchmark.py load --users 50 --rounds 3 --baseline load.json
+"""
+import argparse
+import asyncio
+import csv
+import json
+import logging
+import os
+import random
+import resource
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import db
+from async_db import AsyncToolRepository
+
+
+def percentile(values, pct):
+    """Возвращает перцентиль pct (0..100) для списка значений"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+def format_latencies(title, values):
+    """Форматирует строку с p50/p95/p99 в миллисекундах"""
+    return (
+        f"{title}: n={len(values)} "
+        f"p50={percentile(values, 50) * 1000:.2f}ms "
+        f"p95={percentile(values, 95) * 1000:.2f}ms "
+        f"p99={percentile(values, 99) * 1000:.2f}ms "
+        f"max={max(values) * 1000 if values else 0:.2f}ms"
+    )
+
+
+def generate_catalog(db_path, tools_count, loans_count, seed=42):
+    """Создает синтетическую базу с инструментами и историей выдач"""
+    rnd = random.Random(seed)
+    db.DB_PATH = db_path
+    db.create_tables()
+
+    conn = sqlite3.connect(db_path)
+    try:
+        conn.executemany(
+            "INSERT INTO tools (name, quantity) VALUES (?, ?)",
+            ((f"Инструмент {i:06d}", rnd.randint(1, 10)) for i in range(tools_count))
+        )
+        now = datetime.now()
+        loans = []
+        for i in range(loans_count):
+            issue_date = now - timedelta(days=rnd.randint(0, 365), minutes=rnd.randint(0, 1440))
+            expected = issue_date + timedelta(days=rnd.choice((1, 3, 7, 14)))
+            # Небольшая доля выдач остается открытой
+            returned = None if rnd.random() < 0.02 else expected - timedelta(hours=rnd.randint(0, 48))
+            loans.append((rnd.randint(1, tools_count), f"Сотрудник {rnd.randint(1, 500)}",
+                          issue_date, expected, returned))
+        conn.executemany(
+            """
+            INSERT INTO issued_tools (tool_id, employee_name, issue_date, expected_return_date, return_date)
+            VALUES (?, ?, ?, ?, ?)
+            """,
+            loans
+        )
+        conn.executemany(
+            "INSERT INTO tool_history (tool_id, action, employee_name, timestamp) VALUES (?, 'issued', ?, ?)",
+            ((tool_id, employee, issue_date) for tool_id, employee, issue_date, _, _ in loans)
+        )
+        # Открытые выдачи занимают единицы сверх сгенерированного свободного количества
+        conn.execute("""
+            UPDATE tools SET quantity = quantity + o.open_count, reserved = o.open_count
+            FROM (
+                SELECT tool_id, COUNT(*) AS open_count FROM issued_tools
+                WHERE return_date IS NULL GROUP BY tool_id
+            ) o
+            WHERE tools.id = o.tool_id
+        """)
+        conn.commit()
+    finally:
+        conn.close()
+
+
+async def _replay_updates(handler_factory, updates, interval):
+    """
+    Запускает обработчики по расписанию и возвращает задержки по типам.
+    Задержка считается от запланированного времени поступления обновления,
+    поэтому учитывает и время ожидания заблокированного цикла событий.
+    """
+    latencies = {'light': [], 'heavy': []}
+
+    async def run_one(kind, arrival):
+        await handler_factory(kind)
+        latencies[kind].append(time.perf_counter() - arrival)
+
+    tasks = []
+    started = time.perf_counter()
+    for i, kind in enumerate(updates):
+        arrival = started + i * interval
+        delay = arrival - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(run_one(kind, arrival)))
+    await asyncio.gather(*tasks)
+    return latencies
+
+
+def bench_webhook_latency(args):
+    """Сравнивает задержку обработки обновлений: синхронный доступ к БД против AsyncToolRepository"""
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, 'tools.db')
+        print(f"Генерация данных: {args.tools} инструментов, {args.loans} выдач...")
+        generate_catalog(db_path, args.tools, args.loans)
+
+        rnd = random.Random(1)
+        # Каждое пятое обновление - тяжелый отчет, остальные не обращаются к базе
+        updates = ['heavy' if rnd.random() < 0.2 else 'light' for _ in range(args.updates)]
+
+        async def sync_handler(kind):
+            if kind == 'heavy':
+                db.get_report_stats()
+            await asyncio.sleep(0)
+
+        repo = AsyncToolRepository()
+
+        async def async_handler(kind):
+            if kind == 'heavy':
+                await repo.get_report_stats()
+            await asyncio.sleep(0)
+
+        for title, handler in (('до (синхронный sqlite3)', sync_handler),
+                               ('после (AsyncToolRepository)', async_handler)):
+            latencies = asyncio.run(_replay_updates(handler, updates, args.interval))
+            print(f"\n{title}")
+            print("  " + format_latencies("легкие обновления", latencies['light']))
+            print("  " + format_latencies("тяжелые обновления", latencies['heavy']))
+            print("  " + format_latencies("все", latencies['light'] + latencies['heavy']))
+
+        repo.close()
+        db.close_pool()
+
+
+def _legacy_report_stats(cursor):
+    """Агрегаты отчета по всей истории, как считалось до сводных таблиц"""
+    cursor.execute("""
+        SELECT COUNT(*), SUM(quantity),
+               (SELECT COUNT(*) FROM issued_tools WHERE return_date IS NULL)
+        FROM tools
+    """)
+    stats = cursor.fetchone()
+    cursor.execute("""
+        SELECT t.name, COUNT(*) AS issue_count
+        FROM issued_tools it
+        JOIN tools t ON it.tool_id = t.id
+        GROUP BY t.id, t.name
+        ORDER BY issue_count DESC
+        LIMIT 5
+    """)
+    return stats, cursor.fetchall()
+
+
+def bench_report(args):
+    """Сравнивает /report: агрегаты по всей истории против сводных таблиц"""
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, 'tools.db')
+        print(f"Генерация данных: {args.tools} инструментов, {args.loans} выдач...")
+        generate_catalog(db_path, args.tools, args.loans)
+        runs = 20
+
+        conn = sqlite3.connect(db_path)
+        legacy = []
+        for _ in range(runs):
+            started = time.perf_counter()
+            legacy_stats, legacy_top = _legacy_report_stats(conn.cursor())
+            legacy.append(time.perf_counter() - started)
+        conn.close()
+
+        current = []
+        for _ in range(runs):
+            started = time.perf_counter()
+            stats, top_tools, _, activity = db.get_report_stats()
+            current.append(time.perf_counter() - started)
+
+        # Выдача и возврат обновляют сводки триггерами: проверяем, что итоги сходятся
+        tool_id = 1
+        issue_id = db.issue_tool_for_period(tool_id, 'Сотрудник', datetime.now(), datetime.now() + timedelta(days=1))
+        db.return_tool_with_photo(issue_id, 'photo', datetime.now())
+        conn = sqlite3.connect(db_path)
+        legacy_stats, legacy_top = _legacy_report_stats(conn.cursor())
+        conn.close()
+        stats, top_tools, _, activity = db.get_report_stats()
+
+        print("до (агрегаты по истории): " + format_latencies("отчет", legacy))
+        print("после (сводные таблицы): " + format_latencies("отчет", current))
+        print(f"итоги совпадают: {tuple(stats) == tuple(legacy_stats)}, "
+              f"топ совпадает: {[c for _, c in top_tools] == [c for _, c in legacy_top]}, "
+              f"за 7 дней: {activity[7]}, за 30 дней: {activity[30]}")
+        db.close_write_queue()
+        db.close_pool()
+
+
+def _file_size_mb(*paths):
+    return sum(os.path.getsize(path) for path in paths if os.path.exists(path)) / 1024 / 1024
+
+
+def bench_history(args):
+    """Размер базы и скорость выборок истории до и после переноса старых месяцев в архивы"""
+    import history_archive
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, 'tools.db')
+        print(f"Генерация данных: {args.tools} инструментов, {args.loans} выдач (история за год)...")
+        generate_catalog(db_path, args.tools, args.loans)
+        rnd = random.Random(11)
+        runs = 20
+
+        def measure(func):
+            values = []
+            for _ in range(runs):
+                started = time.perf_counter()
+                func()
+                values.append(time.perf_counter() - started)
+            return values
+
+        def queries():
+            month_ago = datetime.now() - timedelta(days=200)
+            since = month_ago.strftime('%Y-%m-01')
+            until = (month_ago.replace(day=1) + timedelta(days=32)).strftime('%Y-%m-01')
+            return {
+                'последние 20': lambda: db.get_history_page(limit=20),
+                'инструмент, 100': lambda: db.get_tool_history(tool_id=rnd.randint(1, args.tools)),
+                'сотрудник, 100': lambda: db.get_tool_history(
+                    employee_name=f"Сотрудник {rnd.randint(1, 500)}"),
+                'месяц полгода назад, 100': lambda: db.get_tool_history(since=since, until=until),
+            }
+
+        def legacy_full_history():
+            # Прежний get_tool_history: вся история с сортировкой, без LIMIT
+            with db.DatabaseConnection() as conn:
+                conn.cursor.execute("""
+                    SELECT t.name, th.action, th.timestamp, th.employee_name, th.notes
+                    FROM tool_history th
+                    JOIN tools t ON th.tool_id = t.id
+                    ORDER BY th.timestamp DESC
+                """)
+                return conn.cursor.fetchall()
+
+        def checkpoint():
+            conn = sqlite3.connect(db_path)
+            conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+            conn.close()
+
+        checkpoint()
+        size_before = _file_size_mb(db_path)
+        print(f"\nдо: tools.db {size_before:.1f} МБ")
+        print("  " + format_latencies("вся история (прежний get_tool_history)", measure(legacy_full_history)))
+        for title, func in queries().items():
+            print("  " + format_latencies(title, measure(func)))
+
+        history_archive.HISTORY_ARCHIVE_DIR = os.path.join(tmp, 'history_archive')
+        started = time.perf_counter()
+        result = history_archive.archive_history()
+        elapsed = time.perf_counter() - started
+        checkpoint()
+        with db.DatabaseConnection() as conn:
+            conn.cursor.execute('PRAGMA freelist_count')
+            free_pages = conn.cursor.fetchone()[0]
+            conn.cursor.execute('PRAGMA page_size')
+            free_mb = free_pages * conn.cursor.fetchone()[0] / 1024 / 1024
+        archives = [path for _, path in history_archive.list_archives()]
+
+        print(f"\nархивация: {result['archived']} записей за {result['months']} мес. за {elapsed:.2f}с")
+        print(f"после: tools.db {_file_size_mb(db_path):.1f} МБ (из них {free_mb:.1f} МБ свободных страниц "
+              f"для новых записей), архивы {_file_size_mb(*archives):.1f} МБ в {len(archives)} файлах")
+        for title, func in queries().items():
+            print("  " + format_latencies(title, measure(func)))
+
+        db.close_write_queue()
+        db.close_pool()
+
+
+class _CollectingNotifier:
+    """Вместо NotificationSender: запоминает уведомления"""
+
+    def __init__(self):
+        self.sent = []
+
+    def notify(self, chat_id, text, photo=None):
+        self.sent.append((chat_id, text))
+
+
+def bench_overdue(args):
+    """Напоминания о просрочке: опрос всех открытых выдач против OverdueScheduler"""
+    from async_db import repo
+    from overdue import OverdueScheduler
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, 'tools.db')
+        print(f"Генерация данных: {args.tools} инструментов, {args.loans} выдач...")
+        generate_catalog(db_path, args.tools, args.loans)
+        # Открытые выдачи со сроками в ближайшие 7 дней у 200 сотрудников
+        rnd = random.Random(13)
+        now = datetime.now()
+        open_loans = [
+            (rnd.randint(1, args.tools), f"Сотрудник {chat_id}", now,
+             now + timedelta(minutes=rnd.randint(1, 7 * 24 * 60)), chat_id)
+            for chat_id in (rnd.randint(1, 200) for _ in range(args.loans // 10))
+        ]
+        db.run_write(lambda cursor: cursor.executemany("""
+            INSERT INTO issued_tools (tool_id, employee_name, issue_date, expected_return_date, chat_id)
+            VALUES (?, ?, ?, ?, ?)
+        """, open_loans))
+        with db.DatabaseConnection() as conn:
+            conn.cursor.execute("SELECT COUNT(*) FROM issued_tools WHERE return_date IS NULL")
+            open_count = conn.cursor.fetchone()[0]
+        print(f"Открытых выдач: {open_count}, новых сроков за неделю: {len(open_loans)}")
+
+        # До: раз в 5 минут полный просмотр открытых выдач (get_overdue_tools)
+        polls = 12
+        started = time.perf_counter()
+        for _ in range(polls):
+            db.get_overdue_tools()
+        poll_time = (time.perf_counter() - started) / polls
+        print(f"\nдо (опрос get_overdue_tools): {poll_time * 1000:.1f}мс на опрос, "
+              f"{7 * 24 * 12} опросов за неделю = {poll_time * 7 * 24 * 12:.1f}с")
+
+        async def run_scheduler():
+            notifier = _CollectingNotifier()
+            scheduler = OverdueScheduler(notifier, admin_id=1)
+            # Время моделируется: проверяем в моменты, когда планировщик проснулся бы сам
+            clock = now
+            checks, busy = 0, 0.0
+            started = time.perf_counter()
+            await scheduler.check(clock)
+            first_check = time.perf_counter() - started
+            end = now + timedelta(days=7, minutes=1)
+            while clock < end:
+                clock += timedelta(seconds=scheduler._next_wakeup(clock))
+                started = time.perf_counter()
+                await scheduler.check(clock)
+                busy += time.perf_counter() - started
+                checks += 1
+            return scheduler.get_stats(), notifier.sent, first_check, checks, busy
+
+        stats, sent, first_check, checks, busy = asyncio.run(run_scheduler())
+        repo.close()
+        print(f"после (OverdueScheduler): первая проверка {first_check * 1000:.0f}мс "
+              f"(старые просрочки: {stats['reminded'] - len(open_loans)} выдач), "
+              f"затем {checks} пробуждений за неделю, {busy:.1f}с работы")
+        print(f"  напоминаний: {stats['reminded']} выдач в {stats['borrower_messages']} сообщениях сотрудникам "
+              f"и {stats['admin_messages']} сводках админу, отправлено уведомлений: {len(sent)}")
+        db.close_write_queue()
+        db.close_pool()
+
+
+def _legacy_issue_and_return(tool_id, employee_name):
+    """Выдача и возврат так, как это делалось до очереди записи: отдельное соединение на транзакцию"""
+    now = datetime.now()
+    conn = sqlite3.connect(db.DB_PATH, timeout=args_busy_timeout)
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT quantity FROM tools WHERE id = ?", (tool_id,))
+        cursor.execute("UPDATE tools SET quantity = quantity - 1 WHERE id = ?", (tool_id,))
+        cursor.execute(
+            "INSERT INTO issued_tools (tool_id, employee_name, issue_date, expected_return_date) VALUES (?, ?, ?, ?)",
+            (tool_id, employee_name, now, now + timedelta(days=1))
+        )
+        cursor.execute(
+            "INSERT INTO tool_history (tool_id, action, employee_name, timestamp) VALUES (?, 'issued', ?, ?)",
+            (tool_id, employee_name, now)
+        )
+        conn.commit()
+        cursor.execute("UPDATE issued_tools SET return_date = ? WHERE tool_id = ? AND return_date IS NULL",
+                       (now, tool_id))
+        cursor.execute("UPDATE tools SET quantity = quantity + 1 WHERE id = ?", (tool_id,))
+        cursor.execute(
+            "INSERT INTO tool_history (tool_id, action, employee_name, timestamp) VALUES (?, 'returned', ?, ?)",
+            (tool_id, employee_name, now)
+        )
+        conn.commit()
+    finally:
+        conn.close()
+
+
+# Таймаут ожидания блокировки для "старого" режима (по умолчанию sqlite3 ждет 5 секунд)
+args_busy_timeout = 5.0
+
+
+def _queued_issue_and_return(tool_id, employee_name):
+    """Выдача и возврат через db.py (очередь записи с групповыми коммитами)"""
+    now = datetime.now()
+    issue_id = db.issue_tool_for_period(tool_id, employee_name, now, now + timedelta(days=1))
+    db.return_tool_with_photo(issue_id, None, now)
+
+
+def bench_write_contention(args):
+    """Сравнивает пропускную способность параллельных выдач/возвратов: журнал отката против WAL + очереди записи"""
+    from concurrent.futures import ThreadPoolExecutor
+
+    for title, profile, operation in (
+        ('до (журнал отката, соединение на транзакцию)', 'legacy', _legacy_issue_and_return),
+        ('после (WAL + очередь записи)', 'default', _queued_issue_and_return),
+    ):
+        with tempfile.TemporaryDirectory() as tmp:
+            db.DB_STORAGE_PROFILE = profile
+            generate_catalog(os.path.join(tmp, 'tools.db'), args.tools, 0)
+            errors = []
+            latencies = []
+
+            def worker(worker_id):
+                for i in range(args.operations):
+                    started = time.perf_counter()
+                    try:
+                        # У каждого потока свой инструмент, чтобы операции не конфликтовали по данным
+                        operation(1 + worker_id % args.tools, f"Сотрудник {worker_id}")
+                    except Exception as e:
+                        errors.append(e)
+                    latencies.append(time.perf_counter() - started)
+
+            started = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=args.threads) as executor:
+                list(executor.map(worker, range(args.threads)))
+            elapsed = time.perf_counter() - started
+
+            total = args.threads * args.operations
+            print(f"\n{title}")
+            print(f"  {total} выдач+возвратов за {elapsed:.2f}с ({total / elapsed:.0f} оп/с), ошибок: {len(errors)}")
+            if errors:
+                print(f"  первая ошибка: {errors[0]!r}")
+            print("  " + format_latencies("операция", latencies))
+            if profile == 'default':
+                print(f"  очередь записи: {db.get_write_queue().get_stats()}")
+            db.close_write_queue()
+            db.close_pool()
+
+
+def _stock_legacy_issue(db_path, tool_id, employee_name):
+    """Выдача как до учета единиц: остаток проверяется одним запросом, единица занимается другим"""
+    conn = sqlite3.connect(db_path, timeout=30)
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT quantity - reserved FROM tools WHERE id = ?", (tool_id,))
+        if cursor.fetchone()[0] <= 0:
+            raise ValueError("Инструмент больше не доступен")
+        cursor.execute("UPDATE tools SET reserved = reserved + 1 WHERE id = ?", (tool_id,))
+        cursor.execute("INSERT INTO issued_tools (tool_id, employee_name) VALUES (?, ?)", (tool_id, employee_name))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def _stock_atomic_issue(db_path, tool_id, employee_name):
+    """Выдача через db.open_loan на отдельном соединении, как из другого процесса"""
+    conn = sqlite3.connect(db_path, timeout=30)
+    try:
+        db.open_loan(conn.cursor(), tool_id, employee_name)
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def _stock_state(db_path, tool_id):
+    """(всего единиц, выдано по счетчику, открытых выдач)"""
+    conn = sqlite3.connect(db_path)
+    try:
+        return conn.execute("""
+            SELECT quantity, reserved,
+                   (SELECT COUNT(*) FROM issued_tools WHERE tool_id = tools.id AND return_date IS NULL)
+            FROM tools WHERE id = ?
+        """, (tool_id,)).fetchone()
+    finally:
+        conn.close()
+
+
+def bench_stock(args):
+    """
+    Конкурентная выдача одного инструмента: --threads потоков по --operations попыток
+    (и --updates задач asyncio через AsyncToolRepository) на --units единиц.
+    Проверяет, что выдано ровно --units, счетчик reserved равен числу открытых
+    выдач, а после параллельного возврата всех выдач единицы освобождены.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    tool_id = 1
+    ok = True
+    # Отказы в выдаче здесь ожидаемы и считаются отдельно: их журнал только засорит вывод
+    logging.disable(logging.ERROR)
+    for title, mode in (
+        ('до (проверка и запись отдельными запросами)', 'legacy'),
+        ('после (условный UPDATE, отдельные соединения)', 'atomic'),
+        ('после (условный UPDATE, очередь записи и asyncio)', 'queue'),
+    ):
+        with tempfile.TemporaryDirectory() as tmp:
+            db_path = os.path.join(tmp, 'tools.db')
+            generate_catalog(db_path, 1, 0)
+            conn = sqlite3.connect(db_path)
+            conn.execute("UPDATE tools SET quantity = ? WHERE id = ?", (args.units, tool_id))
+            if mode == 'legacy':
+                # Без триггера: показываем, сколько единиц старый путь выдал бы сверх наличия
+                conn.execute("DROP TRIGGER trg_tools_stock_check")
+            conn.commit()
+            conn.close()
+
+            # Исходы попыток из потоков и задач: list.append не теряет значения при конкуренции
+            outcomes = []
+            errors = []
+
+            def attempt(operation, *params):
+                try:
+                    result = operation(*params)
+                except ValueError:
+                    result = False
+                except Exception as e:
+                    errors.append(e)
+                    outcomes.append('errors')
+                    return
+                outcomes.append('issued' if result is not False else 'refused')
+
+            def worker(worker_id):
+                for i in range(args.operations):
+                    employee_name = f"Сотрудник {worker_id}-{i}"
+                    if mode == 'legacy':
+                        attempt(_stock_legacy_issue, db_path, tool_id, employee_name)
+                    elif mode == 'atomic':
+                        attempt(_stock_atomic_issue, db_path, tool_id, employee_name)
+                    else:
+                        now = datetime.now()
+                        attempt(db.issue_tool_for_period, tool_id, employee_name, now, now + timedelta(days=1))
+
+            async def run_queue():
+                repo = AsyncToolRepository()
+                loop = asyncio.get_running_loop()
+                executor = ThreadPoolExecutor(max_workers=args.threads)
+
+                async def issue_task(i):
+                    now = datetime.now()
+                    employee_name = f"Сотрудник async-{i}"
+                    try:
+                        # Каждая вторая задача идет через запрос и одобрение
+                        if i % 2:
+                            created = await repo.create_tool_request(tool_id, employee_name, i)
+                            result = created and await repo.approve_issue_request(tool_id, i)
+                        else:
+                            result = await repo.issue_tool_for_period(
+                                tool_id, employee_name, now, now + timedelta(days=1), i
+                            )
+                    except ValueError:
+                        result = False
+                    except Exception as e:
+                        errors.append(e)
+                        outcomes.append('errors')
+                        return
+                    outcomes.append('issued' if result is not False else 'refused')
+
+                await asyncio.gather(
+                    *(loop.run_in_executor(executor, worker, worker_id) for worker_id in range(args.threads)),
+                    *(issue_task(i) for i in range(args.updates))
+                )
+                issued_state = _stock_state(db_path, tool_id)
+
+                # Все выдачи возвращаются одновременно
+                with db.DatabaseConnection() as conn:
+                    conn.cursor.execute(
+                        "SELECT id FROM issued_tools WHERE tool_id = ? AND return_date IS NULL", (tool_id,)
+                    )
+                    issue_ids = [row[0] for row in conn.cursor.fetchall()]
+                returned = await asyncio.gather(
+                    *(repo.return_tool_with_photo(issue_id, None, datetime.now()) for issue_id in issue_ids),
+                    *(repo.return_tool_with_photo(issue_id, None, datetime.now()) for issue_id in issue_ids[:10]),
+                    return_exceptions=True
+                )
+                executor.shutdown()
+                repo.close()
+                double_returns = sum(not isinstance(result, ValueError) for result in returned[len(issue_ids):])
+                return issued_state, double_returns
+
+            started = time.perf_counter()
+            if mode == 'queue':
+                (quantity, reserved, open_loans), double_returns = asyncio.run(run_queue())
+                attempts = args.threads * args.operations + args.updates
+            else:
+                with ThreadPoolExecutor(max_workers=args.threads) as executor:
+                    list(executor.map(worker, range(args.threads)))
+                quantity, reserved, open_loans = _stock_state(db_path, tool_id)
+                attempts = args.threads * args.operations
+            elapsed = time.perf_counter() - started
+
+            counts = {key: outcomes.count(key) for key in ('issued', 'refused', 'errors')}
+            oversold = max(0, open_loans - quantity)
+            consistent = counts['issued'] == open_loans == reserved == min(quantity, attempts)
+            print(f"\n{title}")
+            print(f"  {attempts} попыток за {elapsed:.2f}с: выдано {counts['issued']} из {quantity}, "
+                  f"отказов {counts['refused']}, ошибок {counts['errors']}")
+            print(f"  открытых выдач {open_loans}, счетчик reserved {reserved}, сверх наличия {oversold}")
+            if errors:
+                print(f"  первая ошибка: {errors[0]!r}")
+            if mode == 'queue':
+                _, reserved_after, open_after = _stock_state(db_path, tool_id)
+                print(f"  после параллельного возврата: reserved {reserved_after}, открытых выдач {open_after}, "
+                      f"повторных возвратов принято {double_returns}")
+                consistent = consistent and reserved_after == open_after == 0 and double_returns == 0
+            print(f"  {'✅ учет сходится' if consistent else '❌ учет не сходится'}")
+            if mode != 'legacy':
+                ok = ok and consistent
+            db.close_write_queue()
+            db.close_pool()
+    if not ok:
+        sys.exit(1)
+
+
+SYNTHETIC_BRANDS = ('Milwaukee', 'Makita', 'Bosch', 'DeWalt', 'Metabo', 'Hilti', 'Интерскол', 'Зубр', 'Ryobi', 'AEG')
+SYNTHETIC_TYPES = ('Болгарка', 'Перфоратор', 'Шуруповёрт', 'Сабельная пила', 'Пылесос', 'Лазерный уровень',
+                   'Удлинитель', 'Лестница', 'Аккумулятор', 'Зарядное устройство', 'Дрель', 'Фен строительный')
+
+
+def synthetic_tool_names(count, seed=7):
+    """Генерирует названия инструментов в стиле каталога"""
+    rnd = random.Random(seed)
+    return [
+        f"{rnd.choice(SYNTHETIC_BRANDS)} - {rnd.choice(SYNTHETIC_TYPES)} {rnd.choice('ABCDEFGHKMX')}{rnd.randint(10, 9999)}"
+        for _ in range(count)
+    ]
+
+
+def bench_search(args):
+    """Сравнивает поиск LIKE '%...%' в SQLite с индексом ToolSearchIndex на синтетическом каталоге"""
+    from search_index import ToolSearchIndex
+
+    names = synthetic_tool_names(args.catalog)
+    queries = ['makita', 'макита', 'перфоратр', 'болг', 'бош', 'милуоки', 'пылесос metabo',
+               'зарядное', 'dewalt дрель', 'фен']
+
+    with tempfile.TemporaryDirectory() as tmp:
+        conn = sqlite3.connect(os.path.join(tmp, 'tools.db'))
+        conn.execute("CREATE TABLE tools (id INTEGER PRIMARY KEY, name TEXT NOT NULL, quantity INTEGER DEFAULT 1)")
+        conn.executemany("INSERT INTO tools (name) VALUES (?)", ((name,) for name in names))
+        conn.commit()
+
+        like_latencies = []
+        like_hits = {}
+        for _ in range(args.repeat):
+            for query in queries:
+                started = time.perf_counter()
+                rows = conn.execute(
+                    "SELECT id, name FROM tools WHERE LOWER(name) LIKE ?", (f"%{query.lower()}%",)
+                ).fetchall()
+                like_latencies.append(time.perf_counter() - started)
+                like_hits[query] = len(rows)
+        conn.close()
+
+    started = time.perf_counter()
+    index = ToolSearchIndex()
+    index.rebuild(enumerate(names, 1))
+    build_time = time.perf_counter() - started
+
+    index_latencies = []
+    index_hits = {}
+    for _ in range(args.repeat):
+        for query in queries:
+            started = time.perf_counter()
+            results = index.search(query, limit=20)
+            index_latencies.append(time.perf_counter() - started)
+            index_hits[query] = len(results)
+
+    print(f"Каталог: {args.catalog} инструментов")
+    print("\nдо (LIKE '%запрос%' в SQLite)")
+    print("  " + format_latencies("запрос", like_latencies))
+    print("\nпосле (ToolSearchIndex)")
+    print(f"  построение индекса: {build_time:.2f}с")
+    print("  " + format_latencies("запрос (top 20)", index_latencies))
+    print("\nНайдено (LIKE / индекс, top 20):")
+    for query in queries:
+        print(f"  {query!r}: {like_hits[query]} / {index_hits[query]}")
+
+
+def _write_catalog_csv(path, count, seed=7):
+    """Пишет синтетический каталог в CSV построчно, не держа его в памяти"""
+    rnd = random.Random(seed)
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(['name', 'quantity', 'description'])
+        for number in range(count):
+            name = f"{rnd.choice(SYNTHETIC_BRANDS)} - {rnd.choice(SYNTHETIC_TYPES)} #{number}"
+            writer.writerow([name, number % 7 + 1, ''])
+
+
+def bench_import(args):
+    """Сравнивает построчную вставку (как в populate_database) с import_tools на CSV-каталоге"""
+    import import_tools
+
+    with tempfile.TemporaryDirectory() as tmp:
+        csv_path = os.path.join(tmp, 'catalog.csv')
+        _write_catalog_csv(csv_path, args.catalog)
+        baseline_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+        db.DB_PATH = os.path.join(tmp, 'legacy.db')
+        db.create_tables()
+        conn = sqlite3.connect(db.DB_PATH)
+        started = time.perf_counter()
+        for record in import_tools.read_csv(csv_path):
+            conn.execute(
+                "INSERT INTO tools (name, quantity, status) VALUES (?, ?, 'available')",
+                (record['name'], int(record['quantity']))
+            )
+        conn.commit()
+        legacy_time = time.perf_counter() - started
+        conn.close()
+        db.close_pool()
+
+        db.DB_PATH = os.path.join(tmp, 'tools.db')
+        stats = import_tools.import_records(import_tools.read_csv(csv_path))
+        # Повторный импорт того же файла: все строки обновляются по названию
+        again = import_tools.import_records(import_tools.read_csv(csv_path))
+        db.close_pool()
+
+    peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f"Каталог: {args.catalog} строк CSV")
+    print(f"\nдо (execute на каждую строку): {legacy_time:.2f}с ({args.catalog / legacy_time:.0f} строк/с)")
+    print(f"после (import_tools, пачки по {import_tools.IMPORT_BATCH_SIZE}):")
+    print(f"  новая база: {stats['seconds']:.2f}с ({stats['rows'] / stats['seconds']:.0f} строк/с), "
+          f"добавлено {stats['inserted']}")
+    print(f"  повторный импорт: {again['seconds']:.2f}с ({again['rows'] / again['seconds']:.0f} строк/с), "
+          f"обновлено {again['updated']}")
+    print(f"пиковая память процесса: {peak_mb:.0f} МБ (до импорта {baseline_mb:.0f} МБ)")
+
+
+_COLD_START_SCRIPT = """
+import asyncio, json, sys, time
+started = time.perf_counter()
+import bot
+imported = time.perf_counter() - started
+from aiogram import types
+
+async def fake_request(method, data=None, files=None, **kwargs):
+    if method == 'sendMessage':
+        return {'message_id': 2, 'date': 0, 'chat': {'id': 1, 'type': 'private'}, 'text': ''}
+    return True
+
+async def main():
+    # Bot API заменен заглушкой: замеряем только собственную работу процесса
+    bot.bot.request = fake_request
+    app = bot.build_app()
+    await bot.on_startup(app)
+    update = types.Update(**{
+        'update_id': 1,
+        'message': {'message_id': 1, 'date': 0, 'text': '/help',
+                    'chat': {'id': 1, 'type': 'private'},
+                    'from': {'id': 1, 'is_bot': False, 'first_name': 'A'},
+                    'entities': [{'type': 'bot_command', 'offset': 0, 'length': 5}]},
+    })
+    await bot.dp.process_update(update)
+    await app['warm_caches']
+    await bot.on_shutdown(app)
+    print(json.dumps({'import': imported, **bot.STARTUP_TIMINGS}))
+
+asyncio.run(main())
+"""
+
+
+def bench_cold_start(args):
+    """Замеряет фазы запуска бота в отдельном процессе и время до первого обработанного обновления"""
+    with tempfile.TemporaryDirectory() as tmp:
+        print(f"Генерация данных: {args.tools} инструментов, {args.loans} выдач...")
+        generate_catalog(os.path.join(tmp, 'tools.db'), args.tools, args.loans)
+        db.close_pool()
+
+        env = dict(os.environ, DATA_DIR=tmp)
+        runs = []
+        for _ in range(args.repeat):
+            output = subprocess.run(
+                [sys.executable, '-c', _COLD_START_SCRIPT],
+                env=env, cwd=os.path.dirname(os.path.abspath(__file__)),
+                capture_output=True, text=True, check=True
+            ).stdout
+            runs.append(json.loads(output.strip().splitlines()[-1]))
+
+    print(f"\nФазы запуска, медиана из {args.repeat} запусков:")
+    for phase in runs[0]:
+        print(f"  {phase}: {percentile([run[phase] for run in runs], 50) * 1000:.1f}мс")
+
+
+async def _fsm_operations(storage, users):
+    """Прогоняет типичный диалог выдачи для каждого пользователя; возвращает задержки по операциям"""
+    latencies = {'get_state': [], 'get_data': [], 'set_state': [], 'update_data': [], 'finish': []}
+
+    async def timed(name, coro):
+        started = time.perf_counter()
+        result = await coro
+        latencies[name].append(time.perf_counter() - started)
+        return result
+
+    for user in range(users):
+        address = {'chat': user, 'user': user}
+        await timed('get_state', storage.get_state(**address))
+        await timed('set_state', storage.set_state(**address, state='ToolIssueState:waiting_for_tool_id'))
+        await timed('update_data', storage.update_data(**address, data={'tool_id': user, 'tool_name': 'Makita'}))
+        await timed('get_state', storage.get_state(**address))
+        await timed('set_state', storage.set_state(**address, state='ToolIssueState:waiting_for_confirmation'))
+        await timed('get_data', storage.get_data(**address))
+        # Каждый второй диалог остается незавершенным
+        if user % 2:
+            await timed('finish', storage.reset_state(**address))
+    return latencies
+
+
+def bench_fsm(args):
+    """Сравнивает задержки операций MemoryStorage и SQLiteStorage на типичном диалоге"""
+    from aiogram.contrib.fsm_storage.memory import MemoryStorage
+    from fsm_storage import SQLiteStorage
+
+    users = args.updates
+    print(f"Диалогов: {users}")
+    results = [('MemoryStorage', asyncio.run(_fsm_operations(MemoryStorage(), users)))]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db.DB_PATH = os.path.join(tmp, 'tools.db')
+        db.create_tables()
+
+        async def run_sqlite():
+            storage = SQLiteStorage(default_ttl=0.5)
+            latencies = await _fsm_operations(storage, users)
+            active = storage.get_stats()['active']
+            # Незавершенные диалоги должны истечь и быть удалены
+            await asyncio.sleep(0.6)
+            removed = await storage.reap()
+            # Новый экземпляр (как после перезапуска) видит только живые состояния
+            await storage.set_state(chat=1, user=1, state='SearchState:waiting_for_query')
+            restarted = SQLiteStorage()
+            restored = await restarted.get_state(chat=1, user=1)
+            print(f"SQLiteStorage: активных диалогов {active}, удалено просроченных {removed}, "
+                  f"после перезапуска: {restored}")
+            return latencies
+
+        results.append(('SQLiteStorage', asyncio.run(run_sqlite())))
+        db.close_write_queue()
+        db.close_pool()
+
+    for title, latencies in results:
+        print(f"\n{title}")
+        for name, values in latencies.items():
+            print("  " + format_latencies(name, values))
+
+
+def bench_throttling(args):
+    """Память и скорость ограничителя частоты: старый словарь времени нажатий против TokenBucketLimiter"""
+    from throttling import TokenBucketLimiter
+
+    users = args.catalog
+    rnd = random.Random(3)
+    # Поток нажатий: пользователи приходят один раз и больше не возвращаются
+    events = [(rnd.randrange(users), i * 0.001) for i in range(users)]
+
+    last_click = {}
+    started = time.perf_counter()
+    for user_id, now in events:
+        if now - last_click.get(user_id, -1) >= 1:
+            last_click[user_id] = now
+    legacy_time = time.perf_counter() - started
+
+    limiter = TokenBucketLimiter(rate=1, burst=2, max_keys=10000)
+    started = time.perf_counter()
+    for user_id, now in events:
+        limiter.allow(user_id, now)
+    limiter_time = time.perf_counter() - started
+
+    print(f"Нажатий: {len(events)} от {users} пользователей")
+    print(f"до (словарь времени нажатий): {len(last_click)} записей, "
+          f"{legacy_time / len(events) * 1e6:.2f}мкс на проверку")
+    print(f"после (TokenBucketLimiter): {len(limiter)} корзин, "
+          f"{limiter_time / len(events) * 1e6:.2f}мкс на проверку")
+
+
+def _synthetic_update(update_id, chat_id):
+    from aiogram import types
+    return types.Update(**{
+        'update_id': update_id,
+        'message': {'message_id': update_id, 'date': 0, 'text': 'x',
+                    'chat': {'id': chat_id, 'type': 'private'},
+                    'from': {'id': chat_id, 'is_bot': False, 'first_name': 'A'}},
+    })
+
+
+def bench_ingestion(args):
+    """Сравнивает время ответа вебхука: обработка до ответа против UpdateQueue"""
+    from ingestion import UpdateQueue
+
+    rnd = random.Random(5)
+    chats = 50
+    updates = [_synthetic_update(i, rnd.randrange(chats)) for i in range(args.updates)]
+    handler_time = 0.05  # БД + отправка сообщений админу
+
+    async def run(use_queue):
+        done = {}
+        order_errors = 0
+
+        async def process(update):
+            nonlocal order_errors
+            await asyncio.sleep(handler_time)
+            chat_id = update.message.chat.id
+            if done.get(chat_id, -1) > update.update_id:
+                order_errors += 1
+            done[chat_id] = update.update_id
+
+        queue = UpdateQueue(process)
+        queue.start()
+        acks = []
+
+        async def webhook(update, arrival):
+            if use_queue:
+                await queue.submit(update)
+            else:
+                await process(update)
+            acks.append(time.perf_counter() - arrival)
+
+        tasks = []
+        started = time.perf_counter()
+        for i, update in enumerate(updates):
+            arrival = started + i * args.interval
+            delay = arrival - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.create_task(webhook(update, arrival)))
+        await asyncio.gather(*tasks)
+        await queue.close()
+        return acks, time.perf_counter() - started, order_errors, queue.get_stats()
+
+    print(f"Обновлений: {len(updates)}, чатов: {chats}, обработка {handler_time * 1000:.0f}мс, "
+          f"интервал {args.interval * 1000:.0f}мс")
+    for title, use_queue in (('до (ответ после обработки)', False), ('после (UpdateQueue)', True)):
+        acks, total, order_errors, stats = asyncio.run(run(use_queue))
+        print(f"\n{title}")
+        print("  " + format_latencies("ответ вебхука", acks))
+        print(f"  все обработаны за {total:.2f}с, нарушений порядка в чатах: {order_errors}")
+        if use_queue:
+            print(f"  задержка в очереди: p50={stats['lag_p50'] * 1000:.1f}ms "
+                  f"p99={stats['lag_p99'] * 1000:.1f}ms, отклонено: {stats['rejected']}")
+
+
+def bench_dedup(args):
+    """Повторные доставки: сколько обновлений применено дважды без UpdateDeduplicator и с ним"""
+    from ingestion import UpdateDeduplicator, UpdateQueue
+
+    rnd = random.Random(7)
+    updates = [_synthetic_update(i, rnd.randrange(50)) for i in range(1, args.updates + 1)]
+    # 10% обновлений Telegram доставляет повторно, часть - уже после обработки оригинала
+    deliveries = list(updates)
+    for update in rnd.sample(updates, len(updates) // 10):
+        deliveries.insert(min(len(deliveries), update.update_id + rnd.randrange(200)), update)
+
+    async def run(dedup):
+        applied = {}
+
+        async def process(update):
+            applied[update.update_id] = applied.get(update.update_id, 0) + 1
+
+        queue = UpdateQueue(process, dedup=dedup)
+        queue.start()
+        for update in deliveries:
+            await queue.submit(update)
+        await queue.close()
+        return sum(count - 1 for count in applied.values())
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db.DB_PATH = os.path.join(tmp, 'tools.db')
+        db.create_tables()
+
+        async def run_with_dedup():
+            dedup = UpdateDeduplicator()
+            await dedup.start()
+            twice = await run(dedup)
+            await dedup.close()
+            stats = dedup.get_stats()
+            # После перезапуска окно в памяти пустое, повторы отсекает сохраненная граница
+            restarted = UpdateDeduplicator()
+            await restarted.start()
+            replayed = sum(not restarted.accept(update.update_id) for update in updates[-1000:])
+            await restarted.close()
+
+            # Отклоненное обновление (очередь переполнена) не должно считаться обработанным:
+            # более поздние обновления обработаны, граница сохранена, Telegram доставляет его снова
+            base = args.updates + 1
+            rejected = UpdateDeduplicator()
+            await rejected.start()
+            for update_id in range(base, base + 10):
+                rejected.accept(update_id)
+            rejected.forget(base + 3)
+            for update_id in range(base, base + 10):
+                if update_id != base + 3:
+                    rejected.done(update_id)
+            await rejected.flush()
+            redelivered = rejected.accept(base + 3)
+            rejected.done(base + 3)
+            await rejected.close()
+            redelivery = (redelivered, rejected.get_stats()['watermark'] == base + 9)
+
+            checks = [rnd.randrange(args.updates * 2) for _ in range(100000)]
+            started = time.perf_counter()
+            for update_id in checks:
+                dedup.accept(update_id)
+            check_time = (time.perf_counter() - started) / len(checks)
+            return twice, replayed, stats, check_time, redelivery
+
+        print(f"Обновлений: {len(updates)}, доставок: {len(deliveries)}")
+        print(f"до (без дедупликации): применено повторно {asyncio.run(run(None))}")
+        twice, replayed, stats, check_time, redelivery = asyncio.run(run_with_dedup())
+        print(f"после (UpdateDeduplicator): применено повторно {twice}, "
+              f"отброшено повторов {stats['duplicates']}, граница {stats['watermark']}")
+        print(f"  после перезапуска отброшено {replayed} из 1000 уже обработанных, "
+              f"{check_time * 1e6:.2f}мкс на проверку")
+        print(f"  отклоненное обновление после сохранения границы: повторная доставка "
+              f"{'принята' if redelivery[0] else 'ПОТЕРЯНА'}, "
+              f"граница {'сдвинута после обработки' if redelivery[1] else 'НЕ сдвинута'}")
+        db.close_write_queue()
+        db.close_pool()
+
+
+class _FakeTelegram:
+    """Bot API с задержкой ответа и ограничением 1 сообщение в секунду на чат (иначе RetryAfter)"""
+
+    def __init__(self, latency=0.1):
+        self.latency = latency
+        self.calls = 0
+        self.flood_errors = 0
+        self._last = {}
+
+    async def send_message(self, chat_id, text, **kwargs):
+        from aiogram.utils.exceptions import RetryAfter
+
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        now = time.monotonic()
+        if now - self._last.get(chat_id, -1) < 1:
+            self.flood_errors += 1
+            raise RetryAfter(1)
+        self._last[chat_id] = now
+
+    send_photo = send_message
+
+
+def bench_notifications(args):
+    """Уведомления админу: отправка в обработчике против NotificationSender при всплеске выдач"""
+    from notifications import NotificationSender
+
+    events = args.updates
+
+    async def run(use_sender):
+        telegram = _FakeTelegram()
+        sender = NotificationSender(telegram)
+        sender.start()
+        replies = []
+
+        async def handler(number):
+            started = time.perf_counter()
+            text = f"📢 Выдан инструмент:\n🔧 Инструмент {number}\n👤 Сотрудник: Иван Петров"
+            if use_sender:
+                sender.notify(1, text)
+            else:
+                try:
+                    await telegram.send_message(1, text)
+                except Exception:
+                    pass  # Как в старом коде: ошибка отправки срывала ответ пользователю
+            replies.append(time.perf_counter() - started)
+
+        tasks = []
+        for number in range(events):
+            tasks.append(asyncio.create_task(handler(number)))
+            await asyncio.sleep(args.interval)
+        await asyncio.gather(*tasks)
+        await sender.close(timeout=60)
+        return replies, telegram, sender.get_stats()
+
+    print(f"Уведомлений: {events}, интервал {args.interval * 1000:.0f}мс, ответ Bot API 100мс")
+    replies, telegram, _ = asyncio.run(run(False))
+    print("\nдо (send_message в обработчике)")
+    print("  " + format_latencies("ответ пользователю", replies))
+    print(f"  вызовов API: {telegram.calls}, отказов из-за лимита: {telegram.flood_errors} (уведомления потеряны)")
+    replies, telegram, stats = asyncio.run(run(True))
+    print("\nпосле (NotificationSender)")
+    print("  " + format_latencies("ответ пользователю", replies))
+    print(f"  вызовов API: {telegram.calls}, отказов из-за лимита: {telegram.flood_errors}, "
+          f"доставлено {stats['delivered']} в {stats['messages']} сообщениях, потеряно {stats['failed']}")
+    print(f"  задержка доставки: p50={stats['latency_p50'] * 1000:.0f}ms p99={stats['latency_p99'] * 1000:.0f}ms")
+
+
+class _FakePhotoTelegram:
+    """Bot API: ответ 100мс, загрузка файла со скоростью 5 МБ/с; скачивание отдает заданные байты"""
+
+    def __init__(self, files, latency=0.1, upload_rate=5 * 1024 * 1024):
+        from types import SimpleNamespace
+
+        self._namespace = SimpleNamespace
+        self.files = files
+        self.latency = latency
+        self.upload_rate = upload_rate
+        self.uploads = 0
+        self.uploaded_bytes = 0
+
+    async def send_photo(self, chat_id, photo, caption=None, **kwargs):
+        from aiogram import types
+
+        delay = self.latency
+        if isinstance(photo, types.InputFile):
+            size = os.path.getsize(photo.file.name)
+            self.uploads += 1
+            self.uploaded_bytes += size
+            delay += size / self.upload_rate
+            photo = f"catalog-{self.uploads}"
+        await asyncio.sleep(delay)
+        return self._namespace(photo=[self._namespace(file_id=photo)])
+
+    async def download_file_by_id(self, file_id, destination=None, **kwargs):
+        await asyncio.sleep(self.latency)
+        destination.write(self.files[file_id])
+        return destination
+
+
+def bench_media(args):
+    """Фото возврата и картинки каталога: хранилище по хэшу и кэш file_id"""
+    import glob
+    from aiogram import types
+    from async_db import repo
+    from media import CatalogImages, CATALOG_IMAGES_DIR, PhotoDownloader, media_dir
+
+    images = sorted(glob.glob(os.path.join(CATALOG_IMAGES_DIR, '*.jpg')))
+    samples = [open(path, 'rb').read() for path in images + glob.glob('return_photos/*.jpg')]
+    with tempfile.TemporaryDirectory() as tmp:
+        db.DB_PATH = os.path.join(tmp, 'tools.db')
+        db.create_tables()
+        # Возвраты: каждое пятое фото - повтор уже присланного (то же содержимое, другой file_id)
+        rnd = random.Random(5)
+        files = {}
+        for number in range(args.updates):
+            if number % 5 == 4:
+                files[f"photo-{number}"] = files[f"photo-{rnd.randrange(number)}"]
+            else:
+                files[f"photo-{number}"] = samples[number % len(samples)] + number.to_bytes(4, 'big')
+        naive_bytes = sum(len(data) for data in files.values())
+
+        async def run_downloads():
+            downloader = PhotoDownloader(_FakePhotoTelegram(files), workers=4)
+            downloader.start()
+            started = time.perf_counter()
+            for file_id in files:
+                downloader.submit(file_id)
+            await downloader.close(timeout=600)
+            return downloader.get_stats(), time.perf_counter() - started
+
+        stats, elapsed = asyncio.run(run_downloads())
+        stored = [path for path in glob.glob(os.path.join(media_dir(), '??', '*.jpg'))]
+        stored_bytes = sum(os.path.getsize(path) for path in stored)
+        print(f"Фото возврата: {len(files)}, из них повторов содержимого: {args.updates // 5}")
+        print(f"  файл на каждый возврат: {len(files)} файлов, {naive_bytes / 1024 / 1024:.1f} МБ")
+        print(f"  хранилище по хэшу: {len(stored)} файлов, {stored_bytes / 1024 / 1024:.1f} МБ, "
+              f"скачано за {elapsed:.1f}с ({stats['downloaded']} новых, {stats['deduplicated']} повторов)")
+
+        async def run_catalog(cache):
+            telegram = _FakePhotoTelegram({})
+            catalog = CatalogImages(telegram)
+            names = [os.path.basename(path) for path in images]
+            views = [names[rnd.randrange(len(names))] for _ in range(args.updates)]
+            latencies = []
+            for name in views:
+                started = time.perf_counter()
+                if cache:
+                    await catalog.send_photo(1, name, caption=name)
+                else:
+                    await telegram.send_photo(1, types.InputFile(os.path.join(CATALOG_IMAGES_DIR, name)))
+                latencies.append(time.perf_counter() - started)
+            return telegram, latencies
+
+        print(f"\nКартинки каталога: {len(images)}, просмотров: {args.updates}, "
+              f"ответ Bot API 100мс, загрузка 5 МБ/с")
+        telegram, latencies = asyncio.run(run_catalog(False))
+        print(f"  до (загрузка каждый раз): загрузок {telegram.uploads}, "
+              f"{telegram.uploaded_bytes / 1024 / 1024:.1f} МБ; " + format_latencies("отправка", latencies))
+        telegram, latencies = asyncio.run(run_catalog(True))
+        print(f"  после (CatalogImages): загрузок {telegram.uploads}, "
+              f"{telegram.uploaded_bytes / 1024 / 1024:.1f} МБ; " + format_latencies("отправка", latencies))
+        repo.close()
+        db.close_write_queue()
+        db.close_pool()
+
+
+class _StubBotAPI:
+    """
+    Локальный сервер Bot API: отвечает на методы бота без обращения к Telegram,
+    с задержкой latency секунд. Бот ходит к нему по HTTP так же, как к api.telegram.org.
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = {}
+        self._runner = None
+        self.url = None
+
+    async def _handle(self, request):
+        from aiohttp import web
+
+        method = request.match_info['method']
+        self.calls[method] = self.calls.get(method, 0) + 1
+        form = await request.post()
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        result = True
+        if method in ('sendMessage', 'sendPhoto', 'editMessageText'):
+            chat_id = int(form.get('chat_id', 0))
+            result = {'message_id': self.calls[method], 'date': int(time.time()),
+                      'chat': {'id': chat_id, 'type': 'private'}, 'text': form.get('text', '')}
+            if method == 'sendPhoto':
+                result['photo'] = [{'file_id': f"stub-photo-{self.calls[method]}",
+                                    'file_unique_id': 'stub', 'width': 1, 'height': 1}]
+        return web.json_response({'ok': True, 'result': result})
+
+    async def start(self):
+        from aiohttp import web
+
+        app = web.Application()
+        app.router.add_post('/bot{token}/{method}', self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://127.0.0.1:{port}"
+
+    async def close(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+
+def _open_issue_id(employee_name):
+    """ID последней открытой выдачи сотрудника: /return выбирает выдачу, а не инструмент"""
+    with db.DatabaseConnection() as conn:
+        conn.cursor.execute(
+            "SELECT MAX(id) FROM issued_tools WHERE employee_name = ? AND return_date IS NULL",
+            (employee_name,)
+        )
+        return str(conn.cursor.fetchone()[0])
+
+
+def _load_scenario(user, tools_count):
+    """
+    Диалоги одного сотрудника: [(команда, текст или None для фото)].
+    Текст-функция вычисляется перед отправкой обновления.
+    """
+    tool_id = str(user % tools_count + 1)
+    employee_name = f"Сотрудник {user}"
+    return [
+        ('/list', '/list'),
+        ('/search', '/search'), ('/search', f"Инструмент {user % tools_count:06d}"),
+        ('/issue', '/issue'), ('/issue', tool_id), ('/issue', employee_name),
+        ('/issue', '7 дней'), ('/issue', '✅ Подтвердить'),
+        ('/return', '/return'), ('/return', lambda: _open_issue_id(employee_name)),
+        ('/return', None), ('/return', '✅ Подтвердить'),
+    ]
+
+
+def _load_update(update_id, user_id, text):
+    from aiogram import types
+
+    message = {'message_id': update_id, 'date': int(time.time()),
+               'chat': {'id': user_id, 'type': 'private'},
+               'from': {'id': user_id, 'is_bot': False, 'first_name': 'Load'}}
+    if text is None:
+        message['photo'] = [{'file_id': f"load-photo-{update_id}", 'file_unique_id': str(update_id),
+                             'width': 1280, 'height': 960}]
+    else:
+        message['text'] = text
+        if text.startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text)}]
+    return types.Update(update_id=update_id, message=message)
+
+
+def _compare_load(results, baseline, max_regression):
+    """Печатает изменения относительно сохраненного прогона; Returns True, если есть регрессия"""
+    regressed = False
+    print(f"\nСравнение с {baseline['started_at']} (допустимое ухудшение {max_regression:.0%}):")
+    rows = [('всего', results['total'], baseline['total'])] + [
+        (command, stats, baseline['commands'][command])
+        for command, stats in results['commands'].items() if command in baseline['commands']
+    ]
+    for title, current, previous in rows:
+        changes = []
+        for key in ('p50', 'p95', 'p99'):
+            change = current[key] / previous[key] - 1 if previous[key] else 0.0
+            mark = ''
+            if key == 'p95' and change > max_regression:
+                mark, regressed = ' ⚠️', True
+            changes.append(f"{key} {previous[key] * 1000:.1f}→{current[key] * 1000:.1f}ms ({change:+.0%}){mark}")
+        print(f"  {title:8} " + ", ".join(changes))
+    change = results['throughput'] / baseline['throughput'] - 1
+    if change < -max_regression:
+        regressed = True
+    print(f"  пропускная способность {baseline['throughput']:.0f}→{results['throughput']:.0f} обновлений/с "
+          f"({change:+.0%}){' ⚠️' if change < -max_regression else ''}")
+    return regressed
+
+
+def bench_load(args):
+    """
+    Нагрузочный прогон обработчиков bot.py: синтетические обновления идут через
+    dp.process_update, бот отвечает локальному серверу Bot API. Пользователи работают
+    параллельно, обновления одного чата - по очереди (как в UpdateQueue).
+    Ограничение частоты не подключается: измеряются обработчики и база.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, 'tools.db')
+        print(f"Генерация данных: {args.tools} инструментов, {args.loans} выдач...")
+        generate_catalog(db_path, args.tools, args.loans)
+
+        # bot.py импортируется после выбора базы: его хранилища открывают db.DB_PATH
+        import bot as bot_module
+        from aiogram.bot.api import TelegramAPIServer
+
+        # Журнал каждого обновления исказил бы замер
+        logging.disable(logging.INFO)
+
+        dispatcher = bot_module.dp
+        dispatcher.middleware.setup(bot_module.FirstUpdateMiddleware())
+        bot_module.register_handlers(dispatcher)
+
+        latencies = {}
+        errors = []
+        update_ids = iter(range(1, 10 ** 9))
+
+        async def replay(user_id, steps):
+            for command, text in steps:
+                if callable(text):
+                    text = text()
+                update = _load_update(next(update_ids), user_id, text)
+                started = time.perf_counter()
+                try:
+                    # Каждое обновление - в своей задаче, как в UpdateQueue: aiogram хранит
+                    # текущий чат и пользователя в contextvars
+                    await asyncio.create_task(dispatcher.process_update(update))
+                except Exception as e:
+                    errors.append(f"{command}: {e}")
+                latencies.setdefault(command, []).append(time.perf_counter() - started)
+
+        async def run():
+            api = _StubBotAPI(args.api_latency)
+            await api.start()
+            bot_module.bot.server = TelegramAPIServer.from_base(api.url)
+            await bot_module.start_database()
+            await bot_module.warm_caches()
+            try:
+                users = [
+                    replay(10000 + user, _load_scenario(user, args.tools) * args.rounds)
+                    for user in range(args.users)
+                ]
+                admin = replay(bot_module.ADMIN_ID, [('/report', '/report'), ('/overdue', '/overdue')] * args.rounds)
+                started = time.perf_counter()
+                await asyncio.gather(admin, *users)
+                elapsed = time.perf_counter() - started
+            finally:
+                await bot_module.storage.close()
+                await bot_module.storage.wait_closed()
+                await (await bot_module.bot.get_session()).close()
+                await api.close()
+            return elapsed, api.calls
+
+        elapsed, calls = asyncio.run(run())
+        bot_module.repo.close()
+        db.close_write_queue()
+        db.close_pool()
+
+    def summary(values):
+        return {'n': len(values), 'p50': percentile(values, 50), 'p95': percentile(values, 95),
+                'p99': percentile(values, 99), 'max': max(values, default=0.0)}
+
+    all_latencies = [value for values in latencies.values() for value in values]
+    results = {
+        'benchmark': 'load',
+        'started_at': datetime.now().isoformat(timespec='seconds'),
+        'params': {'tools': args.tools, 'loans': args.loans, 'users': args.users,
+                   'rounds': args.rounds, 'api_latency': args.api_latency},
+        'elapsed': elapsed,
+        'throughput': len(all_latencies) / elapsed,
+        'errors': len(errors),
+        'api_calls': calls,
+        'total': summary(all_latencies),
+        'commands': {command: summary(values) for command, values in sorted(latencies.items())},
+    }
+
+    print(f"\nПользователей: {args.users}, повторов сценария: {args.rounds}, "
+          f"задержка Bot API {args.api_latency * 1000:.0f}мс")
+    print(f"Обновлений: {len(all_latencies)} за {elapsed:.2f}с - {results['throughput']:.0f} обновлений/с, "
+          f"вызовов Bot API: {sum(calls.values())}, ошибок: {len(errors)}")
+    for command, values in sorted(latencies.items()):
+        print("  " + format_latencies(f"{command:8}", values))
+    for error in errors[:5]:
+        print(f"  ошибка {error}")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"Результаты сохранены в {args.output}")
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        if _compare_load(results, baseline, args.max_regression):
+            sys.exit(1)
+
+
+def _free_port_range(count):
+    """Начало диапазона из count свободных локальных портов"""
+    import socket
+
+    rnd = random.Random()
+    while True:
+        base = rnd.randrange(20000, 60000 - count)
+        sockets = []
+        try:
+            for port in range(base, base + count):
+                sock = socket.socket()
+                sockets.append(sock)
+                sock.bind(('127.0.0.1', port))
+            return base
+        except OSError:
+            continue
+        finally:
+            for sock in sockets:
+                sock.close()
+
+
+def bench_cluster(args):
+    """
+    Пропускная способность вебхука в зависимости от числа процессов: настоящий
+    `python bot.py` с WEB_WORKERS=1 и WEB_WORKERS=N принимает синтетические /list
+    по HTTP и отвечает локальному серверу Bot API. Обновление считается обработанным,
+    когда его ответ дошел до Bot API (каждый /list, в том числе отклоненный
+    ограничением частоты, - ровно один sendMessage).
+    """
+    import shutil
+    import aiohttp
+    from config import WEBHOOK_PATH
+
+    secret = 'benchmark-secret'
+    per_user = 5    # меньше запаса ограничителя частоты 'message'
+    users = max(1, args.updates // per_user)
+    total = users * per_user
+    worker_counts = sorted({1, args.workers})
+
+    async def run(workers, source_db, tmp):
+        data_dir = os.path.join(tmp, f'workers-{workers}')
+        os.makedirs(data_dir)
+        shutil.copy(source_db, os.path.join(data_dir, 'tools.db'))
+
+        api = _StubBotAPI(args.api_latency)
+        await api.start()
+        port = _free_port_range(1)
+        env = dict(
+            os.environ, WEB_WORKERS=str(workers), PORT=str(port), DATA_DIR=data_dir,
+            BOT_API_URL=api.url, WEBHOOK_SECRET=secret, LOG_LEVEL='WARNING',
+            CLUSTER_BASE_PORT=str(_free_port_range(workers)),
+        )
+        env.pop('CLUSTER_WORKER_ID', None)
+        process = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bot.py')],
+                                   env=env)
+        base_url = f'http://127.0.0.1:{port}'
+        try:
+            async with aiohttp.ClientSession() as session:
+                deadline = time.monotonic() + 120
+                while True:
+                    if process.poll() is not None or time.monotonic() > deadline:
+                        raise RuntimeError(f"бот не запустился (WEB_WORKERS={workers})")
+                    try:
+                        async with session.get(base_url + '/health') as response:
+                            if response.status == 200:
+                                break
+                    except aiohttp.ClientError:
+                        pass
+                    await asyncio.sleep(0.2)
+
+                api.calls.clear()
+                update_ids = iter(range(1, total + 1))
+                limit = asyncio.Semaphore(64)
+
+                async def send(user_id):
+                    # Обновления одного чата - по очереди, как их отправляет Telegram
+                    for _ in range(per_user):
+                        update = _load_update(next(update_ids), user_id, '/list')
+                        async with limit:
+                            async with session.post(
+                                base_url + WEBHOOK_PATH, data=json.dumps(update.to_python()),
+                                headers={'Content-Type': 'application/json',
+                                         'X-Telegram-Bot-Api-Secret-Token': secret}
+                            ) as response:
+                                if response.status != 200:
+                                    raise RuntimeError(f"вебхук ответил {response.status}")
+
+                started = time.perf_counter()
+                await asyncio.gather(*(send(20000 + user) for user in range(users)))
+                accepted = time.perf_counter() - started
+                while api.calls.get('sendMessage', 0) < total:
+                    if time.perf_counter() - started > 300:
+                        raise RuntimeError(f"обработано {api.calls.get('sendMessage', 0)} из {total}")
+                    await asyncio.sleep(0.01)
+                return accepted, time.perf_counter() - started
+        finally:
+            process.terminate()
+            await asyncio.get_running_loop().run_in_executor(None, process.wait)
+            await api.close()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        source_db = os.path.join(tmp, 'tools.db')
+        print(f"Генерация данных: {args.tools} инструментов, {args.loans} выдач...")
+        generate_catalog(source_db, args.tools, args.loans)
+
+        results = {}
+        for workers in worker_counts:
+            results[workers] = asyncio.run(run(workers, source_db, tmp))
+
+    print(f"\nОбновлений: {total} от {users} чатов, задержка Bot API {args.api_latency * 1000:.0f}мс, "
+          f"ядер: {os.cpu_count()}")
+    baseline = total / results[1][1]
+    for workers, (accepted, elapsed) in results.items():
+        rate = total / elapsed
+        print(f"  WEB_WORKERS={workers}: {rate:.0f} обновлений/с (прием {total / accepted:.0f}/с), "
+              f"x{rate / baseline:.2f} к одному процессу")
+
+
+def bench_logging(args):
+    """
+    Цена логирования на обновление в цикле событий: прежняя схема (запись в поток
+    вывода в вызывающем потоке, f-строки со списком инструментов) против очереди
+    log_setup с отложенным форматированием и выборочной записью обновлений.
+    """
+    import log_setup
+
+    tools = [(i, f'Инструмент {i}', 'available', 1) for i in range(args.tools)]
+    updates = args.updates
+
+    def measure(runtime_handlers, log_update, log_tools):
+        bench_logger = logging.getLogger('benchmark.logging')
+        bench_logger.propagate = False
+        bench_logger.setLevel(logging.INFO)
+        for handler in runtime_handlers:
+            bench_logger.addHandler(handler)
+        try:
+            timings = []
+            for update_id in range(updates):
+                started = time.perf_counter()
+                log_update(bench_logger, update_id)
+                log_tools(bench_logger)
+                timings.append(time.perf_counter() - started)
+            return timings
+        finally:
+            for handler in runtime_handlers:
+                bench_logger.removeHandler(handler)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        with open(os.path.join(tmp, 'before.log'), 'w', encoding='utf-8') as before_file:
+            output = logging.StreamHandler(before_file)
+            output.setFormatter(logging.Formatter(log_setup.LOG_FORMAT))
+
+            def eager_update(bench_logger, update_id):
+                bench_logger.info(f"Received message [ID:{update_id}] in chat [private:{update_id % 50}]")
+
+            def eager_tools(bench_logger):
+                bench_logger.info(f"DEBUG: Получено {len(tools)} инструментов: {tools}")
+
+            before = measure([output], eager_update, eager_tools)
+
+        with open(os.path.join(tmp, 'after.log'), 'w', encoding='utf-8') as after_file:
+            output = logging.StreamHandler(after_file)
+            output.setFormatter(logging.Formatter(log_setup.LOG_FORMAT))
+            runtime = log_setup.LoggingRuntime([output], sample_rates={'benchmark.logging': args.sample})
+            sampling = runtime.filters['benchmark.logging']
+            runtime.queue_handler.addFilter(sampling)
+            runtime.start()
+
+            def lazy_update(bench_logger, update_id):
+                bench_logger.info("Сообщение %s в чате %s", update_id, update_id % 50)
+
+            def lazy_tools(bench_logger):
+                bench_logger.debug("Получено инструментов: %s", len(tools))
+
+            after = measure([runtime.queue_handler], lazy_update, lazy_tools)
+            drain_started = time.perf_counter()
+            runtime.stop()
+            drain = time.perf_counter() - drain_started
+            stats = runtime.get_stats()
+
+    print(f"Обновлений: {updates}, инструментов в списке: {len(tools)}")
+    print("до (поток вывода в цикле событий, f-строки):")
+    print("  " + format_latencies('на обновление', before))
+    print(f"после (очередь, отложенное форматирование, доля записей {args.sample}):")
+    print("  " + format_latencies('на обновление', after))
+    print(f"  поток вывода дописал очередь за {drain * 1000:.1f}мс, "
+          f"отброшено выборкой: {stats['sampled_out']}, при переполнении: {stats['dropped']}")
+
+
+BENCHMARKS = {
+    'webhook-latency': bench_webhook_latency,
+    'write-contention': bench_write_contention,
+    'stock': bench_stock,
+    'search': bench_search,
+    'import': bench_import,
+    'cold-start': bench_cold_start,
+    'fsm': bench_fsm,
+    'throttling': bench_throttling,
+    'ingestion': bench_ingestion,
+    'dedup': bench_dedup,
+    'notifications': bench_notifications,
+    'report': bench_report,
+    'history': bench_history,
+    'overdue': bench_overdue,
+    'media': bench_media,
+    'logging': bench_logging,
+    'cluster': bench_cluster,
+    'load': bench_load,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарки бота")
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS))
+    parser.add_argument('--tools', type=int, default=2000)
+    parser.add_argument('--loans', type=int, default=100000)
+    parser.add_argument('--updates', type=int, default=200)
+    parser.add_argument('--interval', type=float, default=0.002,
+                        help="интервал между обновлениями, секунды")
+    parser.add_argument('--catalog', type=int, default=100000,
+                        help="размер синтетического каталога для поиска")
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--operations', type=int, default=50,
+                        help="операций на поток")
+    parser.add_argument('--units', type=int, default=100,
+                        help="единиц инструмента, за которые идет конкуренция (stock)")
+    parser.add_argument('--users', type=int, default=50,
+                        help="сколько пользователей одновременно работает с ботом (load)")
+    parser.add_argument('--rounds', type=int, default=3,
+                        help="сколько раз каждый пользователь проходит сценарий (load)")
+    parser.add_argument('--api-latency', type=float, default=0.0,
+                        help="задержка ответа локального Bot API, секунды (load)")
+    parser.add_argument('--workers', type=int, default=min(4, os.cpu_count() or 1),
+                        help="число процессов, сравниваемое с одним (cluster)")
+    parser.add_argument('--sample', type=float, default=1.0,
+                        help="доля записываемых записей об обновлениях (logging)")
+    parser.add_argument('--output', help="сохранить результаты в JSON (load)")
+    parser.add_argument('--baseline', help="сравнить с сохраненными результатами (load)")
+    parser.add_argument('--max-regression', type=float, default=0.2,
+                        help="допустимое ухудшение p95 и пропускной способности при сравнении (load)")
+    args = parser.parse_args()
+    BENCHMARKS[args.benchmark](args)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,24 +1,44 @@
+import time
+
+# Момент запуска: от него считается время до первого обработанного обновления
+PROCESS_STARTED = time.perf_counter()
+
+import asyncio
 import logging
+from contextlib import contextmanager
 from aiogram import Bot, Dispatcher, types
 from aiogram.utils import executor
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
-from aiogram.contrib.middlewares.logging import LoggingMiddleware
-from aiogram.contrib.fsm_storage.memory import MemoryStorage
+from aiogram.bot.api import TelegramAPIServer, TELEGRAM_PRODUCTION
+from aiogram.dispatcher.middlewares import BaseMiddleware
 from aiogram.dispatcher import FSMContext
 from aiogram.dispatcher.filters.state import State, StatesGroup
 from db import (
-    get_tools, get_issued_tools, create_tool_request, 
+    get_issued_tools, create_tool_request,
     approve_issue_request, get_issue_request_info, get_tool_by_id,
     get_issued_tool_by_id, update_tool_status, add_tool_history,
     get_tool_history, get_overdue_tools, get_all_issue_requests,
-    create_tables, get_return_info, complete_return, DatabaseConnection
+    get_return_info, complete_return, close_pool,
+    close_write_queue, get_pool, get_write_queue, inventory, sync_inventory,
+    get_webhook_secret, INVENTORY_SYNC_INTERVAL
 )
-from config import API_TOKEN, WEBHOOK_HOST, WEBHOOK_PATH, WEBAPP_HOST, WEBAPP_PORT
+from async_db import repo
+from fsm_storage import SQLiteStorage
+from throttling import ThrottlingMiddleware
+from ingestion import UpdateDeduplicator, UpdateQueue
+from notifications import NotificationSender, NOTIFY_CHAT_RATE, NOTIFY_GLOBAL_RATE
+from history_archive import HistoryArchiver
+from overdue import OverdueScheduler
+from media import CatalogImages, PhotoDownloader
+import metrics
+import log_setup
+import cluster
+from query_profiler import profiler as query_profiler
+from config import API_TOKEN, WEBHOOK_HOST, WEBHOOK_PATH, WEBAPP_HOST, WEBAPP_PORT, WEBHOOK_SECRET, BOT_API_URL
 from datetime import datetime
 import os
 from aiohttp import web
-from populate_database import populate_database
-import time
+from populate_database import seed_database
 from aiogram.dispatcher.filters import Text
 from datetime import timedelta
 
@@ -26,47 +46,61 @@ from datetime import timedelta
 TOKEN = API_TOKEN
 ADMIN_ID = 1495719377  # ID администратора
 
-# Инициализация хранилища состояний
-storage = MemoryStorage()
+# Сколько живет незавершенный диалог без активности, секунды (остальные - FSM_STATE_TTL)
+STATE_TTL = {
+    'SearchState': 15 * 60,
+    'ToolIssueState': 60 * 60,
+    'ToolReturnState': 6 * 60 * 60,
+}
 
-# Инициализация бота и диспетчера
-bot = Bot(token=TOKEN)
+# Инициализация хранилища состояний: переживает перезапуск, брошенные диалоги истекают
+storage = SQLiteStorage(state_ttl=STATE_TTL)
+
+# Инициализация бота и диспетчера; запросы к Bot API замеряются для /metrics
+bot = metrics.InstrumentedBot(
+    token=TOKEN,
+    server=TelegramAPIServer.from_base(BOT_API_URL) if BOT_API_URL else TELEGRAM_PRODUCTION
+)
 dp = Dispatcher(bot, storage=storage)
 
+# Фоновая отправка уведомлений админу; ограничения Telegram общие для всех процессов-обработчиков
+notifier = NotificationSender(
+    bot,
+    chat_rate=NOTIFY_CHAT_RATE / cluster.worker_count(),
+    global_rate=NOTIFY_GLOBAL_RATE / cluster.worker_count()
+)
+
+# Напоминания сотрудникам и админу о наступивших сроках возврата
+overdue_scheduler = OverdueScheduler(notifier, ADMIN_ID)
+
+# Перенос старой истории операций в помесячные архивы
+history_archiver = HistoryArchiver()
+
+# Фото возврата - в хранилище; картинки каталога - по file_id после первой загрузки
+photo_downloader = PhotoDownloader(bot)
+catalog_images = CatalogImages(bot)
+
 # Устанавливаем экземпляр бота как текущий
 Bot.set_current(bot)
 Dispatcher.set_current(dp)
 
-# Настройка логирования
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
+# Логирование настраивается в main() / wsgi.py (log_setup.setup_logging), не при импорте
 logger = logging.getLogger(__name__)
 
+# Входящие сообщения и нажатия кнопок; доля записей настраивается через LOG_SAMPLE=bot.updates=...
+update_logger = logging.getLogger('bot.updates')
+
+class UpdateLoggingMiddleware(BaseMiddleware):
+    """Пишет входящие сообщения и нажатия кнопок; текст записи собирается, только если она будет выведена"""
+
+    async def on_pre_process_message(self, message: types.Message, data: dict):
+        update_logger.info("Сообщение %s в чате %s от %s", message.message_id, message.chat.id, message.from_user.id)
+
+    async def on_pre_process_callback_query(self, callback_query: types.CallbackQuery, data: dict):
+        update_logger.info("Кнопка %s от %s", callback_query.data, callback_query.from_user.id)
+
 # Регистрируем логирование
-dp.middleware.setup(LoggingMiddleware())
-
-# Проверяем содержимое базы данных при запуске
-logger.info("Проверка базы данных при запуске...")
-tools = get_tools()
-logger.info(f"Количество инструментов в базе: {len(tools)}")
-if tools:
-    logger.info("Примеры инструментов:")
-    for tool in tools[:5]:  # Показываем первые 5 инструментов
-        logger.info(f"- {tool}")
-else:
-    logger.info("База данных пуста, заполняем начальными данными...")
-    populate_database()
-    tools = get_tools()
-    logger.info(f"После заполнения в базе {len(tools)} инструментов")
-    if tools:
-        logger.info("Примеры добавленных инструментов:")
-        for tool in tools[:5]:
-            logger.info(f"- {tool}")
-
-# Создание таблиц
-create_tables()
+dp.middleware.setup(UpdateLoggingMiddleware())
 
 # Состояния для возврата
 class ToolReturnState(StatesGroup):
@@ -89,27 +123,25 @@ class ReturnToolStates(StatesGroup):
 # Количество инструментов на странице
 TOOLS_PER_PAGE = 10
 
-# Словарь для отслеживания последних callback-запросов
-_last_callback_time = {}
-
-async def throttle_callback(callback_query: types.CallbackQuery) -> bool:
-    """
-    Проверяет, не слишком ли часто отправляются callback-запросы.
-    Возвращает True, если запрос нужно обработать, False если его нужно пропустить.
-    """
-    user_id = callback_query.from_user.id
-    current_time = time.time()
-    
-    # Проверяем время последнего запроса
-    if user_id in _last_callback_time:
-        last_time = _last_callback_time[user_id]
-        if current_time - last_time < 1:  # Минимальный интервал между запросами - 1 секунда
-            await callback_query.answer("Пожалуйста, не нажимайте кнопки так часто", show_alert=True)
-            return False
-            
-    # Обновляем время последнего запроса
-    _last_callback_time[user_id] = current_time
-    return True
+# Количество операций на странице истории
+HISTORY_PER_PAGE = 20
+
+# Максимальное количество результатов поиска в одном сообщении
+SEARCH_RESULTS_LIMIT = 20
+
+# Ограничение частоты на пользователя: правило -> (маркеров в секунду, запас).
+# 'message' и 'callback' - для команд и кнопок без отдельного правила.
+THROTTLE_RULES = {
+    'message': (1, 10),
+    'callback': (1, 2),
+    '/report': (0.1, 2),
+    '/history': (0.2, 3),
+    'list': (1, 3),
+    'history': (1, 3),
+}
+
+# Ограничение частоты сообщений и нажатий кнопок (подключается в build_app)
+throttling = ThrottlingMiddleware(THROTTLE_RULES)
 
 # Состояния для выдачи инструмента
 class ToolIssueState(StatesGroup):
@@ -176,8 +208,10 @@ async def cmd_help(message: types.Message):
         help_text += (
             "Команды администратора:\n"
             "/history - История операций\n"
+            "/history <ID | сотрудник | ГГГГ-ММ | ГГГГ-ММ-ДД> - История инструмента, сотрудника или за период\n"
             "/report - Отчет по инструментам\n"
             "/overdue - Просроченные инструменты\n"
+            "/slowqueries [N | reset] - Самые затратные запросы к базе (при DB_PROFILE=1)\n"
         )
     
     await message.answer(help_text)
@@ -195,27 +229,25 @@ async def cancel_handler(message: types.Message, state: FSMContext):
     )
 
 # Список инструментов
-async def cmd_list(message: types.Message):
-    """Показать список всех инструментов"""
-    with DatabaseConnection() as db:
-        cursor = db.conn.cursor()
-        cursor.execute("""
-            SELECT t.id, t.name, t.quantity,
-                   COALESCE(COUNT(CASE WHEN it.return_date IS NULL THEN 1 END), 0) as issued_count
-            FROM tools t
-            LEFT JOIN issued_tools it ON t.id = it.tool_id
-            GROUP BY t.id, t.name, t.quantity
-            ORDER BY t.name
-        """)
-        tools = cursor.fetchall()
-    
-    if not tools:
-        await message.answer(
-            "❌ Список инструментов пуст.",
-            reply_markup=types.ReplyKeyboardRemove()
-        )
-        return
-    
+def page_keyboard(prefix: str, rows, has_prev: bool, has_next: bool):
+    """Кнопки перехода по страницам; в callback передается ID первой/последней строки"""
+    buttons = []
+    if has_prev:
+        buttons.append(InlineKeyboardButton("⬅️ Назад", callback_data=f"{prefix}:prev:{rows[0][0]}"))
+    if has_next:
+        buttons.append(InlineKeyboardButton("Вперед ➡️", callback_data=f"{prefix}:next:{rows[-1][0]}"))
+    if not buttons:
+        return None
+    return InlineKeyboardMarkup().row(*buttons)
+
+def parse_page_callback(data: str):
+    """Разбирает callback_data кнопки страницы: возвращает (after_id, before_id)"""
+    _, direction, row_id = data.split(':')
+    if direction == 'next':
+        return int(row_id), None
+    return None, int(row_id)
+
+def format_tools_page(tools):
     result = "📋 *Список всех инструментов:*\n\n"
     for tool_id, name, total_qty, issued_qty in tools:
         available_qty = total_qty - issued_qty
@@ -224,17 +256,46 @@ async def cmd_list(message: types.Message):
         result += f"{status} *{name}*\n"
         result += f"┌ ID: {tool_id}\n"
         result += f"└ Доступно: {available_qty} из {total_qty}\n\n"
+    return result
+
+async def cmd_list(message: types.Message):
+    """Показать список всех инструментов (первая страница)"""
+    tools, has_prev, has_next = await repo.get_tools_page(limit=TOOLS_PER_PAGE)
     
-    keyboard = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    keyboard.add(types.KeyboardButton('/issue'), types.KeyboardButton('/return'))
-    keyboard.add(types.KeyboardButton('/search'), types.KeyboardButton('/help'))
+    if not tools:
+        await message.answer(
+            "❌ Список инструментов пуст.",
+            reply_markup=types.ReplyKeyboardRemove()
+        )
+        return
+    
+    keyboard = page_keyboard('list', tools, has_prev, has_next)
+    if keyboard is None:
+        keyboard = types.ReplyKeyboardMarkup(resize_keyboard=True)
+        keyboard.add(types.KeyboardButton('/issue'), types.KeyboardButton('/return'))
+        keyboard.add(types.KeyboardButton('/search'), types.KeyboardButton('/help'))
     
     await message.answer(
-        result,
+        format_tools_page(tools),
         reply_markup=keyboard,
         parse_mode="Markdown"
     )
 
+async def process_list_page(callback_query: types.CallbackQuery):
+    """Переход по страницам списка инструментов"""
+    after_id, before_id = parse_page_callback(callback_query.data)
+    tools, has_prev, has_next = await repo.get_tools_page(after_id, before_id, TOOLS_PER_PAGE)
+    if not tools:
+        await callback_query.answer("Список инструментов пуст")
+        return
+    
+    await callback_query.message.edit_text(
+        format_tools_page(tools),
+        reply_markup=page_keyboard('list', tools, has_prev, has_next),
+        parse_mode="Markdown"
+    )
+    await callback_query.answer()
+
 # Выдача инструмента
 async def cmd_issue_start(message: types.Message):
     """Начало процесса выдачи инструмента"""
@@ -242,14 +303,7 @@ async def cmd_issue_start(message: types.Message):
     keyboard.add(types.KeyboardButton('/cancel'))
     
     # Получаем список доступных инструментов
-    with DatabaseConnection() as db:
-        cursor = db.conn.cursor()
-        cursor.execute("""
-            SELECT id, name, quantity 
-            FROM tools 
-            WHERE quantity > 0
-        """)
-        tools = cursor.fetchall()
+    tools = await repo.get_available_tools()
     
     if not tools:
         await message.answer(
@@ -274,21 +328,23 @@ async def process_tool_id(message: types.Message, state: FSMContext):
         await message.answer("❌ Пожалуйста, введите числовой ID инструмента.")
         return
     
-    with DatabaseConnection() as db:
-        cursor = db.conn.cursor()
-        cursor.execute(
-            "SELECT name, quantity FROM tools WHERE id = ?",
-            (tool_id,)
-        )
-        tool = cursor.fetchone()
+    # (id, name, available, quantity, description, image)
+    tool = await repo.get_tool_by_id(tool_id)
     
-    if not tool or tool[1] <= 0:
+    if not tool or tool[2] <= 0:
         await message.answer("❌ Инструмент не найден или недоступен.")
         return
     
-    await state.update_data(tool_id=tool_id, tool_name=tool[0])
+    if tool[5]:
+        try:
+            await catalog_images.send_photo(message.chat.id, tool[5], caption=tool[1])
+        except Exception as e:
+            # Без картинки выдача продолжается
+            logger.error(f"Ошибка при отправке картинки инструмента {tool_id}: {e}")
+    
+    await state.update_data(tool_id=tool_id, tool_name=tool[1])
     await message.answer(
-        f"👤 Вы выбрали: {tool[0]}\n"
+        f"👤 Вы выбрали: {tool[1]}\n"
         "Введите имя сотрудника:"
     )
     await ToolIssueState.waiting_for_employee_name.set()
@@ -363,58 +419,26 @@ async def process_issue_confirmation(message: types.Message, state: FSMContext):
     return_date = issue_date + timedelta(days=duration_days)
     
     try:
-        with DatabaseConnection() as db:
-            cursor = db.conn.cursor()
-            
-            # Проверяем доступность инструмента
-            cursor.execute(
-                "SELECT quantity FROM tools WHERE id = ?",
-                (tool_id,)
-            )
-            quantity = cursor.fetchone()[0]
-            
-            if quantity <= 0:
-                raise ValueError("Инструмент больше не доступен")
-            
-            # Обновляем количество
-            cursor.execute(
-                "UPDATE tools SET quantity = quantity - 1 WHERE id = ?",
-                (tool_id,)
-            )
-            
-            # Добавляем запись о выдаче
-            cursor.execute("""
-                INSERT INTO issued_tools 
-                (tool_id, employee_name, issue_date, expected_return_date)
-                VALUES (?, ?, ?, ?)
-            """, (tool_id, employee_name, issue_date, return_date))
-            
-            # Добавляем запись в историю
-            cursor.execute("""
-                INSERT INTO tool_history 
-                (tool_id, action, employee_name, timestamp)
-                VALUES (?, 'issued', ?, ?)
-            """, (tool_id, employee_name, issue_date))
-            
-            db.conn.commit()
-            
-            # Уведомляем админа
-            if ADMIN_ID:
-                await bot.send_message(
-                    ADMIN_ID,
-                    f"📢 Выдан инструмент:\n"
-                    f"🔧 {data['tool_name']}\n"
-                    f"👤 Сотрудник: {employee_name}\n"
-                    f"📅 Дата возврата: {return_date.strftime('%d.%m.%Y')}"
-                )
-            
-            await message.answer(
-                f"✅ Инструмент успешно выдан!\n\n"
+        await repo.issue_tool_for_period(tool_id, employee_name, issue_date, return_date, message.chat.id)
+        overdue_scheduler.track(return_date)
+        
+        # Уведомляем админа: отправка в фоне, пользователь не ждет ее
+        if ADMIN_ID:
+            notifier.notify(
+                ADMIN_ID,
+                f"📢 Выдан инструмент:\n"
                 f"🔧 {data['tool_name']}\n"
-                f"📅 Дата возврата: {return_date.strftime('%d.%m.%Y')}\n\n"
-                "Пожалуйста, верните инструмент вовремя.",
-                reply_markup=types.ReplyKeyboardRemove()
+                f"👤 Сотрудник: {employee_name}\n"
+                f"📅 Дата возврата: {return_date.strftime('%d.%m.%Y')}"
             )
+        
+        await message.answer(
+            f"✅ Инструмент успешно выдан!\n\n"
+            f"🔧 {data['tool_name']}\n"
+            f"📅 Дата возврата: {return_date.strftime('%d.%m.%Y')}\n\n"
+            "Пожалуйста, верните инструмент вовремя.",
+            reply_markup=types.ReplyKeyboardRemove()
+        )
             
     except Exception as e:
         logger.error(f"Error issuing tool: {e}")
@@ -433,16 +457,8 @@ async def cmd_return_start(message: types.Message):
     keyboard = types.ReplyKeyboardMarkup(resize_keyboard=True)
     keyboard.add(types.KeyboardButton('/cancel'))
     
-    # Получаем список выданных инструментов
-    with DatabaseConnection() as db:
-        cursor = db.conn.cursor()
-        cursor.execute("""
-            SELECT t.id, t.name, it.employee_name, it.issue_date 
-            FROM tools t
-            JOIN issued_tools it ON t.id = it.tool_id
-            WHERE it.return_date IS NULL
-        """)
-        tools = cursor.fetchall()
+    # Получаем список открытых выдач: у типа инструмента их может быть несколько
+    tools = await repo.get_tools_for_return()
     
     if not tools:
         await message.answer(
@@ -458,38 +474,32 @@ async def cmd_return_start(message: types.Message):
     
     await message.answer(
         f"🔧 Выданные инструменты:\n\n{tools_list}\n\n"
-        "Введите ID инструмента для возврата:",
+        "Введите ID выдачи для возврата:",
         reply_markup=keyboard
     )
     await ToolReturnState.waiting_for_tool_id.set()
 
 async def process_return_tool_id(message: types.Message, state: FSMContext):
-    """Обработка ID инструмента для возврата"""
+    """Обработка ID выдачи для возврата"""
     try:
-        tool_id = int(message.text)
+        issue_id = int(message.text)
     except ValueError:
-        await message.answer("❌ Пожалуйста, введите числовой ID инструмента.")
+        await message.answer("❌ Пожалуйста, введите числовой ID выдачи.")
         return
     
-    with DatabaseConnection() as db:
-        cursor = db.conn.cursor()
-        cursor.execute("""
-            SELECT t.name, it.employee_name, it.issue_date
-            FROM tools t
-            JOIN issued_tools it ON t.id = it.tool_id
-            WHERE t.id = ? AND it.return_date IS NULL
-        """, (tool_id,))
-        tool = cursor.fetchone()
-    
-    if not tool:
+    # (tool_name, tool_id, employee_name, issue_date)
+    issued = await repo.get_return_info(issue_id)
+    
+    if not issued:
         await message.answer(
-            "❌ Инструмент не найден или уже возвращен."
+            "❌ Выдача не найдена или инструмент уже возвращен."
         )
         return
     
-    await state.update_data(tool_id=tool_id, tool_name=tool[0])
+    tool_name = issued[0]
+    await state.update_data(issue_id=issue_id, tool_name=tool_name)
     await message.answer(
-        f"📸 Для возврата инструмента *{tool[0]}* отправьте его фотографию.\n\n"
+        f"📸 Для возврата инструмента *{tool_name}* отправьте его фотографию.\n\n"
         "Фото должно быть четким и показывать состояние инструмента.",
         parse_mode="Markdown"
     )
@@ -532,68 +542,41 @@ async def process_return_confirmation(message: types.Message, state: FSMContext)
         return
     
     data = await state.get_data()
-    tool_id = data['tool_id']
+    issue_id = data.get('issue_id')
     photo_id = data['photo_id']
+    if issue_id is None:
+        # Диалог начат до перехода на возврат по ID выдачи
+        await state.finish()
+        await message.answer(
+            "❌ Начните возврат заново: /return",
+            reply_markup=types.ReplyKeyboardRemove()
+        )
+        return
     
     try:
-        with DatabaseConnection() as db:
-            cursor = db.conn.cursor()
-            
-            # Получаем информацию о выдаче
-            cursor.execute("""
-                SELECT employee_name, issue_date 
-                FROM issued_tools 
-                WHERE tool_id = ? AND return_date IS NULL
-            """, (tool_id,))
-            issue_info = cursor.fetchone()
-            
-            if not issue_info:
-                raise ValueError("Инструмент уже возвращен")
-            
-            employee_name, issue_date = issue_info
-            return_date = datetime.now()
-            
-            # Обновляем запись о выдаче
-            cursor.execute("""
-                UPDATE issued_tools 
-                SET return_date = ?, return_photo = ?
-                WHERE tool_id = ? AND return_date IS NULL
-            """, (return_date, photo_id, tool_id))
-            
-            # Обновляем количество доступных инструментов
-            cursor.execute("""
-                UPDATE tools 
-                SET quantity = quantity + 1
-                WHERE id = ?
-            """, (tool_id,))
-            
-            # Добавляем запись в историю
-            cursor.execute("""
-                INSERT INTO tool_history 
-                (tool_id, action, employee_name, timestamp)
-                VALUES (?, 'returned', ?, ?)
-            """, (tool_id, employee_name, return_date))
-            
-            db.conn.commit()
-            
-            # Уведомляем админа
-            if ADMIN_ID:
-                await bot.send_photo(
-                    ADMIN_ID,
-                    photo_id,
-                    caption=f"📢 Возвращен инструмент:\n"
-                    f"🔧 {data['tool_name']}\n"
-                    f"👤 Сотрудник: {employee_name}\n"
-                    f"📅 Дата выдачи: {issue_date}\n"
-                    f"📅 Дата возврата: {return_date.strftime('%d.%m.%Y')}"
-                )
-            
-            await message.answer(
-                f"✅ Инструмент успешно возвращен!\n\n"
+        return_date = datetime.now()
+        employee_name, issue_date = await repo.return_tool_with_photo(issue_id, photo_id, return_date)
+        # Фото сохраняется в хранилище в фоне
+        photo_downloader.submit(photo_id)
+        
+        # Уведомляем админа: отправка в фоне, пользователь не ждет ее
+        if ADMIN_ID:
+            notifier.notify(
+                ADMIN_ID,
+                f"📢 Возвращен инструмент:\n"
                 f"🔧 {data['tool_name']}\n"
+                f"👤 Сотрудник: {employee_name}\n"
+                f"📅 Дата выдачи: {issue_date}\n"
                 f"📅 Дата возврата: {return_date.strftime('%d.%m.%Y')}",
-                reply_markup=types.ReplyKeyboardRemove()
+                photo=photo_id
             )
+        
+        await message.answer(
+            f"✅ Инструмент успешно возвращен!\n\n"
+            f"🔧 {data['tool_name']}\n"
+            f"📅 Дата возврата: {return_date.strftime('%d.%m.%Y')}",
+            reply_markup=types.ReplyKeyboardRemove()
+        )
             
     except Exception as e:
         logger.error(f"Error returning tool: {e}")
@@ -620,19 +603,10 @@ async def cmd_search_start(message: types.Message):
 
 async def process_search_query(message: types.Message, state: FSMContext):
     """Обработка поискового запроса"""
-    search_query = message.text.lower()
-    
-    with DatabaseConnection() as db:
-        cursor = db.conn.cursor()
-        cursor.execute("""
-            SELECT t.id, t.name, t.quantity,
-                   COALESCE(COUNT(CASE WHEN it.return_date IS NULL THEN 1 END), 0) as issued_count
-            FROM tools t
-            LEFT JOIN issued_tools it ON t.id = it.tool_id
-            WHERE LOWER(t.name) LIKE ?
-            GROUP BY t.id, t.name, t.quantity
-        """, (f"%{search_query}%",))
-        tools = cursor.fetchall()
+    search_query = message.text
+    
+    # Результаты уже отсортированы по релевантности
+    tools = await repo.search_tools(search_query, SEARCH_RESULTS_LIMIT)
     
     if not tools:
         await message.answer(
@@ -664,36 +638,84 @@ async def process_search_query(message: types.Message, state: FSMContext):
     await state.finish()
 
 # Админские команды
+def format_history_page(history):
+    result = "📜 *Последние операции:*\n\n"
+    for _, name, action, employee, timestamp in history:
+        action_emoji = "📥" if action == "issued" else "📤"
+        result += f"{action_emoji} *{name}*\n"
+        result += f"┌ Действие: {action}\n"
+        result += f"├ Сотрудник: {employee}\n"
+        result += f"└ Дата: {timestamp.split()[0]}\n\n"
+    return result
+
+def parse_history_filter(text: str) -> dict:
+    """Фильтр истории из аргумента /history: ID инструмента, месяц, день или имя сотрудника"""
+    text = text.strip()
+    if text.isdigit():
+        return {'tool_id': int(text)}
+    for pattern, step in (('%Y-%m-%d', 'day'), ('%Y-%m', 'month')):
+        try:
+            since = datetime.strptime(text, pattern)
+        except ValueError:
+            continue
+        if step == 'day':
+            until = since + timedelta(days=1)
+        else:
+            until = (since + timedelta(days=32)).replace(day=1)
+        return {'since': since.strftime('%Y-%m-%d'), 'until': until.strftime('%Y-%m-%d')}
+    return {'employee_name': text}
+
 async def cmd_history(message: types.Message):
     """Показать историю операций (только для админа)"""
     if not is_admin(message):
         await message.answer("⛔ У вас нет доступа к этой команде.")
         return
     
-    with DatabaseConnection() as db:
-        cursor = db.conn.cursor()
-        cursor.execute("""
-            SELECT t.name, th.action, th.employee_name, th.timestamp
-            FROM tool_history th
-            JOIN tools t ON th.tool_id = t.id
-            ORDER BY th.timestamp DESC
-            LIMIT 20
-        """)
-        history = cursor.fetchall()
+    args = message.get_args()
+    if args:
+        # Выборка по инструменту, сотруднику или периоду, в том числе из архивов
+        history = await repo.get_tool_history(**parse_history_filter(args), limit=HISTORY_PER_PAGE)
+        if not history:
+            await message.answer("📜 Операций не найдено.")
+            return
+        await message.answer(
+            format_history_page([
+                (None, name, action, employee, timestamp)
+                for name, action, timestamp, employee, _ in history
+            ]),
+            parse_mode="Markdown"
+        )
+        return
+    
+    history, has_prev, has_next = await repo.get_history_page(limit=HISTORY_PER_PAGE)
     
     if not history:
         await message.answer("📜 История операций пуста.")
         return
     
-    result = "📜 *Последние операции:*\n\n"
-    for name, action, employee, timestamp in history:
-        action_emoji = "📥" if action == "issued" else "📤"
-        result += f"{action_emoji} *{name}*\n"
-        result += f"┌ Действие: {action}\n"
-        result += f"├ Сотрудник: {employee}\n"
-        result += f"└ Дата: {timestamp.split()[0]}\n\n"
+    await message.answer(
+        format_history_page(history),
+        reply_markup=page_keyboard('history', history, has_prev, has_next),
+        parse_mode="Markdown"
+    )
+
+async def process_history_page(callback_query: types.CallbackQuery):
+    """Переход по страницам истории операций (только для админа)"""
+    if not is_admin(callback_query):
+        await callback_query.answer("⛔ У вас нет доступа к этой команде.", show_alert=True)
+        return
+    after_id, before_id = parse_page_callback(callback_query.data)
+    history, has_prev, has_next = await repo.get_history_page(after_id, before_id, HISTORY_PER_PAGE)
+    if not history:
+        await callback_query.answer("📜 История операций пуста.")
+        return
     
-    await message.answer(result, parse_mode="Markdown")
+    await callback_query.message.edit_text(
+        format_history_page(history),
+        reply_markup=page_keyboard('history', history, has_prev, has_next),
+        parse_mode="Markdown"
+    )
+    await callback_query.answer()
 
 async def cmd_report(message: types.Message):
     """Показать отчет по инструментам (только для админа)"""
@@ -701,39 +723,7 @@ async def cmd_report(message: types.Message):
         await message.answer("⛔ У вас нет доступа к этой команде.")
         return
     
-    with DatabaseConnection() as db:
-        cursor = db.conn.cursor()
-        
-        # Общая статистика
-        cursor.execute("""
-            SELECT 
-                COUNT(*) as total_tools,
-                SUM(quantity) as total_quantity,
-                (SELECT COUNT(*) FROM issued_tools WHERE return_date IS NULL) as issued_count
-            FROM tools
-        """)
-        stats = cursor.fetchone()
-        
-        # Топ выдаваемых инструментов
-        cursor.execute("""
-            SELECT t.name, COUNT(*) as issue_count
-            FROM issued_tools it
-            JOIN tools t ON it.tool_id = t.id
-            GROUP BY t.id, t.name
-            ORDER BY issue_count DESC
-            LIMIT 5
-        """)
-        top_tools = cursor.fetchall()
-        
-        # Просроченные инструменты
-        cursor.execute("""
-            SELECT t.name, it.employee_name, it.expected_return_date
-            FROM issued_tools it
-            JOIN tools t ON it.tool_id = t.id
-            WHERE it.return_date IS NULL 
-            AND it.expected_return_date < date('now')
-        """)
-        overdue = cursor.fetchall()
+    stats, top_tools, overdue, activity = await repo.get_report_stats()
     
     result = "📊 *Отчет по инструментам*\n\n"
     
@@ -743,6 +733,12 @@ async def cmd_report(message: types.Message):
     result += f"├ Общее количество: {stats[1]}\n"
     result += f"└ Сейчас выдано: {stats[2]}\n\n"
     
+    # Активность за период
+    result += "*Активность:*\n"
+    for days, (issued, returned) in activity.items():
+        result += f"• За {days} дней: выдано {issued}, возвращено {returned}\n"
+    result += "\n"
+    
     # Топ инструментов
     if top_tools:
         result += "*Самые популярные инструменты:*\n"
@@ -766,22 +762,7 @@ async def cmd_overdue(message: types.Message):
         await message.answer("⛔ У вас нет доступа к этой команде.")
         return
     
-    with DatabaseConnection() as db:
-        cursor = db.conn.cursor()
-        cursor.execute("""
-            SELECT 
-                t.name,
-                it.employee_name,
-                it.issue_date,
-                it.expected_return_date,
-                julianday('now') - julianday(it.expected_return_date) as days_overdue
-            FROM issued_tools it
-            JOIN tools t ON it.tool_id = t.id
-            WHERE it.return_date IS NULL 
-            AND it.expected_return_date < date('now')
-            ORDER BY days_overdue DESC
-        """)
-        overdue = cursor.fetchall()
+    overdue = await repo.get_overdue_report()
     
     if not overdue:
         await message.answer("✅ Нет просроченных инструментов.")
@@ -804,6 +785,44 @@ async def cmd_overdue(message: types.Message):
         parse_mode="Markdown"
     )
 
+# Сколько запросов показывает /slowqueries по умолчанию и сколько символов текста запроса
+SLOW_QUERIES_LIMIT = 10
+SLOW_QUERY_TEXT_LIMIT = 200
+
+async def cmd_slow_queries(message: types.Message):
+    """Самые затратные запросы к базе данных по данным профилирования (только для админа)"""
+    if not is_admin(message):
+        await message.answer("⛔ У вас нет доступа к этой команде.")
+        return
+    
+    if not query_profiler.enabled:
+        await message.answer("Профилирование запросов выключено (DB_PROFILE=1 включает его).")
+        return
+    
+    args = message.get_args().strip()
+    if args == 'reset':
+        query_profiler.reset()
+        await message.answer("🧹 Статистика запросов очищена.")
+        return
+    limit = int(args) if args.isdigit() else SLOW_QUERIES_LIMIT
+    
+    top = query_profiler.top(max(1, min(limit, 20)))
+    if not top:
+        await message.answer("Запросов пока не было.")
+        return
+    
+    stats = query_profiler.get_stats()
+    result = (f"🐢 Запросы по суммарному времени (всего {stats['queries']}, "
+              f"медленных {stats['slow_queries']}):\n\n")
+    for sql, count, total, average, longest, rows, slow in top:
+        if len(sql) > SLOW_QUERY_TEXT_LIMIT:
+            sql = sql[:SLOW_QUERY_TEXT_LIMIT] + '…'
+        result += (f"• {total * 1000:.0f} мс за {count} раз, среднее {average * 1000:.1f} мс, "
+                   f"макс. {longest * 1000:.1f} мс, строк {rows}, медленных {slow}\n{sql}\n\n")
+    
+    # Без Markdown: в тексте запросов встречаются * и _
+    await message.answer(result[:4096])
+
 # Регистрируем обработчики
 def register_handlers(dp: Dispatcher):
     """Регистрация всех обработчиков команд"""
@@ -811,6 +830,7 @@ def register_handlers(dp: Dispatcher):
     dp.register_message_handler(cmd_start, commands=['start'])
     dp.register_message_handler(cmd_help, commands=['help'])
     dp.register_message_handler(cmd_list, commands=['list'])
+    dp.register_callback_query_handler(process_list_page, Text(startswith='list:'))
     dp.register_message_handler(cancel_handler, commands=['cancel'], state='*')
     
     # Выдача инструмента
@@ -832,61 +852,242 @@ def register_handlers(dp: Dispatcher):
     
     # Админские команды
     dp.register_message_handler(cmd_history, commands=['history'])
+    dp.register_callback_query_handler(process_history_page, Text(startswith='history:'))
     dp.register_message_handler(cmd_report, commands=['report'])
     dp.register_message_handler(cmd_overdue, commands=['overdue'])
+    dp.register_message_handler(cmd_slow_queries, commands=['slowqueries'])
+    
+    # Время и ошибки каждого обработчика - в /metrics
+    metrics.instrument_handlers(dp)
+
+# Очередь входящих обновлений: вебхук отвечает сразу, обработка идет в фоне
+update_dedup = UpdateDeduplicator(
+    meta_key=UpdateDeduplicator.META_KEY if cluster.is_leader()
+    else f'{UpdateDeduplicator.META_KEY}:{cluster.worker_id()}'
+)
+updates_queue = UpdateQueue(dp.process_update, dedup=update_dedup)
+
+# Секрет вебхука: WEBHOOK_SECRET из окружения или общий для всех процессов из базы (см. start_database)
+webhook_secret = WEBHOOK_SECRET or None
 
 async def handle_webhook(request):
-    """Обработчик вебхука от Telegram"""
-    if request.match_info.get('token') != API_TOKEN:
+    """Обработчик вебхука от Telegram: ставит обновление в очередь и сразу отвечает"""
+    if request.headers.get('X-Telegram-Bot-Api-Secret-Token') != webhook_secret:
         return web.Response(status=403)
     
     try:
         data = await request.json()
         update = types.Update(**data)
-        await dp.process_update(update)
-        return web.Response(status=200)
     except Exception as e:
-        logger.error(f"Ошибка при обработке вебхука: {e}")
-        return web.Response(status=500)
+        logger.error(f"Некорректное обновление в вебхуке: {e}")
+        return web.Response(status=400)
+    
+    # Очередь переполнена: Telegram повторит доставку позже
+    if not await updates_queue.submit(update):
+        return web.Response(status=503)
+    return web.Response(status=200)
 
 async def health_check(request):
     """Эндпоинт для проверки работоспособности"""
     return web.Response(text="OK", status=200)
 
+async def metrics_endpoint(request):
+    """Метрики в текстовом формате Prometheus"""
+    if not metrics.is_authorized(request):
+        return web.Response(status=401)
+    return web.Response(body=metrics.registry.render().encode('utf-8'),
+                        headers={'Content-Type': metrics.CONTENT_TYPE})
+
+def register_metrics():
+    """Показатели компонентов для /metrics: собираются только при запросе метрик"""
+    for component, get_stats in (
+        ('updates_queue', updates_queue.get_stats),
+        ('update_dedup', update_dedup.get_stats),
+        ('notifications', notifier.get_stats),
+        ('fsm_storage', storage.get_stats),
+        ('throttling', throttling.get_stats),
+        ('inventory_cache', inventory.get_stats),
+        ('overdue', overdue_scheduler.get_stats),
+        ('photo_downloader', photo_downloader.get_stats),
+        ('catalog_images', catalog_images.get_stats),
+        ('db_pool', lambda: get_pool().get_stats()),
+        ('db_write_queue', lambda: get_write_queue().get_stats()),
+        ('query_profiler', query_profiler.get_stats),
+        ('logging', log_setup.get_stats),
+    ):
+        metrics.registry.register_stats(component, get_stats)
+    metrics.registry.register_collector(lambda: [(
+        'bot_fsm_states', 'gauge', 'Диалоги в каждом состоянии FSM',
+        [({'state': state}, count) for state, count in sorted(storage.state_counts().items())]
+    )])
+
 # Инициализация и запуск
+
+# Длительность фаз запуска в секундах, в порядке выполнения
+STARTUP_TIMINGS = {}
+
+@contextmanager
+def startup_phase(name: str):
+    """Замеряет фазу запуска и пишет ее длительность в лог"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        STARTUP_TIMINGS[name] = time.perf_counter() - started
+        logger.info(f"Запуск: {name} - {STARTUP_TIMINGS[name] * 1000:.1f} мс")
+
+class FirstUpdateMiddleware(BaseMiddleware):
+    """Фиксирует время от запуска процесса до первого обработанного обновления"""
+
+    def __init__(self):
+        super().__init__()
+        self.first_update_at = None
+
+    def _mark(self):
+        if self.first_update_at is None:
+            self.first_update_at = time.perf_counter() - PROCESS_STARTED
+            STARTUP_TIMINGS['first_update'] = self.first_update_at
+            logger.info(f"Первое обновление обработано через {self.first_update_at:.3f} с после запуска")
+
+    # dp.process_update (вебхук) вызывает только события конкретного типа обновления
+    async def on_post_process_message(self, message: types.Message, results, data: dict):
+        self._mark()
+
+    async def on_post_process_callback_query(self, callback_query: types.CallbackQuery, results, data: dict):
+        self._mark()
+
+def build_app() -> web.Application:
+    """Собирает приложение: обработчики и маршруты. Не обращается к базе данных и сети."""
+    with startup_phase('build_app'):
+        dp.middleware.setup(FirstUpdateMiddleware())
+        dp.middleware.setup(throttling)
+        register_handlers(dp)
+        
+        app = web.Application()
+        app.router.add_post(WEBHOOK_PATH, handle_webhook)
+        app.router.add_get("/health", health_check)
+        app.router.add_get("/metrics", metrics_endpoint)
+        register_metrics()
+        metrics.log_exposure()
+        
+        app.on_startup.append(on_startup)
+        app.on_shutdown.append(on_shutdown)
+    return app
+
+async def start_database():
+    """Открывает пул, применяет миграции и начальные данные, загружает состояния диалогов и границу обработанных обновлений"""
+    global webhook_secret
+    with startup_phase('open_pool'):
+        await repo.run(get_pool().prefill)
+    with startup_phase('migrate_and_seed'):
+        # При актуальных версиях схемы и данных - несколько запросов без записи
+        await repo.run(seed_database)
+    if webhook_secret is None:
+        webhook_secret = await repo.run(get_webhook_secret)
+    with startup_phase('fsm_storage'):
+        await storage.start()
+    with startup_phase('update_dedup'):
+        await update_dedup.start()
+
+async def warm_caches():
+    """Прогревает кэш наличия и поисковый индекс"""
+    with startup_phase('warm_caches'):
+        await repo.run(inventory.warm)
+
+async def sync_inventory_forever():
+    """Подхватывает изменения наличия, сделанные другими процессами (импорт каталога, другие обработчики)"""
+    while True:
+        await asyncio.sleep(INVENTORY_SYNC_INTERVAL)
+        try:
+            await repo.run(sync_inventory)
+        except Exception as e:
+            logger.error(f"Ошибка при проверке изменений наличия: {e}")
+
 async def on_startup(app):
     """Действия при запуске бота"""
-    # Создаем таблицы в БД
-    create_tables()
+    await start_database()
+    
+    # Кэш прогревается в фоне: сервер начинает принимать обновления сразу,
+    # а обработчики, которым нужен кэш, дождутся этой же загрузки
+    app['warm_caches'] = asyncio.create_task(warm_caches())
+    
+    updates_queue.start()
+    notifier.start()
+    # Расписание сроков и недокачанные фото из базы загружает только ведущий процесс-обработчик,
+    # остальные следят лишь за своими выдачами и возвратами
+    overdue_scheduler.start(track_only=not cluster.is_leader())
+    photo_downloader.start(load_backlog=cluster.is_leader())
+    app['inventory_sync'] = asyncio.create_task(sync_inventory_forever())
+    
+    # Архивацию и вебхук выполняет только ведущий процесс-обработчик
+    if cluster.is_leader():
+        history_archiver.start()
+        
+        with startup_phase('set_webhook'):
+            webhook_url = f"{WEBHOOK_HOST}{WEBHOOK_PATH}"
+            await bot.set_webhook(webhook_url, secret_token=webhook_secret)
+            logger.info(f"Webhook установлен: {webhook_url}")
     
-    # Устанавливаем вебхук
-    webhook_url = f"{WEBHOOK_HOST}{WEBHOOK_PATH}"
-    await bot.set_webhook(webhook_url)
-    logger.info(f"Webhook установлен: {webhook_url}")
+    logger.info(f"Запуск завершен за {time.perf_counter() - PROCESS_STARTED:.3f} с")
 
 async def on_shutdown(app):
     """Действия при остановке бота"""
     # Удаляем вебхук
-    await bot.delete_webhook()
-    logger.info("Webhook удален")
+    if cluster.is_leader():
+        await bot.delete_webhook()
+        logger.info("Webhook удален")
+    
+    # Дорабатываем уже принятые обновления
+    await updates_queue.close()
+    await update_dedup.close()
+    
+    syncing = app.get('inventory_sync')
+    if syncing is not None:
+        syncing.cancel()
+        await asyncio.gather(syncing, return_exceptions=True)
+    
+    # Отправляем накопившиеся уведомления
+    await overdue_scheduler.close()
+    await notifier.close()
+    await photo_downloader.close()
+    
+    # Дожидаемся прогрева кэша, чтобы не закрыть базу под ним
+    warming = app.get('warm_caches')
+    if warming is not None:
+        await asyncio.gather(warming, return_exceptions=True)
+    
+    # Останавливаем фоновое удаление просроченных состояний
+    await storage.close()
+    await storage.wait_closed()
+    
+    # Останавливаем архивацию истории; начатый перенос месяца завершится при закрытии репозитория
+    await history_archiver.close()
+    
+    # Закрываем соединения с базой данных
+    repo.close()
+    close_write_queue()
+    close_pool()
+    
+    # Дописываем накопившиеся записи лога
+    log_setup.stop_logging()
 
 def main():
     """Основная функция запуска бота"""
+    # Запись лога в поток вывода идет в отдельном потоке, не в цикле событий
+    log_setup.setup_logging()
     try:
-        # Регистрируем все обработчики
-        register_handlers(dp)
-        
-        # Настраиваем маршруты
-        app = web.Application()
-        app.router.add_post(WEBHOOK_PATH, handle_webhook)
-        app.router.add_get("/health", health_check)
+        # Несколько процессов: этот процесс только распределяет обновления по чатам
+        if cluster.WEB_WORKERS > 1 and cluster.CLUSTER_WORKER_ID is None:
+            cluster.run_front(WEBAPP_HOST, WEBAPP_PORT, WEBHOOK_PATH, WEBHOOK_SECRET or None)
+            return
         
-        # Устанавливаем обработчики запуска/остановки
-        app.on_startup.append(on_startup)
-        app.on_shutdown.append(on_shutdown)
+        app = build_app()
         
-        # Запускаем веб-сервер
-        web.run_app(app, host=WEBAPP_HOST, port=WEBAPP_PORT)
+        # Запускаем веб-сервер; процесс-обработчик принимает обновления только от диспетчера
+        if cluster.CLUSTER_WORKER_ID is not None:
+            web.run_app(app, host='127.0.0.1', port=cluster.worker_port(cluster.worker_id()))
+        else:
+            web.run_app(app, host=WEBAPP_HOST, port=WEBAPP_PORT)
         
     except Exception as e:
         logger.error(f"Ошибка при запуске бота: {e}")
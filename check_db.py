@@ -1,7 +1,194 @@
 import sqlite3
 
+from db import DB_PATH, create_tables
+
+# Горячие запросы и индексы, которые они должны использовать
+EXPECTED_QUERY_PLANS = [
+    (
+        'Открытая выдача по инструменту',
+        """
+        SELECT i.id, i.tool_id, t.name, i.employee_name, i.issue_date, i.expected_return_date
+        FROM issued_tools i
+        JOIN tools t ON i.tool_id = t.id
+        WHERE i.tool_id = ? AND i.return_date IS NULL
+        """,
+        (1,),
+        'idx_issued_tools_open',
+    ),
+    (
+        'Последние операции',
+        """
+        SELECT t.name, th.action, th.employee_name, th.timestamp
+        FROM tool_history th
+        JOIN tools t ON th.tool_id = t.id
+        ORDER BY th.timestamp DESC
+        LIMIT 20
+        """,
+        (),
+        'idx_tool_history_timestamp',
+    ),
+    (
+        'Запрос на выдачу',
+        """
+        SELECT employee_name
+        FROM issue_requests
+        WHERE tool_id = ? AND chat_id = ? AND status = 'pending'
+        """,
+        (1, 1),
+        'idx_issue_requests_lookup',
+    ),
+    (
+        'Страница списка инструментов',
+        """
+        SELECT t.id, t.name, t.quantity
+        FROM tools t
+        WHERE (t.name, t.id) > (?, ?)
+        ORDER BY t.name ASC, t.id ASC
+        LIMIT 11
+        """,
+        ('', 0),
+        'idx_tools_name_unique',
+    ),
+    (
+        'Тип инструмента по названию',
+        """
+        SELECT id FROM tools WHERE name = ?
+        """,
+        ('',),
+        'idx_tools_name_unique',
+    ),
+    (
+        'Самые популярные инструменты',
+        """
+        SELECT t.name, s.issue_count
+        FROM tool_stats s
+        JOIN tools t ON s.tool_id = t.id
+        WHERE s.issue_count > 0
+        ORDER BY s.issue_count DESC
+        LIMIT 5
+        """,
+        (),
+        'idx_tool_stats_issue_count',
+    ),
+    (
+        'Просроченные выдачи',
+        """
+        SELECT t.name, it.employee_name, it.expected_return_date
+        FROM issued_tools it
+        JOIN tools t ON it.tool_id = t.id
+        WHERE it.return_date IS NULL
+        AND it.expected_return_date < date('now')
+        """,
+        (),
+        'idx_issued_tools_open_due',
+    ),
+    (
+        'История инструмента',
+        """
+        SELECT th.timestamp, th.id, t.name, th.action, th.employee_name, th.notes
+        FROM tool_history th
+        JOIN tools t ON th.tool_id = t.id
+        WHERE th.tool_id = ?
+        ORDER BY th.timestamp DESC, th.id DESC
+        LIMIT 100
+        """,
+        (1,),
+        'idx_tool_history_tool',
+    ),
+    (
+        'История сотрудника',
+        """
+        SELECT th.timestamp, th.id, t.name, th.action, th.employee_name, th.notes
+        FROM tool_history th
+        JOIN tools t ON th.tool_id = t.id
+        WHERE th.employee_name = ?
+        ORDER BY th.timestamp DESC, th.id DESC
+        LIMIT 100
+        """,
+        ('',),
+        'idx_tool_history_employee',
+    ),
+    (
+        'Наступившие сроки без напоминания',
+        """
+        SELECT it.id, t.name, it.employee_name, it.chat_id, it.expected_return_date
+        FROM issued_tools it
+        JOIN tools t ON it.tool_id = t.id
+        WHERE it.return_date IS NULL AND it.overdue_notified_at IS NULL
+        AND it.expected_return_date <= ?
+        ORDER BY it.expected_return_date
+        """,
+        ('',),
+        'idx_issued_tools_due_pending',
+    ),
+    (
+        'Фото возврата, еще не сохраненные в хранилище',
+        """
+        SELECT DISTINCT return_photo
+        FROM issued_tools
+        WHERE return_photo IS NOT NULL AND return_photo_sha IS NULL
+        LIMIT 1000
+        """,
+        (),
+        'idx_issued_tools_photo_pending',
+    ),
+]
+
+
+def check_query_plans(cursor):
+    """Проверяет через EXPLAIN QUERY PLAN, что горячие запросы используют индексы"""
+    print("\nПланы запросов:")
+    for title, query, params, index in EXPECTED_QUERY_PLANS:
+        cursor.execute(f"EXPLAIN QUERY PLAN {query}", params)
+        plan = [row[3] for row in cursor.fetchall()]
+        print(f"- {title}:")
+        for line in plan:
+            print(f"    {line}")
+        assert any(index in line for line in plan), f"{title}: не используется индекс {index}"
+
+
+def check_report_stats(cursor):
+    """Проверяет, что сводные таблицы отчета совпадают с пересчетом по данным"""
+    cursor.execute("SELECT tool_types, total_quantity, issued_now FROM stats_totals WHERE id = 1")
+    totals = cursor.fetchone()
+    cursor.execute("""
+        SELECT COUNT(*), COALESCE(SUM(quantity), 0),
+               (SELECT COUNT(*) FROM issued_tools WHERE return_date IS NULL)
+        FROM tools
+    """)
+    expected = cursor.fetchone()
+    print(f"\nСводка отчета: {totals}, пересчет: {expected}")
+    assert totals == expected, "Сводка отчета не совпадает с данными"
+    cursor.execute("""
+        SELECT COUNT(*) FROM (
+            SELECT tool_id, COUNT(*) AS issue_count, SUM(return_date IS NULL) AS issued_now
+            FROM issued_tools WHERE tool_id IN (SELECT id FROM tools) GROUP BY tool_id
+            EXCEPT
+            SELECT tool_id, issue_count, issued_now FROM tool_stats WHERE issue_count > 0
+        )
+    """)
+    assert cursor.fetchone()[0] == 0, "Счетчики выдач по инструментам не совпадают с данными"
+
+
+def check_stock(cursor):
+    """Проверяет, что выдано столько единиц, сколько открытых выдач, и не больше, чем есть"""
+    cursor.execute("""
+        SELECT t.id, t.name, t.quantity, t.reserved, COUNT(it.id)
+        FROM tools t
+        LEFT JOIN issued_tools it ON it.tool_id = t.id AND it.return_date IS NULL
+        GROUP BY t.id
+        HAVING t.reserved != COUNT(it.id) OR t.reserved > t.quantity
+    """)
+    broken = cursor.fetchall()
+    for tool_id, name, quantity, reserved, open_loans in broken:
+        print(f"- {name} (ID {tool_id}): всего {quantity}, выдано {reserved}, открытых выдач {open_loans}")
+    assert not broken, "Число выданных единиц не совпадает с открытыми выдачами"
+    print("\nУчет единиц совпадает с открытыми выдачами")
+
+
 def check_database():
-    conn = sqlite3.connect('tools.db')
+    create_tables()
+    conn = sqlite3.connect(DB_PATH)
     cursor = conn.cursor()
     
     # Проверяем таблицы
@@ -11,12 +198,20 @@ def check_database():
     for table in tables:
         print(f"- {table[0]}")
     
+    # Проверяем версию схемы
+    cursor.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+    print(f"\nВерсия схемы: {cursor.fetchone()[0]}")
+    
     # Проверяем содержимое таблицы tools
     print("\nСодержимое таблицы tools:")
-    cursor.execute("SELECT * FROM tools")
+    cursor.execute("SELECT id, name, quantity, reserved FROM tools")
     tools = cursor.fetchall()
     for tool in tools:
-        print(f"ID: {tool[0]}, Название: {tool[1]}, Статус: {tool[3]}")
+        print(f"ID: {tool[0]}, Название: {tool[1]}, Всего: {tool[2]}, Выдано: {tool[3]}")
+    
+    check_query_plans(cursor)
+    check_report_stats(cursor)
+    check_stock(cursor)
     
     conn.close()
 
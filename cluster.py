@@ -0,0 +1,295 @@
+import asyncio
+import json
+import logging
+import os
+import subprocess
+import sys
+import time
+import zlib
+
+import aiohttp
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+# Сколько процессов-обработчиков запускать; 1 - прежний режим в одном процессе
+WEB_WORKERS = int(os.getenv('WEB_WORKERS', '1'))
+
+# Номер процесса-обработчика; задается процессом-диспетчером, в одиночном режиме не задан
+CLUSTER_WORKER_ID = os.getenv('CLUSTER_WORKER_ID')
+
+# Обработчик с номером N слушает 127.0.0.1:CLUSTER_BASE_PORT + N
+CLUSTER_BASE_PORT = int(os.getenv('CLUSTER_BASE_PORT', '9100'))
+
+# Сколько секунд ждать запуска обработчика (миграции, загрузка состояний)
+CLUSTER_START_TIMEOUT = float(os.getenv('CLUSTER_START_TIMEOUT', '120'))
+
+_BOT_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bot.py')
+
+
+def worker_id() -> int:
+    """Номер текущего процесса-обработчика (0 в одиночном режиме)"""
+    return int(CLUSTER_WORKER_ID or 0)
+
+
+def worker_count() -> int:
+    """Сколько обработчиков делят обновления; в одиночном режиме - 1"""
+    return max(1, WEB_WORKERS) if CLUSTER_WORKER_ID is not None else 1
+
+
+def is_leader() -> bool:
+    """Ведущий обработчик: регистрирует вебхук и выполняет общие фоновые задачи"""
+    return worker_id() == 0
+
+
+def worker_port(number: int) -> int:
+    return CLUSTER_BASE_PORT + number
+
+
+def route(chat_id, workers: int) -> int:
+    """Обработчик для чата: один и тот же, пока не меняется число обработчиков"""
+    # crc32, а не hash(): hash строк различается между процессами
+    return zlib.crc32(str(chat_id).encode()) % workers
+
+
+# Поля обновления с сообщением (чат) и с событием от пользователя (отправитель)
+_MESSAGE_FIELDS = ('message', 'edited_message', 'channel_post', 'edited_channel_post')
+_USER_EVENT_FIELDS = ('inline_query', 'chosen_inline_result', 'shipping_query', 'pre_checkout_query',
+                      'my_chat_member', 'chat_member', 'chat_join_request')
+
+
+def raw_update_chat_id(data: dict):
+    """
+    То же, что ingestion.update_chat_id, но по словарю из JSON: диспетчеру нужен
+    только чат, и объекты aiogram для каждого обновления он не строит.
+    """
+    for field in _MESSAGE_FIELDS:
+        if field in data:
+            return data[field]['chat']['id']
+    callback_query = data.get('callback_query')
+    if callback_query:
+        if callback_query.get('message'):
+            return callback_query['message']['chat']['id']
+        return callback_query['from']['id']
+    for field in _USER_EVENT_FIELDS:
+        event = data.get(field)
+        if event and event.get('from'):
+            return event['from']['id']
+    return data['update_id']
+
+
+def _add_worker_label(line: str, number: int) -> str:
+    label = f'worker="{number}"'
+    name_end = min((i for i in (line.find('{'), line.find(' ')) if i != -1), default=len(line))
+    if line[name_end:name_end + 1] == '{':
+        rest = line[name_end + 1:]
+        return f'{line[:name_end]}{{{label}{"," if not rest.startswith("}") else ""}{rest}'
+    return f'{line[:name_end]}{{{label}}}{line[name_end:]}'
+
+
+def merge_metrics(outputs) -> str:
+    """
+    Объединяет /metrics обработчиков в один ответ: к каждому значению добавляется
+    метка worker, а HELP/TYPE каждой метрики выводятся один раз.
+    """
+    families = {}   # имя -> [строки HELP/TYPE, значения]
+    for number, text in outputs:
+        current = None
+        for line in text.splitlines():
+            if line.startswith('# HELP ') or line.startswith('# TYPE '):
+                name = line.split(' ', 3)[2]
+                current = families.setdefault(name, [[], []])
+                if len(current[0]) < 2 and line not in current[0]:
+                    current[0].append(line)
+            elif line and current is not None:
+                current[1].append(_add_worker_label(line, number))
+    lines = []
+    for headers, samples in families.values():
+        lines.extend(headers)
+        lines.extend(samples)
+    return '\n'.join(lines) + '\n'
+
+
+class ClusterFront:
+    """
+    Процесс-диспетчер: принимает вебхук и передает обновление обработчику его чата.
+    Обработчики - отдельные процессы bot.py на локальных портах; все обновления
+    чата попадают в один процесс, поэтому порядок внутри чата, состояния диалогов
+    и ограничение частоты остаются такими же, как в одиночном режиме.
+    Обновления одного чата передаются по одному, разные чаты - параллельно.
+    Упавший обработчик перезапускается с тем же номером.
+    """
+
+    def __init__(self, workers=WEB_WORKERS, webhook_path='/webhook/', secret=None):
+        self.workers = workers
+        self.webhook_path = webhook_path
+        self.secret = secret
+        self._processes = [None] * workers
+        self._session = None
+        self._supervisor = None
+        self._stopping = False
+        self._chat_locks = {}    # chat_id -> [блокировка, число ожидающих]
+        self._stats = {'forwarded': 0, 'failed': 0, 'restarts': 0}
+
+    def _spawn(self, number):
+        env = dict(os.environ, CLUSTER_WORKER_ID=str(number), WEB_WORKERS=str(self.workers))
+        self._processes[number] = subprocess.Popen([sys.executable, _BOT_SCRIPT], env=env)
+        logger.info(f"Обработчик {number} запущен, pid {self._processes[number].pid}")
+
+    async def _wait_ready(self, number):
+        """Ждет, пока обработчик закончит запуск и начнет отвечать на /health"""
+        url = f'http://127.0.0.1:{worker_port(number)}/health'
+        deadline = time.monotonic() + CLUSTER_START_TIMEOUT
+        while time.monotonic() < deadline:
+            if self._processes[number].poll() is not None:
+                raise RuntimeError(f"Обработчик {number} завершился при запуске")
+            try:
+                async with self._session.get(url) as response:
+                    if response.status == 200:
+                        return
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.2)
+        raise RuntimeError(f"Обработчик {number} не запустился за {CLUSTER_START_TIMEOUT} с")
+
+    async def start(self, app):
+        self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=30))
+        # Ведущий запускается первым: миграции и начальные данные применяются одним процессом
+        self._spawn(0)
+        await self._wait_ready(0)
+        if self.secret is None:
+            # Секрет не задан в окружении: ведущий уже создал его в базе при запуске
+            import db
+            self.secret = await asyncio.get_running_loop().run_in_executor(
+                None, db.get_meta, db.WEBHOOK_SECRET_KEY
+            )
+        for number in range(1, self.workers):
+            self._spawn(number)
+        await asyncio.gather(*(self._wait_ready(number) for number in range(1, self.workers)))
+        self._supervisor = asyncio.create_task(self._supervise())
+        logger.info(f"Запущено обработчиков: {self.workers}")
+
+    async def _supervise(self):
+        while True:
+            await asyncio.sleep(1)
+            for number, process in enumerate(self._processes):
+                if process.poll() is not None and not self._stopping:
+                    logger.error(f"Обработчик {number} завершился с кодом {process.returncode}, перезапуск")
+                    self._stats['restarts'] += 1
+                    self._spawn(number)
+
+    async def stop(self, app):
+        """Останавливает обработчики: каждый дорабатывает принятые обновления"""
+        self._stopping = True
+        if self._supervisor is not None:
+            self._supervisor.cancel()
+            await asyncio.gather(self._supervisor, return_exceptions=True)
+        for process in self._processes:
+            if process is not None and process.poll() is None:
+                process.terminate()
+        for number, process in enumerate(self._processes):
+            if process is None:
+                continue
+            try:
+                await asyncio.get_running_loop().run_in_executor(None, process.wait, 30)
+            except subprocess.TimeoutExpired:
+                logger.warning(f"Обработчик {number} не остановился, принудительное завершение")
+                process.kill()
+        if self._session is not None:
+            await self._session.close()
+
+    async def _forward(self, number, body, headers):
+        url = f'http://127.0.0.1:{worker_port(number)}{self.webhook_path}'
+        try:
+            async with self._session.post(url, data=body, headers=headers) as response:
+                self._stats['forwarded'] += 1
+                return response.status
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            # Обработчик перезапускается или завис: Telegram повторит доставку
+            self._stats['failed'] += 1
+            logger.warning(f"Обработчик {number} недоступен: {e}")
+            return 503
+
+    async def handle_webhook(self, request):
+        """Передает обновление обработчику его чата и возвращает его ответ"""
+        secret = request.headers.get('X-Telegram-Bot-Api-Secret-Token')
+        if secret != self.secret:
+            return web.Response(status=403)
+
+        body = await request.read()
+        try:
+            chat_id = raw_update_chat_id(json.loads(body))
+        except Exception as e:
+            logger.error(f"Некорректное обновление в вебхуке: {e}")
+            return web.Response(status=400)
+
+        headers = {
+            'Content-Type': 'application/json',
+            'X-Telegram-Bot-Api-Secret-Token': secret or '',
+        }
+        entry = self._chat_locks.get(chat_id)
+        if entry is None:
+            entry = self._chat_locks[chat_id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                status = await self._forward(route(chat_id, self.workers), body, headers)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._chat_locks[chat_id]
+        return web.Response(status=status)
+
+    async def health_check(self, request):
+        """OK, если все обработчики работают"""
+        alive = sum(process is not None and process.poll() is None for process in self._processes)
+        if alive < self.workers:
+            return web.Response(text=f"{alive}/{self.workers}", status=503)
+        return web.Response(text="OK", status=200)
+
+    async def metrics_endpoint(self, request):
+        """Метрики всех обработчиков с меткой worker и счетчики диспетчера"""
+        import metrics
+
+        if not metrics.is_authorized(request):
+            return web.Response(status=401)
+        headers = {'Authorization': request.headers.get('Authorization', '')}
+
+        async def fetch(number):
+            url = f'http://127.0.0.1:{worker_port(number)}/metrics'
+            try:
+                async with self._session.get(url, headers=headers) as response:
+                    return number, await response.text() if response.status == 200 else ''
+            except aiohttp.ClientError:
+                return number, ''
+
+        outputs = await asyncio.gather(*(fetch(number) for number in range(self.workers)))
+        text = merge_metrics(outputs)
+        for key, value in self.get_stats().items():
+            text += f'# HELP bot_cluster_{key} ClusterFront.get_stats()[{key!r}]\n'
+            text += f'# TYPE bot_cluster_{key} untyped\nbot_cluster_{key} {value}\n'
+        return web.Response(body=text.encode('utf-8'), headers={'Content-Type': metrics.CONTENT_TYPE})
+
+    def get_stats(self):
+        """Счетчики переданных обновлений, ошибок и перезапусков"""
+        stats = dict(self._stats)
+        stats['workers'] = self.workers
+        stats['active_chats'] = len(self._chat_locks)
+        return stats
+
+    def build_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post(self.webhook_path, self.handle_webhook)
+        app.router.add_get('/health', self.health_check)
+        app.router.add_get('/metrics', self.metrics_endpoint)
+        import metrics
+        metrics.log_exposure()
+        app.on_startup.append(self.start)
+        app.on_shutdown.append(self.stop)
+        return app
+
+
+def run_front(host, port, webhook_path, secret=None):
+    """Запускает процесс-диспетчер с WEB_WORKERS обработчиками"""
+    front = ClusterFront(WEB_WORKERS, webhook_path, secret)
+    web.run_app(front.build_app(), host=host, port=port)
@@ -8,4 +8,9 @@ ADMIN_ID = 1495719377  # ID администратора в Telegram
 WEBHOOK_HOST = 'https://igorka-bot.onrender.com'  # The base URL for your webhook
 WEBHOOK_PATH = '/webhook/'  # The URL path where the webhook will receive updates
 WEBAPP_HOST = '0.0.0.0'  # The host to bind the web server to
-WEBAPP_PORT = int(os.environ.get('PORT', 8000))  # The port to run the web server on
\ No newline at end of file
+WEBAPP_PORT = int(os.environ.get('PORT', 8000))  # The port to run the web server on
+# Secret token Telegram sends in X-Telegram-Bot-Api-Secret-Token with every webhook request;
+# empty means a random one generated on first start and kept in app_meta (db.get_webhook_secret)
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET', '')
+# Bot API server base URL (local Bot API server or a test stub); empty means api.telegram.org
+BOT_API_URL = os.environ.get('BOT_API_URL', '')
@@ -2,8 +2,17 @@ import sqlite3
 from datetime import datetime, timedelta
 import logging
 import os
+import queue
+import secrets
+import threading
+import time
+from concurrent.futures import Future
 from typing import Optional, Tuple
 
+from inventory_cache import InventoryCache
+from migrations import apply_migrations
+from query_profiler import connection_factory
+
 # Create a logger
 logger = logging.getLogger(__name__)
 
@@ -12,11 +21,229 @@ DB_PATH = os.path.join(os.getenv('DATA_DIR', ''), 'tools.db')
 if not DB_PATH:
     DB_PATH = 'tools.db'
 
+# Настройки пула соединений
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '5'))
+DB_STATEMENT_CACHE_SIZE = int(os.getenv('DB_STATEMENT_CACHE_SIZE', '128'))
+DB_POOL_HEALTHCHECK_INTERVAL = float(os.getenv('DB_POOL_HEALTHCHECK_INTERVAL', '30'))
+
+# Как часто запущенный бот проверяет, не изменили ли наличие инструментов другие процессы
+# (импорт каталога, populate_database.py, другие процессы-обработчики), секунды
+INVENTORY_SYNC_INTERVAL = float(os.getenv('INVENTORY_SYNC_INTERVAL', '1'))
+
+# Настройки очереди записи
+DB_WRITE_BATCH_SIZE = int(os.getenv('DB_WRITE_BATCH_SIZE', '32'))
+DB_WRITE_BATCH_DELAY = float(os.getenv('DB_WRITE_BATCH_DELAY', '0'))
+
+# Профили хранения: PRAGMA, которые выполняются для каждого нового соединения.
+# busy_timeout идет первым, чтобы переключение журнала дожидалось блокировок.
+STORAGE_PROFILES = {
+    # WAL: читатели не блокируют писателя, fsync только на контрольных точках
+    'default': {
+        'busy_timeout': 5000,
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'cache_size': -16000,  # ~16 МБ
+        'mmap_size': 64 * 1024 * 1024,
+        'temp_store': 'MEMORY',
+    },
+    # Максимальная надежность: fsync на каждый коммит
+    'durable': {
+        'busy_timeout': 10000,
+        'journal_mode': 'WAL',
+        'synchronous': 'FULL',
+        'cache_size': -16000,
+        'mmap_size': 0,
+        'temp_store': 'MEMORY',
+    },
+    # Прежнее поведение (журнал отката)
+    'legacy': {
+        'busy_timeout': 5000,
+        'journal_mode': 'DELETE',
+        'synchronous': 'FULL',
+        'temp_store': 'MEMORY',
+    },
+}
+
+DB_STORAGE_PROFILE = os.getenv('DB_STORAGE_PROFILE', 'default')
+
+# Переопределение отдельных PRAGMA через переменные окружения
+_PRAGMA_OVERRIDES = {
+    'synchronous': 'DB_SYNCHRONOUS',
+    'mmap_size': 'DB_MMAP_SIZE',
+    'cache_size': 'DB_CACHE_SIZE',
+    'busy_timeout': 'DB_BUSY_TIMEOUT',
+}
+
+
+def get_storage_profile(name: Optional[str] = None) -> dict:
+    """Возвращает PRAGMA выбранного профиля хранения с учетом переменных окружения"""
+    name = name or DB_STORAGE_PROFILE
+    if name not in STORAGE_PROFILES:
+        logger.error(f"Неизвестный профиль хранения {name}, используется default")
+        name = 'default'
+    pragmas = dict(STORAGE_PROFILES[name])
+    for pragma, env_name in _PRAGMA_OVERRIDES.items():
+        value = os.getenv(env_name)
+        if value:
+            pragmas[pragma] = value
+    return pragmas
+
+
+class ConnectionPool:
+    """Пул долгоживущих соединений с SQLite"""
+
+    def __init__(self, db_path, size=DB_POOL_SIZE, statement_cache_size=DB_STATEMENT_CACHE_SIZE,
+                 pragmas=None, healthcheck_interval=DB_POOL_HEALTHCHECK_INTERVAL):
+        self.db_path = db_path
+        self.size = size
+        self.statement_cache_size = statement_cache_size
+        self.pragmas = get_storage_profile() if pragmas is None else dict(pragmas)
+        self.healthcheck_interval = healthcheck_interval
+        # LIFO: чаще всего выдаем самое "горячее" соединение
+        self._idle = queue.LifoQueue(maxsize=size)
+        self._lock = threading.Lock()
+        self._stats = {
+            'created': 0,
+            'borrowed': 0,
+            'returned': 0,
+            'in_use': 0,
+            'overflow': 0,
+            'discarded': 0,
+            'healthcheck_failures': 0,
+        }
+
+    def _connect(self):
+        conn = sqlite3.connect(
+            self.db_path,
+            check_same_thread=False,
+            cached_statements=self.statement_cache_size,
+            factory=connection_factory()
+        )
+        for name, value in self.pragmas.items():
+            conn.execute(f'PRAGMA {name} = {value}')
+        with self._lock:
+            self._stats['created'] += 1
+        return conn
+
+    def _is_healthy(self, conn):
+        try:
+            conn.execute('SELECT 1').fetchone()
+            return True
+        except sqlite3.Error:
+            return False
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+        with self._lock:
+            self._stats['discarded'] += 1
+
+    def acquire(self):
+        """Берет соединение из пула (или открывает новое, если свободных нет)"""
+        conn = None
+        while conn is None:
+            try:
+                conn, released_at = self._idle.get_nowait()
+            except queue.Empty:
+                conn = self._connect()
+                with self._lock:
+                    if self._stats['in_use'] >= self.size:
+                        self._stats['overflow'] += 1
+                break
+
+            # Проверяем соединение, только если оно долго простаивало
+            if time.monotonic() - released_at > self.healthcheck_interval and not self._is_healthy(conn):
+                with self._lock:
+                    self._stats['healthcheck_failures'] += 1
+                self._discard(conn)
+                conn = None
+
+        with self._lock:
+            self._stats['borrowed'] += 1
+            self._stats['in_use'] += 1
+        return conn
+
+    def release(self, conn):
+        """Возвращает соединение в пул"""
+        with self._lock:
+            self._stats['returned'] += 1
+            self._stats['in_use'] -= 1
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error as e:
+            logger.error(f"Соединение повреждено и будет закрыто: {e}")
+            self._discard(conn)
+            return
+        try:
+            self._idle.put_nowait((conn, time.monotonic()))
+        except queue.Full:
+            self._discard(conn)
+
+    def prefill(self):
+        """Заранее открывает соединения до размера пула, чтобы первые запросы не ждали подключения"""
+        while self._idle.qsize() < self.size:
+            conn = self._connect()
+            try:
+                self._idle.put_nowait((conn, time.monotonic()))
+            except queue.Full:
+                # Соединение вернули в пул параллельно с заполнением
+                self._discard(conn)
+                break
+
+    def close(self):
+        """Закрывает все свободные соединения пула"""
+        while True:
+            try:
+                conn, _ = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+
+    def get_stats(self):
+        """Возвращает статистику выдачи/возврата соединений"""
+        with self._lock:
+            stats = dict(self._stats)
+        stats['idle'] = self._idle.qsize()
+        stats['size'] = self.size
+        return stats
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool() -> ConnectionPool:
+    """Возвращает общий пул соединений для текущего DB_PATH"""
+    global _pool
+    with _pool_lock:
+        if _pool is None or _pool.db_path != DB_PATH:
+            if _pool is not None:
+                _pool.close()
+                # Кэш относится к прежней базе данных
+                inventory.invalidate()
+            logger.info(f"Пул соединений: путь к базе данных: {DB_PATH}, размер: {DB_POOL_SIZE}")
+            _pool = ConnectionPool(DB_PATH)
+        return _pool
+
+
+def close_pool():
+    """Закрывает общий пул соединений"""
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+            _pool = None
+    inventory.invalidate()
+
+
 class DatabaseConnection:
     def __init__(self):
-        logger.info(f"DatabaseConnection: путь к базе данных: {DB_PATH}")
         try:
-            self.conn = sqlite3.connect(DB_PATH)
+            self.pool = get_pool()
+            self.conn = self.pool.acquire()
             self.cursor = self.conn.cursor()
             self.connection = self.conn  # Add this line to expose connection attribute
         except sqlite3.Error as e:
@@ -37,7 +264,364 @@ class DatabaseConnection:
             logger.error(f"Ошибка при завершении транзакции: {e}")
             raise
         finally:
-            self.conn.close()
+            self.cursor.close()
+            self.pool.release(self.conn)
+
+# Сигнал остановки потока-писателя
+_STOP = object()
+
+
+class WriteQueue:
+    """
+    Очередь записи с единственным потоком-писателем.
+    Небольшие транзакции, накопившиеся в очереди, объединяются в один
+    групповой коммит; каждая выполняется в своей точке сохранения,
+    поэтому ошибка одной задачи не откатывает остальные.
+    """
+
+    def __init__(self, db_path, max_batch=DB_WRITE_BATCH_SIZE, max_delay=DB_WRITE_BATCH_DELAY, pragmas=None):
+        self.db_path = db_path
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.pragmas = get_storage_profile() if pragmas is None else dict(pragmas)
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stats = {'jobs': 0, 'batches': 0, 'failed_jobs': 0, 'failed_batches': 0}
+        self.current_cursor = None
+        self._job_callbacks = []
+
+    def _connect(self):
+        # isolation_level=None: транзакциями управляем сами
+        conn = sqlite3.connect(self.db_path, isolation_level=None, check_same_thread=False,
+                               factory=connection_factory())
+        for name, value in self.pragmas.items():
+            conn.execute(f'PRAGMA {name} = {value}')
+        return conn
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='db-writer', daemon=True)
+                self._thread.start()
+
+    def in_writer_thread(self) -> bool:
+        return threading.current_thread() is self._thread
+
+    def submit(self, job, on_commit=None, exclusive=False) -> Future:
+        """
+        Ставит job(cursor) в очередь и возвращает Future с его результатом.
+        on_commit(result) вызывается в потоке-писателе сразу после коммита,
+        поэтому такие обновления упорядочены так же, как коммиты.
+        exclusive=True: job выполняется вне транзакции между групповыми коммитами
+        (согласованное чтение без одновременных записей этого процесса).
+        """
+        future = Future()
+        self._ensure_started()
+        self._queue.put((job, future, on_commit, exclusive))
+        return future
+
+    def execute(self, job, on_commit=None, exclusive=False):
+        """Выполняет job(cursor) в потоке-писателе и дожидается результата"""
+        return self.submit(job, on_commit, exclusive).result()
+
+    def after_commit(self, callback):
+        """Из задачи записи: вызвать callback() после успешного коммита этой задачи"""
+        self._job_callbacks.append(callback)
+
+    def _collect_batch(self, first):
+        """Собирает пачку задач; возвращает (пачка, следующий элемент, который в пачку не входит)"""
+        batch = [first]
+        deadline = time.monotonic() + self.max_delay
+        while len(batch) < self.max_batch:
+            try:
+                timeout = deadline - time.monotonic()
+                if timeout > 0:
+                    item = self._queue.get(timeout=timeout)
+                else:
+                    item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is _STOP or item[3]:
+                # Остановку и монопольные задачи обрабатываем после текущей пачки
+                return batch, item
+            batch.append(item)
+        return batch, None
+
+    def _run(self):
+        conn = self._connect()
+        cursor = conn.cursor()
+        pending = None
+        try:
+            while True:
+                item = pending if pending is not None else self._queue.get()
+                pending = None
+                if item is _STOP:
+                    break
+                if item[3]:
+                    self._process_exclusive(cursor, item)
+                    continue
+                batch, pending = self._collect_batch(item)
+                self._process_batch(conn, cursor, batch)
+        finally:
+            conn.close()
+
+    def _run_callback(self, callback, *args):
+        try:
+            callback(*args)
+        except Exception as e:
+            logger.error(f"Ошибка в обработчике после коммита: {e}")
+
+    def _process_exclusive(self, cursor, item):
+        job, future, on_commit, _ = item
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            result = job(cursor)
+        except Exception as e:
+            future.set_exception(e)
+            return
+        if on_commit is not None:
+            self._run_callback(on_commit, result)
+        future.set_result(result)
+
+    def _process_batch(self, conn, cursor, batch):
+        # Отмененные до начала выполнения задачи пропускаем
+        active = [item for item in batch if item[1].set_running_or_notify_cancel()]
+        if not active:
+            return
+
+        results = []
+        self.current_cursor = cursor
+        try:
+            cursor.execute('BEGIN IMMEDIATE')
+            for job, future, on_commit, _ in active:
+                self._job_callbacks = []
+                cursor.execute('SAVEPOINT job')
+                try:
+                    result = job(cursor)
+                except Exception as e:
+                    cursor.execute('ROLLBACK TO job')
+                    cursor.execute('RELEASE job')
+                    results.append((future, None, e, None, []))
+                else:
+                    cursor.execute('RELEASE job')
+                    results.append((future, result, None, on_commit, self._job_callbacks))
+            cursor.execute('COMMIT')
+        except sqlite3.Error as e:
+            logger.error(f"Ошибка группового коммита ({len(active)} задач): {e}")
+            if conn.in_transaction:
+                conn.rollback()
+            with self._lock:
+                self._stats['failed_batches'] += 1
+            # Ни одна задача пачки не применена
+            for _, future, _, _ in active:
+                future.set_exception(e)
+            return
+        finally:
+            self.current_cursor = None
+            self._job_callbacks = []
+
+        failed = 0
+        for future, result, error, on_commit, callbacks in results:
+            if error is not None:
+                failed += 1
+                future.set_exception(error)
+                continue
+            for callback in callbacks:
+                self._run_callback(callback)
+            if on_commit is not None:
+                self._run_callback(on_commit, result)
+            future.set_result(result)
+        with self._lock:
+            self._stats['jobs'] += len(results)
+            self._stats['batches'] += 1
+            self._stats['failed_jobs'] += failed
+
+    def close(self):
+        """Дожидается выполнения поставленных задач и останавливает поток-писатель"""
+        with self._lock:
+            thread = self._thread
+            self._thread = None
+        if thread is not None and thread.is_alive():
+            self._queue.put(_STOP)
+            thread.join()
+
+    def get_stats(self):
+        """Возвращает статистику групповых коммитов"""
+        with self._lock:
+            stats = dict(self._stats)
+        stats['pending'] = self._queue.qsize()
+        return stats
+
+
+_write_queue = None
+
+
+def get_write_queue() -> WriteQueue:
+    """Возвращает общую очередь записи для текущего DB_PATH"""
+    global _write_queue
+    with _pool_lock:
+        if _write_queue is None or _write_queue.db_path != DB_PATH:
+            if _write_queue is not None:
+                _write_queue.close()
+            _write_queue = WriteQueue(DB_PATH)
+        return _write_queue
+
+
+def close_write_queue():
+    """Останавливает общую очередь записи"""
+    global _write_queue
+    with _pool_lock:
+        write_queue, _write_queue = _write_queue, None
+    if write_queue is not None:
+        write_queue.close()
+
+
+def run_write(job, on_commit=None):
+    """
+    Выполняет job(cursor) как отдельную транзакцию записи через общую очередь.
+    Исключение, выброшенное job, откатывает только ее изменения и пробрасывается вызывающему.
+    on_commit(result) вызывается в потоке-писателе после коммита.
+    """
+    write_queue = get_write_queue()
+    if write_queue.in_writer_thread():
+        # Вложенный вызов из задачи записи: мы уже внутри транзакции
+        result = job(write_queue.current_cursor)
+        if on_commit is not None:
+            write_queue.after_commit(lambda: on_commit(result))
+        return result
+    return write_queue.execute(job, on_commit)
+
+
+_INVENTORY_QUERY = """
+    SELECT t.id, t.name, t.quantity, t.reserved
+    FROM tools t
+"""
+
+
+# PRAGMA data_version соединения потока-писателя на момент загрузки кэша наличия.
+# Значение меняется только при коммитах других соединений (других процессов).
+_inventory_data_version = None
+
+
+def _data_version(cursor) -> int:
+    cursor.execute('PRAGMA data_version')
+    return cursor.fetchone()[0]
+
+
+def _load_inventory(install):
+    """
+    Загружает наличие всех инструментов в кэш.
+    Чтение и установка выполняются в потоке-писателе между групповыми коммитами,
+    поэтому снимок согласован с обновлениями кэша после коммитов.
+    """
+    def _read(cursor):
+        global _inventory_data_version
+        _inventory_data_version = _data_version(cursor)
+        cursor.execute(_INVENTORY_QUERY)
+        install(cursor.fetchall())
+
+    get_write_queue().execute(_read, exclusive=True)
+
+
+# Кэш наличия инструментов для /list, /issue и поиска
+inventory = InventoryCache(_load_inventory)
+
+
+def sync_inventory() -> bool:
+    """
+    Сбрасывает кэш наличия, если с момента его загрузки в базу писали другие
+    процессы (несколько обработчиков вебхука, импорт каталога). Свои записи
+    кэш получает сквозной записью; returns bool: True, если кэш сброшен.
+    """
+    def _check(cursor):
+        global _inventory_data_version
+        if _inventory_data_version is None or _data_version(cursor) == _inventory_data_version:
+            return False
+        _inventory_data_version = None
+        inventory.invalidate()
+        return True
+
+    return get_write_queue().execute(_check, exclusive=True)
+
+
+def refresh_inventory_tool(cursor, tool_id: int):
+    """
+    Из задачи записи: перечитывает одну запись кэша после нестандартных изменений.
+    Строка читается в той же транзакции, а в кэш попадает после коммита.
+    """
+    cursor.execute(_INVENTORY_QUERY + " WHERE t.id = ?", (tool_id,))
+    row = cursor.fetchone()
+    if row:
+        get_write_queue().after_commit(lambda: inventory.set_tool(*row))
+
+
+def reserve_unit(cursor, tool_id: int) -> bool:
+    """
+    Из задачи записи: резервирует одну свободную единицу инструмента.
+    Проверка и резервирование - один условный UPDATE, поэтому две выдачи
+    не могут занять одну и ту же единицу. Возвращает False, если свободных нет.
+    """
+    cursor.execute(
+        "UPDATE tools SET reserved = reserved + 1 WHERE id = ? AND reserved < quantity",
+        (tool_id,)
+    )
+    return cursor.rowcount == 1
+
+
+def open_loan(cursor, tool_id: int, employee_name: str, issue_date=None, return_date=None,
+              chat_id: Optional[int] = None) -> int:
+    """
+    Из задачи записи: резервирует единицу и оформляет выдачу с записью в историю.
+    Returns int: id выдачи. Выбрасывает ValueError, если свободных единиц нет.
+    """
+    if not reserve_unit(cursor, tool_id):
+        raise ValueError("Инструмент больше не доступен")
+    issue_date = issue_date or datetime.now()
+    cursor.execute("""
+        INSERT INTO issued_tools
+        (tool_id, employee_name, issue_date, expected_return_date, chat_id)
+        VALUES (?, ?, ?, ?, ?)
+    """, (tool_id, employee_name, issue_date, return_date, chat_id))
+    issue_id = cursor.lastrowid
+    cursor.execute("""
+        INSERT INTO tool_history (tool_id, action, employee_name, timestamp)
+        VALUES (?, 'issued', ?, ?)
+    """, (tool_id, employee_name, issue_date))
+    return issue_id
+
+
+def close_loan(cursor, issue_id: int, return_date=None, photo_id: Optional[str] = None):
+    """
+    Из задачи записи: закрывает открытую выдачу, освобождает единицу и пишет историю.
+    Returns tuple: (tool_id, employee_name, issue_date) или None, если выдача уже закрыта.
+    """
+    return_date = return_date or datetime.now()
+    cursor.execute("""
+        SELECT tool_id, employee_name, issue_date
+        FROM issued_tools
+        WHERE id = ? AND return_date IS NULL
+    """, (issue_id,))
+    loan = cursor.fetchone()
+    if loan is None:
+        return None
+    tool_id, employee_name, _ = loan
+    cursor.execute("""
+        UPDATE issued_tools
+        SET return_date = ?, return_photo = COALESCE(?, return_photo)
+        WHERE id = ?
+    """, (return_date, photo_id, issue_id))
+    cursor.execute(
+        "UPDATE tools SET reserved = reserved - 1 WHERE id = ? AND reserved > 0",
+        (tool_id,)
+    )
+    cursor.execute("""
+        INSERT INTO tool_history (tool_id, action, employee_name, timestamp)
+        VALUES (?, 'returned', ?, ?)
+    """, (tool_id, employee_name, return_date))
+    return loan
+
 
 def create_tables():
     """Создает необходимые таблицы в базе данных"""
@@ -94,18 +678,56 @@ def create_tables():
                 )
             ''')
             logger.info("create_tables: все таблицы успешно созданы")
+            
+            # Применяем недостающие миграции схемы (колонки, индексы)
+            version = apply_migrations(db.conn)
+            logger.info(f"create_tables: версия схемы {version}")
     except sqlite3.Error as e:
         logger.error(f"Ошибка при создании таблиц: {e}")
         raise
 
+def get_meta(key: str, default: Optional[str] = None) -> Optional[str]:
+    """Возвращает служебное значение из app_meta"""
+    with DatabaseConnection() as db:
+        db.cursor.execute("SELECT value FROM app_meta WHERE key = ?", (key,))
+        row = db.cursor.fetchone()
+        return row[0] if row else default
+
+
+def set_meta(cursor, key: str, value):
+    """Из задачи записи: сохраняет служебное значение в app_meta"""
+    cursor.execute("""
+        INSERT INTO app_meta (key, value, updated_at) VALUES (?, ?, CURRENT_TIMESTAMP)
+        ON CONFLICT(key) DO UPDATE SET value = excluded.value, updated_at = excluded.updated_at
+    """, (key, str(value)))
+
+
+WEBHOOK_SECRET_KEY = 'webhook_secret'
+
+
+def get_webhook_secret() -> str:
+    """
+    Секрет вебхука, если он не задан в окружении: случайный, создается при первом
+    запуске на этой базе и хранится в app_meta, поэтому у всех процессов-обработчиков он общий
+    """
+    def _get_or_create(cursor):
+        cursor.execute("""
+            INSERT INTO app_meta (key, value, updated_at) VALUES (?, ?, CURRENT_TIMESTAMP)
+            ON CONFLICT(key) DO NOTHING
+        """, (WEBHOOK_SECRET_KEY, secrets.token_urlsafe(32)))
+        cursor.execute("SELECT value FROM app_meta WHERE key = ?", (WEBHOOK_SECRET_KEY,))
+        return cursor.fetchone()[0]
+
+    return get_write_queue().execute(_get_or_create)
+
+
 def get_tools():
     """Получает список всех инструментов"""
-    logger.info("DEBUG: Получение списка инструментов")
     try:
         with DatabaseConnection() as db:
             db.cursor.execute('SELECT id, name, status, quantity FROM tools')
             tools = db.cursor.fetchall()
-            logger.info(f"DEBUG: Получено {len(tools)} инструментов: {tools}")
+            logger.debug("Получено инструментов: %s", len(tools))
             return tools
     except sqlite3.Error as e:
         logger.error(f"DEBUG: Ошибка при получении списка инструментов: {e}")
@@ -201,104 +823,53 @@ def complete_return(issue_id: int) -> bool:
     Завершить возврат инструмента
     """
     try:
-        with DatabaseConnection() as db:
-            # Получаем информацию о выдаче
-            db.cursor.execute("""
-                SELECT tool_id, employee_name
-                FROM issued_tools
-                WHERE id = ? AND return_date IS NULL
-            """, (issue_id,))
-            
-            issue_info = db.cursor.fetchone()
-            if not issue_info:
-                return False
-            
-            tool_id, employee_name = issue_info
-            
-            # Обновляем статус инструмента
-            db.cursor.execute("""
-                UPDATE tools
-                SET status = 'available'
-                WHERE id = ?
-            """, (tool_id,))
-            
-            # Обновляем запись о выдаче
-            db.cursor.execute("""
-                UPDATE issued_tools
-                SET return_date = datetime('now')
-                WHERE id = ?
-            """, (issue_id,))
-            
-            # Добавляем запись в историю
-            db.cursor.execute("""
-                INSERT INTO tool_history (tool_id, action, employee_name, timestamp)
-                VALUES (?, 'return', ?, datetime('now'))
-            """, (tool_id, employee_name))
-            
-            return True
+        def _write(cursor):
+            loan = close_loan(cursor, issue_id)
+            return loan[0] if loan else None
+
+        def _on_commit(tool_id):
+            if tool_id is not None:
+                inventory.apply(tool_id, issued_delta=-1)
+
+        return run_write(_write, _on_commit) is not None
         
     except sqlite3.Error as e:
         logger.error(f"Ошибка при завершении возврата: {e}")
         return False
 
 def return_tool(tool_id, employee_name):
-    """Возвращает инструмент"""
+    """Возвращает инструмент: закрывает последнюю открытую выдачу сотрудника"""
     try:
-        with DatabaseConnection() as db:
-            # Проверяем, что инструмент был выдан
-            db.cursor.execute('SELECT status FROM tools WHERE id = ?', (tool_id,))
-            result = db.cursor.fetchone()
-            
-            if not result or result[0] != 'issued':
-                return False
-            
-            # Проверяем, что инструмент был выдан указанному сотруднику
-            db.cursor.execute('''
-                SELECT employee_name FROM issued_tools
-                WHERE tool_id = ?
-            ''', (tool_id,))
-            issue_record = db.cursor.fetchone()
-            
-            if not issue_record or issue_record[0] != employee_name:
-                return False
-            
-            # Удаляем запись о выдаче
-            db.cursor.execute('''
-                DELETE FROM issued_tools
-                WHERE tool_id = ? AND employee_name = ?
+        def _write(cursor):
+            cursor.execute('''
+                SELECT id FROM issued_tools
+                WHERE tool_id = ? AND employee_name = ? AND return_date IS NULL
+                ORDER BY id DESC
+                LIMIT 1
             ''', (tool_id, employee_name))
-            
-            # Обновляем статус инструмента
-            db.cursor.execute('''
-                UPDATE tools
-                SET status = 'available'
-                WHERE id = ?
-            ''', (tool_id,))
-            
-            # Добавляем запись в историю
-            db.cursor.execute('''
-                INSERT INTO tool_history (tool_id, action, employee_name)
-                VALUES (?, 'return', ?)
-            ''', (tool_id, employee_name))
-            
-            return True
+            issue = cursor.fetchone()
+            return bool(issue) and close_loan(cursor, issue[0]) is not None
+
+        def _on_commit(returned):
+            if returned:
+                inventory.apply(tool_id, issued_delta=-1)
+
+        return run_write(_write, _on_commit)
             
     except sqlite3.Error as e:
         logger.error(f"DEBUG: Ошибка при возврате инструмента: {str(e)}")
         return False
 
-def get_tool_history():
+def get_tool_history(tool_id: Optional[int] = None, employee_name: Optional[str] = None,
+                     since=None, until=None, limit: int = 100):
+    """
+    История операций по инструменту, сотруднику и/или периоду [since, until), новые сначала,
+    включая перенесенную в архивы: (name, action, timestamp, employee_name, notes)
+    """
+    # Импорт здесь: history_archive сам использует этот модуль
+    from history_archive import query_history
     try:
-        with DatabaseConnection() as db:
-            db.cursor.execute('''
-                SELECT t.name, th.action, th.timestamp, th.employee_name, th.notes
-                FROM tool_history th
-                JOIN tools t ON th.tool_id = t.id
-                ORDER BY th.timestamp DESC
-            ''')
-            
-            history = db.cursor.fetchall()
-            return history
+        return query_history(tool_id, employee_name, since, until, limit)
     except sqlite3.Error as e:
         logger.error(f"Ошибка при получении истории инструментов: {e}")
         return []
@@ -332,59 +903,46 @@ def get_overdue_tools(days_threshold=7):
         return []
 
 def is_tool_issued(tool_id):
+    """Выдана ли сейчас хотя бы одна единица инструмента"""
     try:
         with DatabaseConnection() as db:
-            db.cursor.execute('SELECT COUNT(*) FROM issued_tools WHERE tool_id = ?', (tool_id,))
-            count = db.cursor.fetchone()[0]
-            return count > 0
+            db.cursor.execute('SELECT reserved FROM tools WHERE id = ?', (tool_id,))
+            row = db.cursor.fetchone()
+            return bool(row and row[0] > 0)
     except sqlite3.Error as e:
         logger.error(f"Ошибка при проверке выдачи инструмента: {e}")
         return False
 
 def issue_tool(tool_id, employee_name):
+    """Выдает единицу инструмента без срока; ValueError, если свободных единиц нет"""
     try:
-        with DatabaseConnection() as db:
-            # Проверяем, не выдан ли уже инструмент
-            if is_tool_issued(tool_id):
-                raise Exception("Инструмент уже выдан")
-            
-            # Добавляем запись о выдаче
-            db.cursor.execute('''
-                INSERT INTO issued_tools (tool_id, employee_name)
-                VALUES (?, ?)
-            ''', (tool_id, employee_name))
-            
-            # Обновляем статус в tools
-            db.cursor.execute('UPDATE tools SET status = "issued" WHERE id = ?', (tool_id,))
-            
-            # Добавляем запись в историю
-            db.cursor.execute('''
-                INSERT INTO tool_history (tool_id, action, employee_name)
-                VALUES (?, 'issue', ?)
-            ''', (tool_id, employee_name))
-            
+        run_write(
+            lambda cursor: open_loan(cursor, tool_id, employee_name),
+            lambda _: inventory.apply(tool_id, issued_delta=1)
+        )
     except sqlite3.Error as e:
         logger.error(f"Ошибка при выдаче инструмента: {e}")
         raise e
 
 def create_tool_request(tool_id: int, employee_name: str, chat_id: int) -> bool:
-    """Создает запрос на выдачу инструмента"""
+    """Создает запрос на выдачу инструмента; единица резервируется при одобрении"""
     try:
-        with DatabaseConnection() as db:
-            # Проверяем, не выдан ли уже инструмент
-            db.cursor.execute('SELECT status FROM tools WHERE id = ?', (tool_id,))
-            result = db.cursor.fetchone()
-            if not result or result[0] == 'issued':
+        def _write(cursor):
+            # Есть ли свободная единица
+            cursor.execute('SELECT 1 FROM tools WHERE id = ? AND reserved < quantity', (tool_id,))
+            if cursor.fetchone() is None:
                 return False
 
             # Создаем запрос
-            db.cursor.execute('''
+            cursor.execute('''
                 INSERT INTO issue_requests (tool_id, employee_name, chat_id)
                 VALUES (?, ?, ?)
             ''', (tool_id, employee_name, chat_id))
             
-            logger.info(f"DEBUG: Создан запрос на выдачу инструмента {tool_id} сотруднику {employee_name}")
+            logger.info("Создан запрос на выдачу инструмента %s сотруднику %s", tool_id, employee_name)
             return True
+
+        return run_write(_write)
     except sqlite3.Error as e:
         logger.error(f"DEBUG: Ошибка при создании запроса на выдачу: {str(e)}")
         return False
@@ -407,14 +965,14 @@ def get_issue_request_info(tool_id: int, chat_id: int):
 def approve_issue_request(tool_id: int, chat_id: int) -> bool:
     """Одобряет запрос на выдачу инструмента"""
     try:
-        with DatabaseConnection() as db:
+        def _write(cursor):
             # Получаем информацию о запросе
-            db.cursor.execute('''
+            cursor.execute('''
                 SELECT employee_name
                 FROM issue_requests
                 WHERE tool_id = ? AND chat_id = ? AND status = 'pending'
             ''', (tool_id, chat_id))
-            request = db.cursor.fetchone()
+            request = cursor.fetchone()
             
             if not request:
                 logger.error(f"DEBUG: Запрос на выдачу не найден: tool_id={tool_id}, chat_id={chat_id}")
@@ -422,41 +980,27 @@ def approve_issue_request(tool_id: int, chat_id: int) -> bool:
             
             employee_name = request[0]
             
-            # Проверяем статус инструмента
-            db.cursor.execute('SELECT status FROM tools WHERE id = ?', (tool_id,))
-            tool = db.cursor.fetchone()
-            if not tool or tool[0] != 'available':
+            try:
+                open_loan(cursor, tool_id, employee_name, chat_id=chat_id)
+            except ValueError:
                 logger.error(f"DEBUG: Инструмент недоступен для выдачи: {tool_id}")
                 return False
             
-            # Обновляем статус инструмента
-            db.cursor.execute('''
-                UPDATE tools
-                SET status = 'issued'
-                WHERE id = ? AND status = 'available'
-            ''', (tool_id,))
-            
-            # Добавляем запись в issued_tools
-            db.cursor.execute('''
-                INSERT INTO issued_tools (tool_id, employee_name)
-                VALUES (?, ?)
-            ''', (tool_id, employee_name))
-            
             # Обновляем статус запроса
-            db.cursor.execute('''
+            cursor.execute('''
                 UPDATE issue_requests
                 SET status = 'approved'
                 WHERE tool_id = ? AND chat_id = ? AND status = 'pending'
             ''', (tool_id, chat_id))
             
-            # Добавляем запись в историю
-            db.cursor.execute('''
-                INSERT INTO tool_history (tool_id, action, employee_name)
-                VALUES (?, 'issue', ?)
-            ''', (tool_id, employee_name))
-            
-            logger.info(f"DEBUG: Запрос на выдачу одобрен: tool_id={tool_id}, employee={employee_name}")
+            logger.info("Запрос на выдачу одобрен: tool_id=%s, employee=%s", tool_id, employee_name)
             return True
+
+        def _on_commit(approved):
+            if approved:
+                inventory.apply(tool_id, issued_delta=1)
+
+        return run_write(_write, _on_commit)
             
     except sqlite3.Error as e:
         logger.error(f"DEBUG: Ошибка при одобрении запроса: {str(e)}")
@@ -465,46 +1009,56 @@ def approve_issue_request(tool_id: int, chat_id: int) -> bool:
 def reject_issue_request(tool_id: int, chat_id: int) -> bool:
     """Отклоняет запрос на выдачу инструмента"""
     try:
-        with DatabaseConnection() as db:
-            db.cursor.execute('''
+        def _write(cursor):
+            cursor.execute('''
                 UPDATE issue_requests
                 SET status = 'rejected'
                 WHERE tool_id = ? AND chat_id = ? AND status = 'pending'
             ''', (tool_id, chat_id))
             
-            if db.cursor.rowcount > 0:
-                logger.info(f"DEBUG: Запрос на выдачу отклонен: tool_id={tool_id}, chat_id={chat_id}")
+            if cursor.rowcount > 0:
+                logger.info("Запрос на выдачу отклонен: tool_id=%s, chat_id=%s", tool_id, chat_id)
                 return True
             else:
                 logger.error(f"DEBUG: Запрос на выдачу не найден: tool_id={tool_id}, chat_id={chat_id}")
                 return False
+
+        return run_write(_write)
                 
     except sqlite3.Error as e:
         logger.error(f"DEBUG: Ошибка при отклонении запроса: {str(e)}")
         return False
 
 def create_tool(name, quantity=1, description=None):
-    """Создает новый инструмент"""
+    """Создает инструмент; если тип с таким названием уже есть, добавляет ему quantity единиц"""
     try:
-        with DatabaseConnection() as db:
-            db.cursor.execute('''
-                INSERT INTO tools (name, description, status, quantity)
-                VALUES (?, ?, 'available', ?)
+        def _write(cursor):
+            cursor.execute('''
+                INSERT INTO tools (name, description, quantity)
+                VALUES (?, ?, ?)
+                ON CONFLICT(name) DO UPDATE SET
+                    quantity = quantity + excluded.quantity,
+                    description = COALESCE(excluded.description, description)
             ''', (name, description, quantity))
-            
-            tool_id = db.cursor.lastrowid
-            
+            cursor.execute('SELECT id FROM tools WHERE name = ?', (name,))
+            tool_id = cursor.fetchone()[0]
+            refresh_inventory_tool(cursor, tool_id)
             return tool_id
+
+        return run_write(_write)
     except sqlite3.Error as e:
         logger.error(f"Ошибка при создании инструмента: {e}")
         return None
 
 def get_tool_by_id(tool_id: int):
-    """Получает информацию об инструменте по его ID"""
+    """
+    Получает информацию об инструменте по его ID
+    Returns tuple: (id, name, available, quantity, description, image)
+    """
     try:
         with DatabaseConnection() as db:
             db.cursor.execute('''
-                SELECT id, name, status, quantity, description
+                SELECT id, name, quantity - reserved, quantity, description, image
                 FROM tools
                 WHERE id = ?
             ''', (tool_id,))
@@ -516,19 +1070,23 @@ def get_tool_by_id(tool_id: int):
 def update_tool_status(tool_id: int, status: str):
     """Обновляет статус инструмента"""
     try:
-        with DatabaseConnection() as db:
+        def _write(cursor):
             # Обновляем статус инструмента
-            db.cursor.execute('UPDATE tools SET status = ? WHERE id = ?', (status, tool_id))
+            cursor.execute('UPDATE tools SET status = ? WHERE id = ?', (status, tool_id))
             
             # Если статус 'available', закрываем все открытые записи о выдаче
             if status == 'available':
-                db.cursor.execute('''
+                cursor.execute('''
                     UPDATE issued_tools 
                     SET return_date = CURRENT_TIMESTAMP 
                     WHERE tool_id = ? AND return_date IS NULL
                 ''', (tool_id,))
+                cursor.execute('UPDATE tools SET reserved = 0 WHERE id = ?', (tool_id,))
+                refresh_inventory_tool(cursor, tool_id)
             
             return True
+
+        return run_write(_write)
     except sqlite3.Error as e:
         logger.error(f"Ошибка при обновлении статуса инструмента: {e}")
         return False
@@ -536,12 +1094,14 @@ def update_tool_status(tool_id: int, status: str):
 def add_tool_history(tool_id: int, action: str, employee_name: str):
     """Добавляет запись в историю инструмента"""
     try:
-        with DatabaseConnection() as db:
-            db.cursor.execute('''
+        def _write(cursor):
+            cursor.execute('''
                 INSERT INTO tool_history (tool_id, action, employee_name, timestamp)
                 VALUES (?, ?, ?, datetime('now'))
             ''', (tool_id, action, employee_name))
             return True
+
+        return run_write(_write)
     except sqlite3.Error as e:
         logger.error(f"Ошибка при добавлении записи в историю: {e}")
         return False
@@ -562,4 +1122,355 @@ def get_all_issue_requests():
         return []
 
 def get_db_connection():
-    return sqlite3.connect(DB_PATH)
\ No newline at end of file
+    return sqlite3.connect(DB_PATH)
+
+def get_tools_with_availability():
+    """Получает список инструментов с количеством выданных единиц (из кэша)"""
+    try:
+        return inventory.list_tools()
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка при получении списка инструментов с доступностью: {e}")
+        return []
+
+
+def get_available_tools():
+    """Получает инструменты, которые можно выдать (из кэша)"""
+    try:
+        return inventory.available_tools()
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка при получении доступных инструментов: {e}")
+        return []
+
+
+def search_tools(search_query: str, limit: Optional[int] = None):
+    """Ищет инструменты по названию с учетом опечаток и транслитерации (в кэше)"""
+    try:
+        return inventory.search(search_query, limit)
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка при поиске инструментов: {e}")
+        return []
+
+
+def _keyset_page(cursor, query, key, anchor_query, after_id=None, before_id=None,
+                 limit=10, descending=False):
+    """
+    Постраничная выборка по ключу (seek) вместо OFFSET: строки сразу после after_id
+    или сразу перед before_id в порядке сортировки key. Стоимость не зависит от номера страницы.
+    Returns tuple: (rows, has_prev, has_next)
+    """
+    anchor_id = after_id if after_id is not None else before_id
+    anchor = None
+    if anchor_id is not None:
+        cursor.execute(anchor_query, (anchor_id,))
+        anchor = cursor.fetchone()
+    # Если якорь не найден (например, запись удалена), начинаем с первой страницы
+    backward = anchor is not None and after_id is None
+
+    # Назад идем в обратном порядке и затем разворачиваем страницу
+    reverse = descending != backward
+    direction = 'DESC' if reverse else 'ASC'
+    order = ', '.join(f'{column} {direction}' for column in key)
+    where, params = '', ()
+    if anchor is not None:
+        placeholders = ', '.join('?' * len(key))
+        where = f"WHERE ({', '.join(key)}) {'<' if reverse else '>'} ({placeholders})"
+        params = tuple(anchor)
+
+    # Лишняя строка показывает, есть ли продолжение
+    cursor.execute(f"{query} {where} ORDER BY {order} LIMIT ?", (*params, limit + 1))
+    rows = cursor.fetchall()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if backward:
+        rows.reverse()
+        return rows, has_more, True
+    return rows, anchor is not None, has_more
+
+
+def get_tools_page(after_id: Optional[int] = None, before_id: Optional[int] = None, limit: int = 10):
+    """
+    Страница списка инструментов по названию: (id, name, quantity, issued_count)
+    Returns tuple: (rows, has_prev, has_next)
+    """
+    try:
+        with DatabaseConnection() as db:
+            return _keyset_page(
+                db.cursor,
+                """
+                SELECT t.id, t.name, t.quantity, t.reserved
+                FROM tools t
+                """,
+                ('t.name', 't.id'),
+                'SELECT name, id FROM tools WHERE id = ?',
+                after_id, before_id, limit
+            )
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка при получении страницы инструментов: {e}")
+        return [], False, False
+
+
+def issue_tool_for_period(tool_id: int, employee_name: str, issue_date, return_date,
+                          chat_id: Optional[int] = None) -> int:
+    """
+    Выдает единицу инструмента сотруднику на заданный срок.
+    chat_id - чат сотрудника для напоминания о возврате.
+    Returns int: id выдачи. Выбрасывает ValueError, если свободных единиц больше нет.
+    """
+    return run_write(
+        lambda cursor: open_loan(cursor, tool_id, employee_name, issue_date, return_date, chat_id),
+        lambda _: inventory.apply(tool_id, issued_delta=1)
+    )
+
+
+def get_tools_for_return():
+    """
+    Открытые выдачи, ожидающие возврата
+    Returns list: [(issue_id, tool_name, employee_name, issue_date)]
+    """
+    try:
+        with DatabaseConnection() as db:
+            db.cursor.execute("""
+                SELECT it.id, t.name, it.employee_name, it.issue_date 
+                FROM issued_tools it
+                JOIN tools t ON t.id = it.tool_id
+                WHERE it.return_date IS NULL
+                ORDER BY it.id
+            """)
+            return db.cursor.fetchall()
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка при получении инструментов для возврата: {e}")
+        return []
+
+
+def return_tool_with_photo(issue_id: int, photo_id: str, return_date):
+    """
+    Оформляет возврат по выдаче с фотографией.
+    Returns tuple: (employee_name, issue_date)
+    Выбрасывает ValueError, если выдача уже закрыта.
+    """
+    def _write(cursor):
+        loan = close_loan(cursor, issue_id, return_date, photo_id)
+        if loan is None:
+            raise ValueError("Инструмент уже возвращен")
+        return loan
+
+    loan = run_write(_write, lambda loan: inventory.apply(loan[0], issued_delta=-1))
+    return loan[1], loan[2]
+
+
+def get_recent_history(limit: int = 20):
+    """Получает последние операции с инструментами"""
+    try:
+        with DatabaseConnection() as db:
+            db.cursor.execute("""
+                SELECT t.name, th.action, th.employee_name, th.timestamp
+                FROM tool_history th
+                JOIN tools t ON th.tool_id = t.id
+                ORDER BY th.timestamp DESC
+                LIMIT ?
+            """, (limit,))
+            return db.cursor.fetchall()
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка при получении последних операций: {e}")
+        return []
+
+
+def get_history_page(after_id: Optional[int] = None, before_id: Optional[int] = None, limit: int = 20):
+    """
+    Страница истории операций, новые сначала: (id, name, action, employee_name, timestamp)
+    Returns tuple: (rows, has_prev, has_next)
+    """
+    try:
+        with DatabaseConnection() as db:
+            return _keyset_page(
+                db.cursor,
+                """
+                SELECT th.id, t.name, th.action, th.employee_name, th.timestamp
+                FROM tool_history th
+                JOIN tools t ON th.tool_id = t.id
+                """,
+                ('th.timestamp', 'th.id'),
+                'SELECT timestamp, id FROM tool_history WHERE id = ?',
+                after_id, before_id, limit,
+                descending=True
+            )
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка при получении страницы истории: {e}")
+        return [], False, False
+
+
+def get_report_stats():
+    """
+    Собирает данные для отчета по инструментам из сводных таблиц (не зависит от объема истории)
+    Returns tuple: (stats, top_tools, overdue, activity)
+    activity: {дней: (выдач, возвратов)} за последние 7 и 30 дней
+    """
+    with DatabaseConnection() as db:
+        # Общая статистика
+        db.cursor.execute("""
+            SELECT tool_types, total_quantity, issued_now
+            FROM stats_totals
+            WHERE id = 1
+        """)
+        stats = db.cursor.fetchone() or (0, 0, 0)
+        
+        # Топ выдаваемых инструментов: первые строки индекса по числу выдач
+        db.cursor.execute("""
+            SELECT t.name, s.issue_count
+            FROM tool_stats s
+            JOIN tools t ON s.tool_id = t.id
+            WHERE s.issue_count > 0
+            ORDER BY s.issue_count DESC
+            LIMIT 5
+        """)
+        top_tools = db.cursor.fetchall()
+        
+        # Просроченные инструменты
+        db.cursor.execute("""
+            SELECT t.name, it.employee_name, it.expected_return_date
+            FROM issued_tools it
+            JOIN tools t ON it.tool_id = t.id
+            WHERE it.return_date IS NULL 
+            AND it.expected_return_date < date('now')
+        """)
+        overdue = db.cursor.fetchall()
+        
+        # Активность за последние дни: не больше 30 строк по дням
+        activity = {}
+        for days in (7, 30):
+            db.cursor.execute("""
+                SELECT COALESCE(SUM(issued), 0), COALESCE(SUM(returned), 0)
+                FROM daily_activity
+                WHERE day > date('now', ?)
+            """, (f'-{days} days',))
+            activity[days] = db.cursor.fetchone()
+        
+        return stats, top_tools, overdue, activity
+
+
+def get_pending_due_dates(since=None, until=None):
+    """
+    Сроки возврата открытых выдач без напоминания в интервале [since, until), по индексу
+    Returns list: [expected_return_date]
+    """
+    conditions, params = [], []
+    if since is not None:
+        conditions.append('expected_return_date >= ?')
+        params.append(str(since))
+    if until is not None:
+        conditions.append('expected_return_date < ?')
+        params.append(str(until))
+    where = ''.join(f' AND {condition}' for condition in conditions)
+    with DatabaseConnection() as db:
+        db.cursor.execute(f"""
+            SELECT expected_return_date
+            FROM issued_tools
+            WHERE return_date IS NULL AND overdue_notified_at IS NULL
+            AND expected_return_date IS NOT NULL{where}
+        """, params)
+        return [row[0] for row in db.cursor.fetchall()]
+
+
+def claim_overdue_loans(now):
+    """
+    Находит выдачи, срок возврата которых наступил к now и о которых еще не напоминали,
+    и отмечает их в той же транзакции, чтобы напоминание ушло один раз.
+    Returns list: [(issue_id, tool_name, employee_name, chat_id, expected_return_date)]
+    """
+    def _write(cursor):
+        cursor.execute("""
+            SELECT it.id, t.name, it.employee_name, it.chat_id, it.expected_return_date
+            FROM issued_tools it
+            JOIN tools t ON it.tool_id = t.id
+            WHERE it.return_date IS NULL AND it.overdue_notified_at IS NULL
+            AND it.expected_return_date <= ?
+            ORDER BY it.expected_return_date
+        """, (str(now),))
+        loans = cursor.fetchall()
+        cursor.executemany(
+            "UPDATE issued_tools SET overdue_notified_at = ? WHERE id = ?",
+            [(str(now), loan[0]) for loan in loans]
+        )
+        return loans
+
+    return run_write(_write)
+
+
+def get_pending_return_photos(limit: int = 1000):
+    """
+    file_id фото возврата, еще не сохраненных в хранилище, по частичному индексу
+    Returns list: [file_id]
+    """
+    with DatabaseConnection() as db:
+        db.cursor.execute("""
+            SELECT DISTINCT return_photo
+            FROM issued_tools
+            WHERE return_photo IS NOT NULL AND return_photo_sha IS NULL
+            LIMIT ?
+        """, (limit,))
+        return [row[0] for row in db.cursor.fetchall()]
+
+
+def save_media(sha256: str, size: int, has_thumbnail: bool, file_id: Optional[str] = None):
+    """
+    Регистрирует файл хранилища; если передан file_id фото возврата,
+    связывает с ним выдачи. Повторная регистрация того же содержимого ничего не меняет.
+    """
+    def _write(cursor):
+        cursor.execute("""
+            INSERT INTO media (sha256, size, has_thumbnail) VALUES (?, ?, ?)
+            ON CONFLICT(sha256) DO UPDATE SET has_thumbnail = MAX(has_thumbnail, excluded.has_thumbnail)
+        """, (sha256, size, int(has_thumbnail)))
+        if file_id is not None:
+            cursor.execute("""
+                UPDATE issued_tools SET return_photo_sha = ?
+                WHERE return_photo = ? AND return_photo_sha IS NULL
+            """, (sha256, file_id))
+
+    run_write(_write)
+
+
+def get_telegram_file_ids():
+    """Все сохраненные file_id: {sha256: file_id}"""
+    with DatabaseConnection() as db:
+        db.cursor.execute("SELECT sha256, file_id FROM telegram_files")
+        return dict(db.cursor.fetchall())
+
+
+def save_telegram_file_id(sha256: str, file_id: Optional[str]):
+    """Сохраняет file_id загруженного файла; None - удаляет устаревший"""
+    def _write(cursor):
+        if file_id is None:
+            cursor.execute("DELETE FROM telegram_files WHERE sha256 = ?", (sha256,))
+        else:
+            cursor.execute("""
+                INSERT INTO telegram_files (sha256, file_id, updated_at)
+                VALUES (?, ?, CURRENT_TIMESTAMP)
+                ON CONFLICT(sha256) DO UPDATE SET
+                    file_id = excluded.file_id, updated_at = excluded.updated_at
+            """, (sha256, file_id))
+
+    run_write(_write)
+
+
+def get_overdue_report():
+    """Получает просроченные инструменты с количеством дней просрочки"""
+    try:
+        with DatabaseConnection() as db:
+            db.cursor.execute("""
+                SELECT 
+                    t.name,
+                    it.employee_name,
+                    it.issue_date,
+                    it.expected_return_date,
+                    julianday('now') - julianday(it.expected_return_date) as days_overdue
+                FROM issued_tools it
+                JOIN tools t ON it.tool_id = t.id
+                WHERE it.return_date IS NULL 
+                AND it.expected_return_date < date('now')
+                ORDER BY days_overdue DESC
+            """)
+            return db.cursor.fetchall()
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка при получении отчета о просрочках: {e}")
+        return []
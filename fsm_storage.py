@@ -0,0 +1,264 @@
+import asyncio
+import copy
+import json
+import logging
+import os
+import time
+import typing
+
+from aiogram.dispatcher.storage import BaseStorage
+
+from async_db import repo
+from db import DatabaseConnection, get_write_queue
+
+logger = logging.getLogger(__name__)
+
+# Время жизни состояния диалога без активности, секунды
+FSM_STATE_TTL = int(os.getenv('FSM_STATE_TTL', str(24 * 60 * 60)))
+
+# Как часто удалять просроченные состояния, секунды
+FSM_REAP_INTERVAL = int(os.getenv('FSM_REAP_INTERVAL', '300'))
+
+
+def _dumps(value):
+    """Компактная сериализация данных состояния; пустые значения не храним"""
+    if not value:
+        return None
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':'))
+
+
+def _loads(value):
+    return json.loads(value) if value else {}
+
+
+def _load_states(now):
+    with DatabaseConnection() as db:
+        db.cursor.execute(
+            'SELECT chat_id, user_id, state, data, bucket, expires_at FROM fsm_states WHERE expires_at > ?',
+            (now,)
+        )
+        return db.cursor.fetchall()
+
+
+def _save_state(cursor, chat, user, state, data, bucket, expires_at):
+    cursor.execute('''
+        INSERT INTO fsm_states (chat_id, user_id, state, data, bucket, expires_at)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT(chat_id, user_id) DO UPDATE SET
+            state = excluded.state, data = excluded.data,
+            bucket = excluded.bucket, expires_at = excluded.expires_at
+    ''', (chat, user, state, data, bucket, expires_at))
+
+
+def _delete_state(cursor, chat, user):
+    cursor.execute('DELETE FROM fsm_states WHERE chat_id = ? AND user_id = ?', (chat, user))
+
+
+def _delete_expired(cursor, now):
+    cursor.execute('DELETE FROM fsm_states WHERE expires_at <= ?', (now,))
+    return cursor.rowcount
+
+
+async def _write(job):
+    """
+    Ставит задачу в очередь записи прямо из цикла событий и ждет коммита.
+    Задачи попадают в очередь в порядке вызова, поэтому записи одного диалога не переставляются.
+    """
+    return await asyncio.wrap_future(get_write_queue().submit(job))
+
+
+class SQLiteStorage(BaseStorage):
+    """
+    Хранилище состояний диалогов в таблице fsm_states базы tools.db.
+    Все живые состояния держатся в памяти (загружаются при первом обращении),
+    поэтому чтение не обращается к базе; запись сквозная, через очередь записи.
+    Состояние без активности дольше TTL считается сброшенным и удаляется фоновой задачей.
+    """
+
+    def __init__(self, default_ttl=FSM_STATE_TTL, state_ttl=None, reap_interval=FSM_REAP_INTERVAL):
+        # state_ttl: {'Группа:состояние' или 'Группа': секунды}
+        self.default_ttl = default_ttl
+        self.state_ttl = dict(state_ttl or {})
+        self.reap_interval = reap_interval
+        self._records = None  # (chat, user) -> [state, data, bucket, expires_at]
+        self._load_lock = asyncio.Lock()
+        self._reaper = None
+        self._stats = {'reads': 0, 'writes': 0, 'expired': 0}
+
+    def ttl_for(self, state: typing.Optional[str]) -> int:
+        """TTL состояния: точное совпадение, затем группа состояний, затем значение по умолчанию"""
+        if state:
+            if state in self.state_ttl:
+                return self.state_ttl[state]
+            group = state.split(':', 1)[0]
+            if group in self.state_ttl:
+                return self.state_ttl[group]
+        return self.default_ttl
+
+    async def _load(self):
+        if self._records is not None:
+            return
+        async with self._load_lock:
+            if self._records is not None:
+                return
+            rows = await repo.run(_load_states, time.time())
+            self._records = {
+                (chat, user): [state, _loads(data), _loads(bucket), expires_at]
+                for chat, user, state, data, bucket, expires_at in rows
+            }
+            logger.info(f"Состояния диалогов загружены: {len(self._records)}")
+
+    async def _get(self, chat, user):
+        await self._load()
+        self._stats['reads'] += 1
+        key = tuple(map(str, self.check_address(chat=chat, user=user)))
+        record = self._records.get(key)
+        if record is not None and record[3] <= time.time():
+            # Просрочено: из базы запись удалит фоновая задача
+            del self._records[key]
+            self._stats['expired'] += 1
+            record = None
+        return key, record
+
+    async def _put(self, key, state, data, bucket):
+        self._stats['writes'] += 1
+        chat, user = key
+        if state is None and not data and not bucket:
+            if self._records.pop(key, None) is not None:
+                await _write(lambda cursor: _delete_state(cursor, chat, user))
+            return
+        expires_at = time.time() + self.ttl_for(state)
+        self._records[key] = [state, data, bucket, expires_at]
+        data, bucket = _dumps(data), _dumps(bucket)
+        await _write(lambda cursor: _save_state(cursor, chat, user, state, data, bucket, expires_at))
+
+    async def get_state(self, *,
+                        chat: typing.Union[str, int, None] = None,
+                        user: typing.Union[str, int, None] = None,
+                        default: typing.Optional[str] = None) -> typing.Optional[str]:
+        _, record = await self._get(chat, user)
+        if record is None or record[0] is None:
+            return self.resolve_state(default)
+        return record[0]
+
+    async def get_data(self, *,
+                       chat: typing.Union[str, int, None] = None,
+                       user: typing.Union[str, int, None] = None,
+                       default: typing.Optional[typing.Dict] = None) -> typing.Dict:
+        _, record = await self._get(chat, user)
+        if record is None:
+            return copy.deepcopy(default or {})
+        return copy.deepcopy(record[1])
+
+    async def set_state(self, *,
+                        chat: typing.Union[str, int, None] = None,
+                        user: typing.Union[str, int, None] = None,
+                        state: typing.AnyStr = None):
+        key, record = await self._get(chat, user)
+        data, bucket = (record[1], record[2]) if record else ({}, {})
+        await self._put(key, self.resolve_state(state), data, bucket)
+
+    async def set_data(self, *,
+                       chat: typing.Union[str, int, None] = None,
+                       user: typing.Union[str, int, None] = None,
+                       data: typing.Dict = None):
+        key, record = await self._get(chat, user)
+        state, bucket = (record[0], record[2]) if record else (None, {})
+        await self._put(key, state, copy.deepcopy(data or {}), bucket)
+
+    async def update_data(self, *,
+                          chat: typing.Union[str, int, None] = None,
+                          user: typing.Union[str, int, None] = None,
+                          data: typing.Dict = None, **kwargs):
+        key, record = await self._get(chat, user)
+        state, current, bucket = (record[0], dict(record[1]), record[2]) if record else (None, {}, {})
+        current.update(data or {}, **kwargs)
+        await self._put(key, state, current, bucket)
+
+    async def reset_state(self, *,
+                          chat: typing.Union[str, int, None] = None,
+                          user: typing.Union[str, int, None] = None,
+                          with_data: typing.Optional[bool] = True):
+        # Одна запись вместо set_state + set_data из BaseStorage
+        key, record = await self._get(chat, user)
+        data, bucket = (record[1], record[2]) if record else ({}, {})
+        await self._put(key, None, {} if with_data else data, bucket)
+
+    def has_bucket(self):
+        return True
+
+    async def get_bucket(self, *,
+                         chat: typing.Union[str, int, None] = None,
+                         user: typing.Union[str, int, None] = None,
+                         default: typing.Optional[dict] = None) -> typing.Dict:
+        _, record = await self._get(chat, user)
+        if record is None:
+            return copy.deepcopy(default or {})
+        return copy.deepcopy(record[2])
+
+    async def set_bucket(self, *,
+                         chat: typing.Union[str, int, None] = None,
+                         user: typing.Union[str, int, None] = None,
+                         bucket: typing.Dict = None):
+        key, record = await self._get(chat, user)
+        state, data = (record[0], record[1]) if record else (None, {})
+        await self._put(key, state, data, copy.deepcopy(bucket or {}))
+
+    async def update_bucket(self, *,
+                            chat: typing.Union[str, int, None] = None,
+                            user: typing.Union[str, int, None] = None,
+                            bucket: typing.Dict = None, **kwargs):
+        key, record = await self._get(chat, user)
+        state, data, current = (record[0], record[1], dict(record[2])) if record else (None, {}, {})
+        current.update(bucket or {}, **kwargs)
+        await self._put(key, state, data, current)
+
+    async def reap(self) -> int:
+        """Удаляет просроченные состояния из памяти и базы; возвращает количество удаленных записей"""
+        await self._load()
+        now = time.time()
+        for key in [key for key, record in self._records.items() if record[3] <= now]:
+            del self._records[key]
+            self._stats['expired'] += 1
+        removed = await _write(lambda cursor: _delete_expired(cursor, now))
+        if removed:
+            logger.info(f"Удалено просроченных состояний диалогов: {removed}")
+        return removed
+
+    async def _reap_forever(self):
+        while True:
+            await asyncio.sleep(self.reap_interval)
+            try:
+                await self.reap()
+            except Exception as e:
+                logger.error(f"Ошибка при удалении просроченных состояний: {e}")
+
+    async def start(self):
+        """Загружает состояния и запускает фоновое удаление просроченных"""
+        await self._load()
+        if self._reaper is None:
+            self._reaper = asyncio.create_task(self._reap_forever())
+
+    async def close(self):
+        if self._reaper is not None:
+            self._reaper.cancel()
+
+    async def wait_closed(self):
+        if self._reaper is not None:
+            await asyncio.gather(self._reaper, return_exceptions=True)
+            self._reaper = None
+
+    def state_counts(self):
+        """Сколько диалогов сейчас в каждом состоянии (без просроченных): {состояние: количество}"""
+        now = time.time()
+        counts = {}
+        for state, _, _, expires_at in list((self._records or {}).values()):
+            if state and expires_at > now:
+                counts[state] = counts.get(state, 0) + 1
+        return counts
+
+    def get_stats(self):
+        """Возвращает счетчики чтений, записей и просроченных состояний"""
+        stats = dict(self._stats)
+        stats['active'] = len(self._records) if self._records is not None else 0
+        return stats
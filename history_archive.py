@@ -0,0 +1,316 @@
+import asyncio
+import glob
+import logging
+import os
+import re
+import shutil
+import sqlite3
+import stat
+import threading
+from datetime import datetime
+from typing import Optional
+
+import db
+from async_db import repo
+
+logger = logging.getLogger(__name__)
+
+# Каталог архивов истории; по умолчанию - рядом с tools.db
+HISTORY_ARCHIVE_DIR = os.getenv('HISTORY_ARCHIVE_DIR')
+
+# Сколько последних месяцев (включая текущий) история хранится в tools.db
+HISTORY_HOT_MONTHS = int(os.getenv('HISTORY_HOT_MONTHS', '3'))
+
+# Сколько месяцев хранить историю вообще; 0 - хранить всегда
+HISTORY_RETENTION_MONTHS = int(os.getenv('HISTORY_RETENTION_MONTHS', '0'))
+
+# Сколько строк переносить и удалять за одну транзакцию
+HISTORY_ARCHIVE_BATCH = int(os.getenv('HISTORY_ARCHIVE_BATCH', '5000'))
+
+# Как часто проверять, не пора ли архивировать, секунды
+HISTORY_ARCHIVE_INTERVAL = int(os.getenv('HISTORY_ARCHIVE_INTERVAL', str(24 * 60 * 60)))
+
+_ARCHIVE_NAME = re.compile(r'tool_history_(\d{4})_(\d{2})\.db$')
+
+# Архив месяца: отдельная база только для чтения. Название инструмента сохраняется
+# на момент архивации, чтобы архив не зависел от дальнейших изменений tools
+_ARCHIVE_SCHEMA = [
+    '''
+    CREATE TABLE IF NOT EXISTS tool_history (
+        id INTEGER PRIMARY KEY,
+        tool_id INTEGER,
+        tool_name TEXT,
+        action TEXT NOT NULL,
+        employee_name TEXT,
+        timestamp DATETIME,
+        notes TEXT
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS idx_tool_history_timestamp ON tool_history(timestamp, id)',
+    'CREATE INDEX IF NOT EXISTS idx_tool_history_tool ON tool_history(tool_id, timestamp)',
+    'CREATE INDEX IF NOT EXISTS idx_tool_history_employee ON tool_history(employee_name, timestamp)',
+]
+
+
+def archive_dir() -> str:
+    return HISTORY_ARCHIVE_DIR or os.path.join(os.path.dirname(db.DB_PATH), 'history_archive')
+
+
+def _month_start(year, month) -> str:
+    return f'{year:04d}-{month:02d}-01'
+
+
+def _shift_month(year, month, delta):
+    index = year * 12 + (month - 1) + delta
+    return index // 12, index % 12 + 1
+
+
+def archive_path(year, month) -> str:
+    return os.path.join(archive_dir(), f'tool_history_{year:04d}_{month:02d}.db')
+
+
+def list_archives():
+    """Архивы по месяцам, новые сначала: [((год, месяц), путь)]"""
+    archives = []
+    for path in glob.glob(os.path.join(archive_dir(), 'tool_history_*.db')):
+        match = _ARCHIVE_NAME.search(path)
+        if match:
+            archives.append(((int(match.group(1)), int(match.group(2))), path))
+    return sorted(archives, reverse=True)
+
+
+# Открытые архивы в каждом потоке базы данных: path -> (inode, mtime, соединение)
+_archives = threading.local()
+
+
+def _open_archive(path):
+    """
+    Соединение с архивом только для чтения; immutable - без блокировок и журнала.
+    Соединения переиспользуются в потоке, пока архив не подменен новой версией.
+    """
+    opened = getattr(_archives, 'connections', None)
+    if opened is None:
+        opened = _archives.connections = {}
+    info = os.stat(path)
+    version = (info.st_ino, info.st_mtime_ns)
+    cached = opened.get(path)
+    if cached is not None:
+        if cached[0] == version:
+            return cached[1]
+        cached[1].close()
+    conn = sqlite3.connect(f'file:{path}?mode=ro&immutable=1', uri=True)
+    opened[path] = (version, conn)
+    return conn
+
+
+def _history_filter(tool_id=None, employee_name=None, since=None, until=None, prefix=''):
+    """Условие WHERE и параметры для выборки истории по инструменту, сотруднику и датам"""
+    conditions, params = [], []
+    if tool_id is not None:
+        conditions.append(f'{prefix}tool_id = ?')
+        params.append(tool_id)
+    if employee_name is not None:
+        conditions.append(f'{prefix}employee_name = ?')
+        params.append(employee_name)
+    if since is not None:
+        conditions.append(f'{prefix}timestamp >= ?')
+        params.append(str(since))
+    if until is not None:
+        conditions.append(f'{prefix}timestamp < ?')
+        params.append(str(until))
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+    return where, params
+
+
+def query_history(tool_id: Optional[int] = None, employee_name: Optional[str] = None,
+                  since=None, until=None, limit: int = 100):
+    """
+    История операций из tools.db и архивов, новые сначала:
+    (name, action, timestamp, employee_name, notes).
+    since включительно, until не включительно. Архивы за месяцы вне [since, until)
+    не открываются; просмотр останавливается, как только набрано limit строк.
+    """
+    where, params = _history_filter(tool_id, employee_name, since, until, prefix='th.')
+    with db.DatabaseConnection() as conn:
+        conn.cursor.execute(f'''
+            SELECT th.timestamp, th.id, t.name, th.action, th.employee_name, th.notes
+            FROM tool_history th
+            JOIN tools t ON th.tool_id = t.id
+            {where}
+            ORDER BY th.timestamp DESC, th.id DESC
+            LIMIT ?
+        ''', (*params, limit))
+        rows = conn.cursor.fetchall()
+
+    where, params = _history_filter(tool_id, employee_name, since, until)
+    since_month = str(since)[:7] if since is not None else None
+    until_month = str(until)[:7] if until is not None else None
+    archived = 0
+    for (year, month), path in list_archives():
+        month_key = f'{year:04d}-{month:02d}'
+        if until_month is not None and month_key > until_month:
+            continue
+        if since_month is not None and month_key < since_month:
+            break
+        # Архивы идут от новых к старым: набрали limit - более старые месяцы не нужны
+        if archived >= limit:
+            break
+        found = _open_archive(path).execute(f'''
+            SELECT timestamp, id, tool_name, action, employee_name, notes
+            FROM tool_history
+            {where}
+            ORDER BY timestamp DESC, id DESC
+            LIMIT ?
+        ''', (*params, limit)).fetchall()
+        archived += len(found)
+        rows.extend(found)
+
+    rows.sort(key=lambda row: (row[0], row[1]), reverse=True)
+    return [(name, action, timestamp, employee, notes)
+            for timestamp, _, name, action, employee, notes in rows[:limit]]
+
+
+def archive_month(year, month) -> int:
+    """
+    Переносит историю месяца из tools.db в архив этого месяца.
+    Архив собирается во временном файле и атомарно подменяет прежний, поэтому
+    читатели всегда видят целый архив. Сначала строки копируются в архив
+    (повторное копирование безопасно), затем удаляются из tools.db пачками
+    через очередь записи - только скопированные, поэтому записи, добавленные
+    во время архивации, не теряются.
+    Возвращает количество перенесенных строк.
+    """
+    start = _month_start(year, month)
+    end = _month_start(*_shift_month(year, month, 1))
+    path = archive_path(year, month)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    building = f'{path}.tmp'
+    if os.path.exists(path):
+        shutil.copyfile(path, building)
+    elif os.path.exists(building):
+        os.remove(building)
+    archive = sqlite3.connect(building)
+    try:
+        for statement in _ARCHIVE_SCHEMA:
+            archive.execute(statement)
+        # Копируем пачками по id из одного снимка tools.db (чтение в WAL не блокирует запись)
+        copied, max_id = 0, 0
+        with db.DatabaseConnection() as conn:
+            conn.cursor.execute('''
+                SELECT th.id, th.tool_id, t.name, th.action, th.employee_name, th.timestamp, th.notes
+                FROM tool_history th
+                LEFT JOIN tools t ON th.tool_id = t.id
+                WHERE th.timestamp >= ? AND th.timestamp < ?
+                ORDER BY th.id
+            ''', (start, end))
+            while True:
+                rows = conn.cursor.fetchmany(HISTORY_ARCHIVE_BATCH)
+                if not rows:
+                    break
+                archive.executemany(
+                    'INSERT OR IGNORE INTO tool_history VALUES (?, ?, ?, ?, ?, ?, ?)', rows
+                )
+                copied += len(rows)
+                max_id = rows[-1][0]
+        archive.commit()
+        # Архив больше не меняется: без журнала WAL, плотно упакован, со статистикой для планировщика
+        archive.execute('PRAGMA journal_mode = DELETE')
+        archive.execute('ANALYZE')
+        archive.execute('VACUUM')
+    finally:
+        archive.close()
+    if not copied:
+        os.remove(building)
+        return 0
+    os.chmod(building, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+    os.replace(building, path)
+
+    def _delete_batch(cursor):
+        cursor.execute('''
+            DELETE FROM tool_history
+            WHERE id IN (
+                SELECT id FROM tool_history
+                WHERE timestamp >= ? AND timestamp < ? AND id <= ?
+                LIMIT ?
+            )
+        ''', (start, end, max_id, HISTORY_ARCHIVE_BATCH))
+        return cursor.rowcount
+
+    # Удаляем пачками, чтобы не задерживать другие записи надолго
+    while db.run_write(_delete_batch):
+        pass
+    logger.info(f"История за {year:04d}-{month:02d} перенесена в архив: {copied} записей")
+    return copied
+
+
+def apply_retention(now: Optional[datetime] = None) -> int:
+    """Удаляет архивы старше HISTORY_RETENTION_MONTHS; возвращает количество удаленных"""
+    if HISTORY_RETENTION_MONTHS <= 0:
+        return 0
+    now = now or datetime.now()
+    oldest = _shift_month(now.year, now.month, -(HISTORY_RETENTION_MONTHS - 1))
+    removed = 0
+    for month, path in list_archives():
+        if month < oldest:
+            os.remove(path)
+            removed += 1
+            logger.info(f"Архив истории {os.path.basename(path)} удален по сроку хранения")
+    return removed
+
+
+def archive_history(now: Optional[datetime] = None):
+    """
+    Переносит в архивы все месяцы старше окна HISTORY_HOT_MONTHS и применяет срок хранения.
+    Returns dict: {'archived': строк, 'months': месяцев, 'removed': удалено архивов}
+    """
+    now = now or datetime.now()
+    hot_start = _month_start(*_shift_month(now.year, now.month, -(HISTORY_HOT_MONTHS - 1)))
+    with db.DatabaseConnection() as conn:
+        # Месяцы по индексу timestamp: первая и последняя запись до начала окна
+        conn.cursor.execute(
+            'SELECT MIN(timestamp), MAX(timestamp) FROM tool_history WHERE timestamp < ?',
+            (hot_start,)
+        )
+        first, last = conn.cursor.fetchone()
+
+    result = {'archived': 0, 'months': 0, 'removed': 0}
+    if first is not None:
+        year, month = int(first[:4]), int(first[5:7])
+        last_month = (int(last[:4]), int(last[5:7]))
+        while (year, month) <= last_month:
+            moved = archive_month(year, month)
+            if moved:
+                result['archived'] += moved
+                result['months'] += 1
+            year, month = _shift_month(year, month, 1)
+    result['removed'] = apply_retention(now)
+    return result
+
+
+class HistoryArchiver:
+    """Фоновая архивация истории: при запуске и затем раз в interval секунд"""
+
+    def __init__(self, interval=HISTORY_ARCHIVE_INTERVAL):
+        self.interval = interval
+        self._task = None
+
+    async def _archive_forever(self):
+        while True:
+            try:
+                result = await repo.run(archive_history)
+                if result['archived'] or result['removed']:
+                    logger.info(f"Архивация истории: {result}")
+            except Exception as e:
+                logger.error(f"Ошибка при архивации истории: {e}")
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._archive_forever())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
@@ -0,0 +1,173 @@
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+
+from db import DatabaseConnection, INVENTORY_SYNC_INTERVAL, create_tables
+
+# Количество строк в одном executemany
+IMPORT_BATCH_SIZE = int(os.getenv('IMPORT_BATCH_SIZE', '5000'))
+
+# Пачка сначала попадает во временную таблицу, затем сливается с tools двумя запросами
+_CREATE_BATCH_TABLE = '''
+    CREATE TEMP TABLE IF NOT EXISTS import_batch (
+        name TEXT PRIMARY KEY,
+        quantity INTEGER,
+        description TEXT
+    ) WITHOUT ROWID
+'''
+
+# Обновляем тип инструмента с таким названием, остальные данные не трогаем.
+# Количество не опускается ниже числа выданных единиц
+_UPDATE_QUERY = '''
+    UPDATE tools
+    SET quantity = MAX(COALESCE(b.quantity, tools.quantity), tools.reserved),
+        description = COALESCE(b.description, tools.description)
+    FROM import_batch b
+    WHERE tools.name = b.name
+'''
+
+_INSERT_QUERY = '''
+    INSERT INTO tools (name, quantity, description)
+    SELECT b.name, COALESCE(b.quantity, 1), b.description
+    FROM import_batch b
+    WHERE NOT EXISTS (SELECT 1 FROM tools t WHERE t.name = b.name)
+'''
+
+
+def read_csv(path):
+    """Читает CSV с заголовком name,quantity[,description] построчно"""
+    with open(path, newline='', encoding='utf-8-sig') as f:
+        yield from csv.DictReader(f)
+
+
+def read_jsonl(path):
+    """Читает JSONL: по одному объекту {"name", "quantity", "description"} в строке"""
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+READERS = {
+    'csv': read_csv,
+    'jsonl': read_jsonl,
+}
+
+
+def parse_record(record):
+    """Проверяет запись каталога и возвращает (name, quantity, description)"""
+    name = (record.get('name') or '').strip()
+    if not name:
+        raise ValueError("не указано название")
+    # Без количества: новый инструмент получает 1, у существующего оно не меняется
+    quantity = record.get('quantity')
+    quantity = int(quantity) if quantity not in (None, '') else None
+    if quantity is not None and quantity < 0:
+        raise ValueError(f"отрицательное количество {quantity}")
+    description = (record.get('description') or '').strip() or None
+    return name, quantity, description
+
+
+def _flush(cursor, batch):
+    """Записывает пачку {name: (quantity, description)}: возвращает (обновлено, добавлено)"""
+    cursor.executemany(
+        'INSERT INTO import_batch (name, quantity, description) VALUES (?, ?, ?)',
+        [(name, quantity, description) for name, (quantity, description) in batch.items()]
+    )
+    cursor.execute(_UPDATE_QUERY)
+    updated = cursor.rowcount
+    cursor.execute(_INSERT_QUERY)
+    inserted = cursor.rowcount
+    cursor.execute('DELETE FROM import_batch')
+    return updated, inserted
+
+
+def import_records(records, batch_size=IMPORT_BATCH_SIZE, progress=None):
+    """
+    Загружает записи каталога в таблицу tools одной транзакцией.
+    Инструмент ищется по названию: существующий обновляется, новый добавляется.
+    Записи читаются потоком, в памяти держится не больше одной пачки.
+    """
+    stats = {'rows': 0, 'updated': 0, 'inserted': 0, 'skipped': 0}
+    started = time.perf_counter()
+    create_tables()
+
+    with DatabaseConnection() as db:
+        db.cursor.execute(_CREATE_BATCH_TABLE)
+        batch = {}
+        for number, record in enumerate(records, 1):
+            try:
+                name, quantity, description = parse_record(record)
+            except (ValueError, TypeError, AttributeError) as e:
+                stats['skipped'] += 1
+                print(f"⚠️ Запись {number} пропущена: {e}")
+                continue
+            # Повтор названия внутри пачки: побеждает последняя запись
+            batch.pop(name, None)
+            batch[name] = (quantity, description)
+            stats['rows'] += 1
+
+            if len(batch) >= batch_size:
+                updated, inserted = _flush(db.cursor, batch)
+                stats['updated'] += updated
+                stats['inserted'] += inserted
+                batch.clear()
+                if progress:
+                    progress(stats, time.perf_counter() - started)
+
+        if batch:
+            updated, inserted = _flush(db.cursor, batch)
+            stats['updated'] += updated
+            stats['inserted'] += inserted
+        db.cursor.execute('DROP TABLE temp.import_batch')
+
+    stats['seconds'] = time.perf_counter() - started
+    # Кэш наличия запущенного бота сбрасывается по PRAGMA data_version (db.sync_inventory)
+    return stats
+
+
+def print_progress(stats, elapsed):
+    rate = stats['rows'] / elapsed if elapsed else 0
+    print(f"  обработано {stats['rows']} строк ({rate:.0f} строк/с)")
+
+
+def detect_format(path):
+    extension = os.path.splitext(path)[1].lstrip('.').lower()
+    if extension == 'ndjson':
+        return 'jsonl'
+    return extension
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Массовый импорт каталога инструментов")
+    parser.add_argument('path', help="файл каталога (.csv или .jsonl)")
+    parser.add_argument('--format', choices=sorted(READERS),
+                        help="формат файла, по умолчанию определяется по расширению")
+    parser.add_argument('--batch-size', type=int, default=IMPORT_BATCH_SIZE)
+    args = parser.parse_args()
+
+    file_format = args.format or detect_format(args.path)
+    if file_format not in READERS:
+        parser.error(f"неизвестный формат файла: {args.path}")
+
+    print(f"Импорт {args.path} ({file_format})...")
+    try:
+        stats = import_records(READERS[file_format](args.path), args.batch_size, print_progress)
+    except (OSError, ValueError, csv.Error) as e:
+        print(f"❌ Ошибка импорта, изменения отменены: {e}")
+        sys.exit(1)
+
+    rate = stats['rows'] / stats['seconds'] if stats['seconds'] else 0
+    print(
+        f"✅ Импорт завершен за {stats['seconds']:.1f}с ({rate:.0f} строк/с): "
+        f"добавлено {stats['inserted']}, обновлено {stats['updated']}, пропущено {stats['skipped']}"
+    )
+    print(f"Запущенный бот подхватит изменения в течение {INVENTORY_SYNC_INTERVAL:.0f} с")
+
+
+if __name__ == "__main__":
+    main()
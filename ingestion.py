@@ -0,0 +1,279 @@
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+
+from aiogram import types
+
+from async_db import repo
+from db import get_meta, get_write_queue, set_meta
+
+logger = logging.getLogger(__name__)
+
+# Сколько обновлений обрабатывается одновременно (разных чатов)
+INGEST_WORKERS = int(os.getenv('INGEST_WORKERS', '32'))
+
+# Сколько принятых обновлений может ждать обработки
+INGEST_QUEUE_SIZE = int(os.getenv('INGEST_QUEUE_SIZE', '1000'))
+
+# Сколько секунд вебхук ждет места в переполненной очереди, прежде чем отказать
+INGEST_ENQUEUE_TIMEOUT = float(os.getenv('INGEST_ENQUEUE_TIMEOUT', '1'))
+
+# Сколько последних update_id помнится для отбрасывания повторных доставок
+DEDUP_WINDOW = int(os.getenv('DEDUP_WINDOW', '10000'))
+
+# Как часто сохранять в базу границу обработанных update_id, секунды
+DEDUP_FLUSH_INTERVAL = float(os.getenv('DEDUP_FLUSH_INTERVAL', '5'))
+
+# Сколько последних задержек хранится для перцентилей
+_LAG_WINDOW = 1000
+
+
+def update_chat_id(update: types.Update):
+    """Чат, к которому относится обновление (для упорядочивания); для прочих - отправитель"""
+    for message in (update.message, update.edited_message, update.channel_post, update.edited_channel_post):
+        if message:
+            return message.chat.id
+    if update.callback_query:
+        if update.callback_query.message:
+            return update.callback_query.message.chat.id
+        return update.callback_query.from_user.id
+    for event in (update.inline_query, update.chosen_inline_result, update.shipping_query,
+                  update.pre_checkout_query, update.my_chat_member, update.chat_member,
+                  update.chat_join_request):
+        if event and getattr(event, 'from_user', None):
+            return event.from_user.id
+    return update.update_id
+
+
+def _percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+class UpdateDeduplicator:
+    """
+    Отбрасывает повторные доставки обновлений по update_id.
+    В памяти - последние DEDUP_WINDOW принятых id (множество и очередь для вытеснения).
+    В базе (app_meta) - граница: все обновления с id не больше нее уже обработаны;
+    она защищает от повторов после перезапуска. Граница сдвигается только до
+    первого еще не обработанного id, поэтому обновления, принятые параллельно и
+    не по порядку, не теряются. Отклоненное обновление (очередь переполнена)
+    держит границу, пока Telegram не доставит его повторно и оно не будет обработано.
+    """
+
+    META_KEY = 'last_update_id'
+
+    def __init__(self, window=DEDUP_WINDOW, flush_interval=DEDUP_FLUSH_INTERVAL, meta_key=META_KEY):
+        # Каждый процесс-обработчик хранит свою границу: его обновления - только часть общего потока
+        self.meta_key = meta_key
+        self.window = window
+        self.flush_interval = flush_interval
+        self._seen = set()
+        self._order = deque()
+        self._in_progress = set()
+        self._rejected = set()  # отклонены и ждут повторной доставки
+        self._max_done = 0
+        self._floor = 0     # граница, сохраненная в базе
+        self._flusher = None
+        self._stats = {'accepted': 0, 'duplicates': 0}
+
+    def accept(self, update_id: int) -> bool:
+        """Отмечает обновление как принятое; False - если это повторная доставка"""
+        # Telegram начинает нумерацию заново со случайного id после недели без обновлений,
+        # поэтому граница из базы действует только на id чуть ниже нее
+        if update_id in self._seen or self._floor - self.window < update_id <= self._floor:
+            self._stats['duplicates'] += 1
+            return False
+        self._seen.add(update_id)
+        self._order.append(update_id)
+        if len(self._order) > self.window:
+            self._seen.discard(self._order.popleft())
+        self._in_progress.add(update_id)
+        self._stats['accepted'] += 1
+        return True
+
+    def forget(self, update_id: int):
+        """
+        Снимает отметку с обновления, которое не удалось поставить в очередь: Telegram его повторит.
+        До обработки повторной доставки граница за этот id не сдвигается.
+        """
+        self._seen.discard(update_id)
+        self._in_progress.discard(update_id)
+        self._rejected.add(update_id)
+
+    def done(self, update_id: int):
+        """Отмечает обновление обработанным (успешно или нет - повторно его не применяем)"""
+        self._in_progress.discard(update_id)
+        self._rejected.discard(update_id)
+        self._max_done = max(self._max_done, update_id)
+
+    def watermark(self) -> int:
+        """Наибольший id, до которого включительно все принятые обновления обработаны"""
+        if self._in_progress or self._rejected:
+            return max(self._floor, min(self._in_progress | self._rejected) - 1)
+        return max(self._floor, self._max_done)
+
+    async def flush(self):
+        """Сохраняет границу в базу, если она сдвинулась"""
+        watermark = self.watermark()
+        if watermark <= self._floor:
+            return
+        await asyncio.wrap_future(
+            get_write_queue().submit(lambda cursor: set_meta(cursor, self.meta_key, watermark))
+        )
+        self._floor = watermark
+
+    async def _flush_forever(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Ошибка при сохранении границы обработанных обновлений: {e}")
+
+    async def start(self):
+        """Загружает сохраненную границу и запускает ее периодическое сохранение"""
+        self._floor = int(await repo.run(get_meta, self.meta_key, '0'))
+        logger.info(f"Граница обработанных обновлений: {self._floor}")
+        if self._flusher is None:
+            self._flusher = asyncio.create_task(self._flush_forever())
+
+    async def close(self):
+        """Останавливает периодическое сохранение и сохраняет границу в последний раз"""
+        if self._flusher is not None:
+            self._flusher.cancel()
+            await asyncio.gather(self._flusher, return_exceptions=True)
+            self._flusher = None
+        await self.flush()
+
+    def get_stats(self):
+        """Счетчики принятых и повторных обновлений и текущая граница"""
+        stats = dict(self._stats)
+        stats['in_progress'] = len(self._in_progress)
+        stats['awaiting_redelivery'] = len(self._rejected)
+        stats['watermark'] = self.watermark()
+        return stats
+
+
+class UpdateQueue:
+    """
+    Очередь входящих обновлений: вебхук ставит обновление и сразу отвечает Telegram,
+    а обработка идет в пуле фоновых задач. Обновления одного чата обрабатываются
+    строго по порядку и по одному, разные чаты - параллельно (медленный чат
+    не задерживает остальные). Очередь ограничена: при переполнении submit ждет
+    и затем отказывает, и Telegram повторит доставку позже.
+    С dedup повторные доставки уже принятых обновлений отбрасываются.
+    """
+
+    def __init__(self, process, workers=INGEST_WORKERS, max_pending=INGEST_QUEUE_SIZE,
+                 enqueue_timeout=INGEST_ENQUEUE_TIMEOUT, dedup=None):
+        # process(update) - корутина обработки одного обновления
+        self._process = process
+        self.dedup = dedup
+        self.workers = workers
+        self.max_pending = max_pending
+        self.enqueue_timeout = enqueue_timeout
+        self._chats = {}       # chat_id -> deque[(update, время постановки)]; есть, пока чат в работе
+        self._ready = None     # чаты, у которых есть обновления и которые сейчас никто не обрабатывает
+        self._slots = None
+        self._pending = 0
+        self._tasks = []
+        self._lags = deque(maxlen=_LAG_WINDOW)
+        self._stats = {'enqueued': 0, 'processed': 0, 'failed': 0, 'rejected': 0}
+
+    def start(self):
+        """Запускает обработчики в текущем цикле событий"""
+        if self._tasks:
+            return
+        self._ready = asyncio.Queue()
+        self._slots = asyncio.Semaphore(self.max_pending)
+        self._tasks = [
+            asyncio.create_task(self._worker(), name=f'ingest-{number}')
+            for number in range(self.workers)
+        ]
+
+    async def submit(self, update: types.Update) -> bool:
+        """
+        Ставит обновление в очередь его чата; False, если очередь переполнена.
+        Повторная доставка уже принятого обновления отбрасывается, но считается принятой.
+        """
+        if self.dedup is not None and not self.dedup.accept(update.update_id):
+            logger.info("Повторная доставка обновления %s отброшена", update.update_id)
+            return True
+        try:
+            await asyncio.wait_for(self._slots.acquire(), self.enqueue_timeout)
+        except asyncio.TimeoutError:
+            if self.dedup is not None:
+                self.dedup.forget(update.update_id)
+            self._stats['rejected'] += 1
+            logger.warning(f"Очередь обновлений переполнена, обновление {update.update_id} отклонено")
+            return False
+        self._pending += 1
+        self._stats['enqueued'] += 1
+
+        chat_id = update_chat_id(update)
+        items = self._chats.get(chat_id)
+        if items is None:
+            items = self._chats[chat_id] = deque()
+            self._ready.put_nowait(chat_id)
+        # Иначе чат уже ждет обработчика или обрабатывается: обработчик заберет и это обновление
+        items.append((update, time.perf_counter()))
+        return True
+
+    async def _worker(self):
+        while True:
+            chat_id = await self._ready.get()
+            items = self._chats[chat_id]
+            update, enqueued_at = items.popleft()
+            self._lags.append(time.perf_counter() - enqueued_at)
+            try:
+                # Отдельная задача на каждое обновление: aiogram хранит контекст обработки
+                # (текущий update, состояние FSM) в contextvars, и он не должен переходить
+                # к следующему обновлению этого обработчика
+                await asyncio.create_task(self._process(update))
+                self._stats['processed'] += 1
+            except Exception as e:
+                self._stats['failed'] += 1
+                logger.exception(f"Ошибка при обработке обновления {update.update_id}: {e}")
+            finally:
+                if items:
+                    self._ready.put_nowait(chat_id)
+                else:
+                    del self._chats[chat_id]
+                if self.dedup is not None:
+                    self.dedup.done(update.update_id)
+                self._pending -= 1
+                self._slots.release()
+
+    async def close(self, timeout=10):
+        """Дожидается обработки поставленных обновлений (не дольше timeout) и останавливает обработчики"""
+        if not self._tasks:
+            return
+        deadline = time.monotonic() + timeout
+        while self._pending and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        if self._pending:
+            logger.warning(f"Не дождались обработки {self._pending} обновлений при остановке")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def depth(self) -> int:
+        """Количество принятых, но еще не обработанных обновлений"""
+        return self._pending
+
+    def get_stats(self):
+        """Счетчики, глубина очереди и задержка от приема до начала обработки (секунды)"""
+        lags = list(self._lags)
+        stats = dict(self._stats)
+        stats['depth'] = self._pending
+        stats['active_chats'] = len(self._chats)
+        stats['lag_p50'] = _percentile(lags, 50)
+        stats['lag_p99'] = _percentile(lags, 99)
+        stats['lag_max'] = max(lags, default=0.0)
+        return stats
@@ -0,0 +1,136 @@
+import logging
+import threading
+
+from search_index import ToolSearchIndex
+
+logger = logging.getLogger(__name__)
+
+
+class InventoryCache:
+    """
+    Кэш наличия инструментов в памяти процесса: id -> (название, всего единиц, выдано).
+    Заполняется один раз функцией loader и обновляется сквозной записью
+    из путей выдачи/возврата в db.py (после коммита, в потоке-писателе).
+    """
+
+    def __init__(self, loader):
+        # loader(install) должен вызвать install(rows) со строками (id, name, quantity, issued_count)
+        self._loader = loader
+        self._lock = threading.Lock()
+        # Загрузка выполняется одним потоком, остальные читатели ждут ее окончания
+        self._loaded = threading.Condition(self._lock)
+        self._loading = False
+        self._tools = None
+        self._sorted_ids = None
+        self._index = ToolSearchIndex()
+        self._stats = {'hits': 0, 'misses': 0, 'updates': 0, 'invalidations': 0}
+
+    def _install(self, rows):
+        tools = {
+            tool_id: [name, quantity, issued_count]
+            for tool_id, name, quantity, issued_count in rows
+        }
+        index = ToolSearchIndex()
+        index.rebuild((tool_id, entry[0]) for tool_id, entry in tools.items())
+        with self._lock:
+            self._tools = tools
+            self._sorted_ids = None
+            self._index = index
+        logger.info(f"Кэш инструментов загружен: {len(tools)} записей")
+
+    def _read(self, func):
+        """Вызывает func() под блокировкой, при необходимости загрузив кэш"""
+        while True:
+            with self._lock:
+                if self._tools is not None:
+                    self._stats['hits'] += 1
+                    return func()
+                self._stats['misses'] += 1
+                if self._loading:
+                    self._loaded.wait()
+                    continue
+                self._loading = True
+            try:
+                # Загружаем без блокировки: установка данных может идти из другого потока
+                self._loader(self._install)
+            finally:
+                with self._lock:
+                    self._loading = False
+                    self._loaded.notify_all()
+
+    def _ordered_ids(self):
+        if self._sorted_ids is None:
+            self._sorted_ids = sorted(self._tools, key=lambda tool_id: (self._tools[tool_id][0], tool_id))
+        return self._sorted_ids
+
+    def warm(self):
+        """Загружает кэш заранее"""
+        self._read(lambda: None)
+
+    def list_tools(self):
+        """Все инструменты, отсортированные по названию: (id, name, quantity, issued_count)"""
+        return self._read(lambda: [(tool_id, *self._tools[tool_id]) for tool_id in self._ordered_ids()])
+
+    def get(self, tool_id):
+        """Инструмент по ID: (id, name, quantity, issued_count) или None"""
+        def _get():
+            entry = self._tools.get(tool_id)
+            return (tool_id, *entry) if entry else None
+        return self._read(_get)
+
+    def available_tools(self):
+        """Инструменты со свободными единицами: (id, name, свободно) в порядке ID"""
+        return self._read(lambda: [
+            (tool_id, name, quantity - issued_count)
+            for tool_id, (name, quantity, issued_count) in sorted(self._tools.items())
+            if quantity > issued_count
+        ])
+
+    def search(self, query: str, limit=None):
+        """
+        Нечеткий поиск по названию (регистр, транслитерация, опечатки).
+        Возвращает (id, name, quantity, issued_count) по убыванию релевантности.
+        """
+        return self._read(lambda: [
+            (tool_id, *self._tools[tool_id])
+            for tool_id, _ in self._index.search(query, limit)
+        ])
+
+    def apply(self, tool_id, quantity_delta=0, issued_delta=0):
+        """Сквозная запись: применяет изменение количества и числа выданных единиц"""
+        with self._lock:
+            if self._tools is None:
+                return
+            entry = self._tools.get(tool_id)
+            if entry is None:
+                return
+            entry[1] += quantity_delta
+            entry[2] += issued_delta
+            self._stats['updates'] += 1
+
+    def set_tool(self, tool_id, name, quantity, issued_count):
+        """Сквозная запись: добавляет или полностью заменяет запись об инструменте"""
+        with self._lock:
+            if self._tools is None:
+                return
+            old = self._tools.get(tool_id)
+            self._tools[tool_id] = [name, quantity, issued_count]
+            if old is None or old[0] != name:
+                self._sorted_ids = None
+                self._index.add(tool_id, name)
+            self._stats['updates'] += 1
+
+    def invalidate(self):
+        """Сбрасывает кэш; следующее обращение загрузит данные заново"""
+        with self._lock:
+            self._tools = None
+            self._sorted_ids = None
+            self._index = ToolSearchIndex()
+            self._stats['invalidations'] += 1
+
+    def get_stats(self):
+        """Возвращает счетчики попаданий и промахов"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats['size'] = len(self._tools) if self._tools is not None else 0
+        return stats
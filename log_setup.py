@@ -0,0 +1,183 @@
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Уровень корневого логгера
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+
+# Сколько записей может ждать записи в поток вывода; при переполнении новые записи отбрасываются
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', '10000'))
+
+# Выборочное логирование для болтливых логгеров: "имя=доля,имя=доля",
+# например "bot.updates=0.1,throttling=0.01". WARNING и выше пишутся всегда.
+LOG_SAMPLE = os.getenv('LOG_SAMPLE', '')
+
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+# Аргументы таких типов не меняются после вызова логгера, поэтому запись можно форматировать позже
+_IMMUTABLE_ARGS = (str, int, float, bool, type(None))
+
+
+def parse_sample_rates(value: str) -> dict:
+    """Разбирает LOG_SAMPLE в {имя логгера: доля записей}"""
+    rates = {}
+    for item in value.split(','):
+        name, _, rate = item.strip().partition('=')
+        if not name or not rate:
+            continue
+        try:
+            rates[name] = min(1.0, max(0.0, float(rate)))
+        except ValueError:
+            logger.error(f"Неверная доля в LOG_SAMPLE: {item}")
+    return rates
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Пропускает каждую k-ю запись ниже WARNING (k = 1 / доля).
+    Счетчик вместо случайных чисел: дешевле и равномерно по времени.
+    Подключается к логгеру, поэтому отброшенная запись не доходит до обработчиков;
+    действует только на записи самого логгера, не дочерних.
+    """
+
+    def __init__(self, rate: float):
+        super().__init__()
+        self.every = max(1, round(1 / rate)) if rate > 0 else 0
+        self._seen = 0
+        self.dropped = 0
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        self._seen += 1
+        if self.every and self._seen % self.every == 0:
+            return True
+        self.dropped += 1
+        return False
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    Ставит запись в ограниченную очередь, не форматируя ее: сообщение собирается
+    в потоке вывода. Записи с изменяемыми аргументами (списки, объекты) форматируются
+    сразу, чтобы в лог попало значение на момент вызова. Постановка в очередь
+    никогда не ждет: при переполнении запись отбрасывается и учитывается
+    в dropped (WARNING и выше - еще и в dropped_warnings).
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+        self.dropped_warnings = 0
+
+    def prepare(self, record):
+        if record.args and not all(isinstance(arg, _IMMUTABLE_ARGS) for arg in
+                                   (record.args.values() if isinstance(record.args, dict) else record.args)):
+            record.msg = record.getMessage()
+            record.args = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            if record.levelno >= logging.WARNING:
+                self.dropped_warnings += 1
+
+
+class _QueueListener(logging.handlers.QueueListener):
+    def enqueue_sentinel(self):
+        # Очередь ограничена: сигнал остановки ждет места, а не теряется
+        self.queue.put(self._sentinel)
+
+
+class LoggingRuntime:
+    """Очередь записей лога и поток, который пишет их в обработчики вывода"""
+
+    def __init__(self, handlers, queue_size=LOG_QUEUE_SIZE, sample_rates=None):
+        self.handlers = list(handlers)
+        self.queue_handler = DeferredQueueHandler(queue.Queue(maxsize=queue_size))
+        self.listener = _QueueListener(
+            self.queue_handler.queue, *self.handlers, respect_handler_level=True
+        )
+        self.filters = {name: SamplingFilter(rate) for name, rate in (sample_rates or {}).items()}
+        self._lock = threading.Lock()
+        self._started = False
+
+    def start(self):
+        with self._lock:
+            if not self._started:
+                self.listener.start()
+                self._started = True
+
+    def stop(self):
+        """Дописывает накопленные записи и останавливает поток вывода"""
+        with self._lock:
+            if self._started:
+                self.listener.stop()
+                self._started = False
+
+    def get_stats(self):
+        """Возвращает длину очереди и количество отброшенных записей"""
+        return {
+            'queued': self.queue_handler.queue.qsize(),
+            'dropped': self.queue_handler.dropped,
+            'dropped_warnings': self.queue_handler.dropped_warnings,
+            'sampled_out': sum(sampling.dropped for sampling in self.filters.values()),
+        }
+
+
+_runtime = None
+
+
+def setup_logging(level=LOG_LEVEL, stream=None, queue_size=LOG_QUEUE_SIZE, sample=LOG_SAMPLE) -> LoggingRuntime:
+    """
+    Настраивает корневой логгер: запись через очередь в отдельном потоке
+    и выборочное логирование по LOG_SAMPLE. Повторный вызов возвращает уже настроенное.
+    """
+    global _runtime
+    if _runtime is not None:
+        return _runtime
+
+    output = logging.StreamHandler(stream)
+    output.setFormatter(logging.Formatter(LOG_FORMAT))
+    runtime = LoggingRuntime([output], queue_size, parse_sample_rates(sample))
+
+    root = logging.getLogger()
+    root.setLevel(level)
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(runtime.queue_handler)
+    for name, sampling in runtime.filters.items():
+        logging.getLogger(name).addFilter(sampling)
+
+    runtime.start()
+    atexit.register(stop_logging)
+    _runtime = runtime
+    return runtime
+
+
+def stop_logging():
+    """
+    Дописывает очередь лога; вызывается при остановке бота.
+    Дальнейшие записи идут в обработчики вывода напрямую, иначе их некому было бы читать.
+    """
+    if _runtime is None:
+        return
+    root = logging.getLogger()
+    if _runtime.queue_handler in root.handlers:
+        root.removeHandler(_runtime.queue_handler)
+        for handler in _runtime.handlers:
+            root.addHandler(handler)
+    _runtime.stop()
+
+
+def get_stats():
+    """Статистика очереди лога (пустая, если setup_logging не вызывался)"""
+    return _runtime.get_stats() if _runtime is not None else {}
@@ -0,0 +1,268 @@
+import argparse
+import asyncio
+import glob
+import hashlib
+import io
+import logging
+import os
+
+from aiogram import types
+from aiogram.utils.exceptions import BadRequest
+
+import db
+from async_db import repo
+
+try:
+    # Pillow нужен только для миниатюр; без него фото сохраняются без них
+    from PIL import Image
+except ImportError:
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+# Каталог хранилища фотографий; по умолчанию - рядом с tools.db
+MEDIA_DIR = os.getenv('MEDIA_DIR')
+
+# Наибольшая сторона миниатюры, пиксели
+MEDIA_THUMB_SIZE = int(os.getenv('MEDIA_THUMB_SIZE', '320'))
+
+# Сколько фото возврата скачивать одновременно
+MEDIA_DOWNLOAD_WORKERS = int(os.getenv('MEDIA_DOWNLOAD_WORKERS', '2'))
+
+# Картинки каталога инструментов (имена файлов - в tools.image)
+CATALOG_IMAGES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tools_images')
+
+
+def media_dir() -> str:
+    return MEDIA_DIR or os.path.join(os.path.dirname(db.DB_PATH), 'media')
+
+
+def media_path(sha256: str) -> str:
+    """Файл хранилища: первые два символа хэша - подкаталог, чтобы каталоги не разрастались"""
+    return os.path.join(media_dir(), sha256[:2], f'{sha256}.jpg')
+
+
+def thumbnail_path(sha256: str) -> str:
+    return os.path.join(media_dir(), 'thumbs', sha256[:2], f'{sha256}.jpg')
+
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _write_atomic(path: str, data: bytes):
+    """Пишет во временный файл и подменяет: читатель не увидит недописанный файл"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    building = f'{path}.{os.getpid()}.tmp'
+    with open(building, 'wb') as f:
+        f.write(data)
+    os.replace(building, path)
+
+
+def make_thumbnail(data: bytes, size: int = MEDIA_THUMB_SIZE):
+    """JPEG не больше size x size с сохранением пропорций; None без Pillow или для не-изображения"""
+    if Image is None:
+        return None
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            image.thumbnail((size, size))
+            output = io.BytesIO()
+            image.convert('RGB').save(output, 'JPEG', quality=80, optimize=True)
+            return output.getvalue()
+    except Exception as e:
+        logger.warning(f"Не удалось сделать миниатюру: {e}")
+        return None
+
+
+def store_bytes(data: bytes, file_id=None):
+    """
+    Сохраняет содержимое в хранилище под его SHA-256 и регистрирует в таблице media.
+    Одинаковое содержимое хранится один раз; миниатюра создается вместе с файлом.
+    file_id - фото возврата, с которым связать выдачи.
+    Returns tuple: (sha256, True если файл новый)
+    """
+    sha256 = hashlib.sha256(data).hexdigest()
+    path = media_path(sha256)
+    created = not os.path.exists(path)
+    if created:
+        _write_atomic(path, data)
+    thumb = thumbnail_path(sha256)
+    has_thumbnail = os.path.exists(thumb)
+    if not has_thumbnail:
+        thumbnail = make_thumbnail(data)
+        if thumbnail is not None:
+            _write_atomic(thumb, thumbnail)
+            has_thumbnail = True
+    db.save_media(sha256, len(data), has_thumbnail, file_id)
+    return sha256, created
+
+
+def import_directory(path: str):
+    """Переносит JPEG из каталога в хранилище; Returns tuple: (файлов, новых)"""
+    files = new = 0
+    for name in sorted(glob.glob(os.path.join(path, '*.jp*g'))):
+        with open(name, 'rb') as f:
+            _, created = store_bytes(f.read())
+        files += 1
+        new += created
+    return files, new
+
+
+class PhotoDownloader:
+    """
+    Фоновое скачивание фото возврата в хранилище.
+    Обработчик возврата только ставит file_id в очередь; при запуске дозагружаются
+    фото, которые не успели скачать раньше (по частичному индексу issued_tools).
+    """
+
+    def __init__(self, bot, workers=MEDIA_DOWNLOAD_WORKERS):
+        self.bot = bot
+        self.workers = workers
+        self._queue = None
+        self._queued = set()
+        self._tasks = []
+        self._stats = {'downloaded': 0, 'deduplicated': 0, 'bytes': 0, 'failed': 0}
+
+    def submit(self, file_id: str):
+        """Ставит фото в очередь на скачивание; не ждет его"""
+        if self._queue is None or file_id in self._queued:
+            return
+        self._queued.add(file_id)
+        self._queue.put_nowait(file_id)
+
+    async def _load_backlog(self):
+        try:
+            for file_id in await repo.get_pending_return_photos():
+                self.submit(file_id)
+        except Exception as e:
+            logger.error(f"Ошибка при загрузке очереди фото возврата: {e}")
+
+    async def download(self, file_id: str):
+        """Скачивает фото и сохраняет в хранилище; Returns sha256"""
+        buffer = await self.bot.download_file_by_id(file_id, destination=io.BytesIO())
+        data = buffer.getvalue()
+        sha256, created = await repo.run(store_bytes, data, file_id)
+        self._stats['downloaded' if created else 'deduplicated'] += 1
+        self._stats['bytes'] += len(data) if created else 0
+        return sha256
+
+    async def _work(self):
+        while True:
+            file_id = await self._queue.get()
+            try:
+                await self.download(file_id)
+            except Exception as e:
+                # Фото останется в очереди базы и будет скачано при следующем запуске
+                self._stats['failed'] += 1
+                logger.error(f"Не удалось скачать фото возврата {file_id}: {e}")
+            finally:
+                self._queued.discard(file_id)
+                self._queue.task_done()
+
+    def start(self, load_backlog=True):
+        """
+        Запускает скачивание в текущем цикле событий.
+        load_backlog=False: только фото, поставленные этим процессом (процессы-обработчики кроме ведущего).
+        """
+        if self._queue is None:
+            if Image is None:
+                logger.warning("Pillow не установлен: фото возврата сохраняются без миниатюр")
+            self._queue = asyncio.Queue()
+            self._tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+            if load_backlog:
+                self._tasks.append(asyncio.create_task(self._load_backlog()))
+
+    async def close(self, timeout=10):
+        """Дожидается скачивания очереди (не дольше timeout) и останавливает скачивание"""
+        if self._queue is None:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Не скачано фото возврата при остановке: {len(self._queued)}")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._queue = None
+        self._queued.clear()
+
+    def get_stats(self):
+        stats = dict(self._stats)
+        stats['pending'] = len(self._queued)
+        return stats
+
+
+class CatalogImages:
+    """
+    Отправка картинок каталога. Каждая картинка загружается в Telegram один раз,
+    дальше отправляется по сохраненному file_id (таблица telegram_files, ключ - хэш
+    содержимого, поэтому замена файла приводит к новой загрузке).
+    """
+
+    def __init__(self, bot, directory=CATALOG_IMAGES_DIR):
+        self.bot = bot
+        self.directory = directory
+        self._file_ids = None   # sha256 -> file_id
+        self._hashes = {}       # путь -> ((inode, mtime), sha256)
+        self._locks = {}        # sha256 -> блокировка первой загрузки
+        self._stats = {'uploaded': 0, 'by_file_id': 0, 'stale': 0}
+
+    async def _sha256(self, path):
+        info = os.stat(path)
+        version = (info.st_ino, info.st_mtime_ns)
+        cached = self._hashes.get(path)
+        if cached is None or cached[0] != version:
+            cached = self._hashes[path] = (version, await repo.run(file_sha256, path))
+        return cached[1]
+
+    async def _upload(self, chat_id, sha256, path, caption):
+        message = await self.bot.send_photo(chat_id, types.InputFile(path), caption=caption)
+        self._file_ids[sha256] = message.photo[-1].file_id
+        await repo.save_telegram_file_id(sha256, self._file_ids[sha256])
+        self._stats['uploaded'] += 1
+        return message
+
+    async def send_photo(self, chat_id, filename: str, caption=None):
+        """Отправляет картинку каталога; None, если файла нет"""
+        path = os.path.join(self.directory, filename)
+        if not os.path.isfile(path):
+            return None
+        if self._file_ids is None:
+            self._file_ids = await repo.get_telegram_file_ids()
+        sha256 = await self._sha256(path)
+        file_id = self._file_ids.get(sha256)
+        if file_id is None:
+            # Одновременные первые отправки: загружает одна, остальные отправят по ее file_id
+            async with self._locks.setdefault(sha256, asyncio.Lock()):
+                file_id = self._file_ids.get(sha256)
+                if file_id is None:
+                    return await self._upload(chat_id, sha256, path, caption)
+        try:
+            message = await self.bot.send_photo(chat_id, file_id, caption=caption)
+        except BadRequest as e:
+            # file_id не действует (например, сменился токен бота): загружаем заново
+            logger.warning(f"Устаревший file_id картинки {filename}: {e}")
+            self._stats['stale'] += 1
+            return await self._upload(chat_id, sha256, path, caption)
+        self._stats['by_file_id'] += 1
+        return message
+
+    def get_stats(self):
+        stats = dict(self._stats)
+        stats['cached'] = len(self._file_ids or ())
+        return stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Перенос фотографий в хранилище")
+    parser.add_argument('directory', nargs='?', default='return_photos',
+                        help="каталог с JPEG (по умолчанию return_photos)")
+    args = parser.parse_args()
+    db.create_tables()
+    files, new = import_directory(args.directory)
+    print(f"Файлов: {files}, новых в хранилище: {new}, хранилище: {media_dir()}")
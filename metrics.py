@@ -0,0 +1,273 @@
+import bisect
+import functools
+import logging
+import os
+import threading
+import time
+
+from aiogram import Bot
+from aiogram.dispatcher.handler import CancelHandler, SkipHandler
+
+logger = logging.getLogger(__name__)
+
+# Токен для /metrics: если задан, запрос должен содержать заголовок Authorization: Bearer <токен>;
+# без токена /metrics отвечает только на запросы с этой же машины
+METRICS_TOKEN = os.getenv('METRICS_TOKEN')
+
+_LOCAL_ADDRESSES = ('127.0.0.1', '::1')
+
+# Границы корзин гистограмм задержки, секунды
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Формат ответа /metrics (текстовый формат Prometheus)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in (*zip(names, values), *extra)]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """Счетчик с метками; значения хранятся по кортежу значений меток"""
+
+    type = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels):
+        with self._lock:
+            return self._values.get(labels, 0)
+
+    def render(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        for labels, value in values:
+            yield f'{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}'
+
+
+class Histogram:
+    """
+    Гистограмма с метками. observe - поиск корзины и три сложения под блокировкой;
+    накопительные суммы по корзинам считаются только при выдаче /metrics.
+    """
+
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._values = {}   # метки -> [счетчики корзин (последняя - +Inf), сумма, количество]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                entry = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def count(self, *labels):
+        with self._lock:
+            entry = self._values.get(labels)
+            return entry[2] if entry else 0
+
+    def render(self):
+        with self._lock:
+            values = sorted((labels, (list(counts), total, count))
+                            for labels, (counts, total, count) in self._values.items())
+        for labels, (counts, total, count) in values:
+            cumulative = 0
+            for bound, bucket_count in zip((*self.buckets, float('inf')), counts):
+                cumulative += bucket_count
+                label_text = _format_labels(self.labelnames, labels, (('le', _format_value(bound)),))
+                yield f'{self.name}_bucket{label_text} {cumulative}'
+            label_text = _format_labels(self.labelnames, labels)
+            yield f'{self.name}_sum{label_text} {_format_value(total)}'
+            yield f'{self.name}_count{label_text} {count}'
+
+
+class MetricsRegistry:
+    """
+    Метрики процесса. Счетчики и гистограммы обновляются на горячем пути,
+    а показатели компонентов (очереди, кэши, пул) собираются функциями-сборщиками
+    только в момент запроса /metrics.
+    """
+
+    def __init__(self):
+        self._metrics = []
+        # Сборщик возвращает [(имя, тип, описание, [(метки-словарь, значение)])]
+        self._collectors = []
+
+    def counter(self, name, documentation, labelnames=()):
+        metric = Counter(name, documentation, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        metric = Histogram(name, documentation, labelnames, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def register_collector(self, collector):
+        self._collectors.append(collector)
+
+    def register_stats(self, component: str, get_stats):
+        """
+        Показатели get_stats() компонента: числовые значения становятся метриками
+        bot_<component>_<ключ>. В get_stats смешаны счетчики и текущие значения,
+        поэтому тип - untyped.
+        """
+        def collect():
+            families = []
+            for key, value in get_stats().items():
+                if isinstance(value, bool):
+                    value = int(value)
+                if isinstance(value, (int, float)):
+                    families.append((f'bot_{component}_{key}', 'untyped',
+                                     f'{component}.get_stats()[{key!r}]', [({}, value)]))
+            return families
+        self.register_collector(collect)
+
+    def render(self) -> str:
+        """Все метрики в текстовом формате Prometheus"""
+        lines = []
+        for metric in self._metrics:
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            lines.extend(metric.render())
+        for collector in self._collectors:
+            try:
+                families = collector()
+            except Exception as e:
+                # Сбой одного сборщика не должен ломать выдачу остальных метрик
+                logger.error(f"Ошибка сборщика метрик: {e}")
+                continue
+            for name, metric_type, documentation, samples in families:
+                lines.append(f'# HELP {name} {documentation}')
+                lines.append(f'# TYPE {name} {metric_type}')
+                for labels, value in samples:
+                    lines.append(f'{name}{_format_labels(labels.keys(), labels.values())} {_format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+registry = MetricsRegistry()
+
+HANDLER_SECONDS = registry.histogram(
+    'bot_handler_seconds', 'Время работы обработчика aiogram, секунды', ('handler',)
+)
+HANDLER_ERRORS = registry.counter(
+    'bot_handler_errors_total', 'Исключения в обработчиках aiogram', ('handler',)
+)
+DB_CALL_SECONDS = registry.histogram(
+    'bot_db_call_seconds', 'Время функции базы данных в потоке базы данных, секунды', ('function',)
+)
+DB_CALL_ERRORS = registry.counter(
+    'bot_db_call_errors_total', 'Исключения в функциях базы данных', ('function',)
+)
+TELEGRAM_API_SECONDS = registry.histogram(
+    'bot_telegram_api_seconds', 'Время запроса к Bot API, секунды', ('method',)
+)
+TELEGRAM_API_ERRORS = registry.counter(
+    'bot_telegram_api_errors_total', 'Ошибки запросов к Bot API по типу исключения', ('method', 'error')
+)
+
+
+def _timed_handler(handler):
+    name = handler.__name__
+
+    @functools.wraps(handler)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await handler(*args, **kwargs)
+        except (SkipHandler, CancelHandler):
+            raise
+        except Exception:
+            HANDLER_ERRORS.inc(name)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - started, name)
+
+    wrapper.timed = True
+    return wrapper
+
+
+def instrument_handlers(dispatcher):
+    """
+    Оборачивает зарегистрированные обработчики сообщений и кнопок замером времени.
+    aiogram уже разобрал сигнатуру исходной функции, поэтому обертка получает те же аргументы.
+    Повторный вызов не оборачивает обработчики дважды.
+    """
+    for handlers in (dispatcher.message_handlers, dispatcher.callback_query_handlers):
+        for handler_obj in handlers.handlers:
+            if not getattr(handler_obj.handler, 'timed', False):
+                handler_obj.handler = _timed_handler(handler_obj.handler)
+
+
+def timed_db_call(func, *args, **kwargs):
+    """Вызывает функцию базы данных с замером; вызывается в потоке базы данных"""
+    name = getattr(func, '__name__', 'other')
+    started = time.perf_counter()
+    try:
+        return func(*args, **kwargs)
+    except Exception:
+        DB_CALL_ERRORS.inc(name)
+        raise
+    finally:
+        DB_CALL_SECONDS.observe(time.perf_counter() - started, name)
+
+
+class InstrumentedBot(Bot):
+    """Bot, замеряющий каждый запрос к Bot API и считающий ошибки по методам"""
+
+    async def request(self, method, data=None, files=None, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await super().request(method, data, files, **kwargs)
+        except Exception as e:
+            TELEGRAM_API_ERRORS.inc(method, type(e).__name__)
+            raise
+        finally:
+            TELEGRAM_API_SECONDS.observe(time.perf_counter() - started, method)
+
+
+def is_authorized(request) -> bool:
+    """
+    Доступ к /metrics: с METRICS_TOKEN - по заголовку Authorization, без него - только
+    с этой машины. Запрос через прокси (X-Forwarded-For) локальным не считается:
+    прокси на той же машине иначе открыл бы метрики всем.
+    """
+    if METRICS_TOKEN:
+        return request.headers.get('Authorization') == f'Bearer {METRICS_TOKEN}'
+    return request.remote in _LOCAL_ADDRESSES and 'X-Forwarded-For' not in request.headers
+
+
+def log_exposure():
+    """Пишет в лог, кому доступен /metrics; вызывается при сборке приложения"""
+    if not METRICS_TOKEN:
+        logger.warning("METRICS_TOKEN не задан: /metrics доступен только с этой машины")
@@ -0,0 +1,384 @@
+import logging
+import sqlite3
+
+logger = logging.getLogger(__name__)
+
+
+def _add_column(table, column, definition):
+    """Шаг миграции: добавляет колонку, если ее еще нет"""
+    def step(cursor):
+        cursor.execute(f'PRAGMA table_info({table})')
+        if column not in {row[1] for row in cursor.fetchall()}:
+            cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+    return step
+
+
+def _backfill_stats(cursor):
+    """Шаг миграции: заполняет сводные таблицы отчета по уже накопленным данным"""
+    cursor.execute('''
+        INSERT OR REPLACE INTO stats_totals (id, tool_types, total_quantity, issued_now)
+        SELECT 1, COUNT(*), COALESCE(SUM(quantity), 0),
+               (SELECT COUNT(*) FROM issued_tools WHERE return_date IS NULL)
+        FROM tools
+    ''')
+    cursor.execute('DELETE FROM tool_stats')
+    cursor.execute('''
+        INSERT INTO tool_stats (tool_id, issue_count, issued_now)
+        SELECT tool_id, COUNT(*), SUM(return_date IS NULL)
+        FROM issued_tools
+        WHERE tool_id IS NOT NULL
+        GROUP BY tool_id
+    ''')
+    cursor.execute('DELETE FROM daily_activity')
+    cursor.execute('''
+        INSERT INTO daily_activity (day, issued, returned)
+        SELECT day, SUM(issued), SUM(returned)
+        FROM (
+            SELECT COALESCE(date(issue_date), date('now')) AS day, 1 AS issued, 0 AS returned
+            FROM issued_tools
+            UNION ALL
+            SELECT date(return_date), 0, 1 FROM issued_tools WHERE return_date IS NOT NULL
+        )
+        GROUP BY day
+    ''')
+
+
+def _merge_tool_units(cursor):
+    """
+    Шаг миграции: одна строка tools на тип инструмента вместо строки на каждую единицу.
+    Выдача на срок уменьшала quantity, а выдача по запросу только ставила статус 'issued',
+    поэтому единиц у строки - quantity плюс открытые выдачи, кроме учтенной статусом.
+    Выдачи, история и запросы переносятся на строку с наименьшим id.
+    """
+    cursor.execute('''
+        CREATE TEMP TABLE tool_merge AS
+        SELECT t.id AS old_id, c.new_id
+        FROM tools t
+        JOIN (SELECT name, MIN(id) AS new_id FROM tools GROUP BY name) c ON c.name = t.name
+        WHERE t.id != c.new_id
+    ''')
+    cursor.execute('''
+        CREATE TEMP TABLE tool_units AS
+        SELECT t.name,
+               SUM(MAX(COALESCE(t.quantity, 0) + COALESCE(o.open_count, 0)
+                       - (t.status = 'issued' AND COALESCE(o.open_count, 0) > 0), 0)) AS units
+        FROM tools t
+        LEFT JOIN (
+            SELECT tool_id, COUNT(*) AS open_count FROM issued_tools
+            WHERE return_date IS NULL GROUP BY tool_id
+        ) o ON o.tool_id = t.id
+        GROUP BY t.name
+    ''')
+    cursor.execute('''
+        UPDATE tools SET quantity = (SELECT units FROM tool_units WHERE name = tools.name)
+        WHERE id NOT IN (SELECT old_id FROM tool_merge)
+    ''')
+    for table in ('issued_tools', 'tool_history', 'issue_requests'):
+        cursor.execute(f'''
+            UPDATE {table}
+            SET tool_id = (SELECT new_id FROM tool_merge WHERE old_id = {table}.tool_id)
+            WHERE tool_id IN (SELECT old_id FROM tool_merge)
+        ''')
+    cursor.execute('DELETE FROM tools WHERE id IN (SELECT old_id FROM tool_merge)')
+    cursor.execute('DROP TABLE temp.tool_merge')
+    cursor.execute('DROP TABLE temp.tool_units')
+    cursor.execute('''
+        UPDATE tools SET reserved = (
+            SELECT COUNT(*) FROM issued_tools
+            WHERE tool_id = tools.id AND return_date IS NULL
+        )
+    ''')
+
+
+# Упорядоченный список миграций: (версия, описание, шаги).
+# Шаг - SQL-строка или функция, принимающая курсор.
+# Уже примененные миграции не изменять, только добавлять новые в конец.
+MIGRATIONS = [
+    (1, 'Колонки return_photo и notes', [
+        _add_column('issued_tools', 'return_photo', 'TEXT'),
+        _add_column('tool_history', 'notes', 'TEXT'),
+    ]),
+    (2, 'Индексы для выдач, истории и запросов', [
+        # Открытые выдачи: поиск по инструменту и список к возврату без обращения к таблице
+        '''
+        CREATE INDEX IF NOT EXISTS idx_issued_tools_open
+        ON issued_tools(tool_id, employee_name, issue_date, expected_return_date)
+        WHERE return_date IS NULL
+        ''',
+        '''
+        CREATE INDEX IF NOT EXISTS idx_tool_history_timestamp
+        ON tool_history(timestamp)
+        ''',
+        '''
+        CREATE INDEX IF NOT EXISTS idx_issue_requests_lookup
+        ON issue_requests(tool_id, chat_id, status)
+        ''',
+    ]),
+    (3, 'Индекс для постраничного списка инструментов', [
+        # Список по названию с продолжением от (name, id) последней показанной строки
+        '''
+        CREATE INDEX IF NOT EXISTS idx_tools_name_id
+        ON tools(name, id)
+        ''',
+    ]),
+    (4, 'Служебные значения приложения', [
+        # Версия начальных данных и другие значения "ключ - значение"
+        '''
+        CREATE TABLE IF NOT EXISTS app_meta (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+    ]),
+    (5, 'Хранилище состояний диалогов', [
+        '''
+        CREATE TABLE IF NOT EXISTS fsm_states (
+            chat_id TEXT NOT NULL,
+            user_id TEXT NOT NULL,
+            state TEXT,
+            data TEXT,
+            bucket TEXT,
+            expires_at REAL NOT NULL,
+            PRIMARY KEY (chat_id, user_id)
+        ) WITHOUT ROWID
+        ''',
+        '''
+        CREATE INDEX IF NOT EXISTS idx_fsm_states_expires
+        ON fsm_states(expires_at)
+        ''',
+    ]),
+    (6, 'Сводные таблицы для отчета', [
+        # Итоги по всему складу: одна строка
+        '''
+        CREATE TABLE IF NOT EXISTS stats_totals (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            tool_types INTEGER NOT NULL DEFAULT 0,
+            total_quantity INTEGER NOT NULL DEFAULT 0,
+            issued_now INTEGER NOT NULL DEFAULT 0
+        )
+        ''',
+        # Выдачи по инструментам: всего и сейчас на руках
+        '''
+        CREATE TABLE IF NOT EXISTS tool_stats (
+            tool_id INTEGER PRIMARY KEY,
+            issue_count INTEGER NOT NULL DEFAULT 0,
+            issued_now INTEGER NOT NULL DEFAULT 0
+        )
+        ''',
+        '''
+        CREATE INDEX IF NOT EXISTS idx_tool_stats_issue_count
+        ON tool_stats(issue_count)
+        ''',
+        # Выдачи и возвраты по дням: статистика за 7 и 30 дней без просмотра истории
+        '''
+        CREATE TABLE IF NOT EXISTS daily_activity (
+            day TEXT PRIMARY KEY,
+            issued INTEGER NOT NULL DEFAULT 0,
+            returned INTEGER NOT NULL DEFAULT 0
+        ) WITHOUT ROWID
+        ''',
+        # Просроченные выдачи: диапазон по индексу вместо просмотра всех открытых выдач
+        '''
+        CREATE INDEX IF NOT EXISTS idx_issued_tools_open_due
+        ON issued_tools(expected_return_date)
+        WHERE return_date IS NULL
+        ''',
+        _backfill_stats,
+        # Триггеры обновляют сводки в той же транзакции, что и изменение данных,
+        # при любом способе записи (бот, импорт, заполнение базы)
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_stats_tools_insert AFTER INSERT ON tools BEGIN
+            UPDATE stats_totals
+            SET tool_types = tool_types + 1,
+                total_quantity = total_quantity + COALESCE(NEW.quantity, 0);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_stats_tools_delete AFTER DELETE ON tools BEGIN
+            UPDATE stats_totals
+            SET tool_types = tool_types - 1,
+                total_quantity = total_quantity - COALESCE(OLD.quantity, 0);
+            DELETE FROM tool_stats WHERE tool_id = OLD.id;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_stats_tools_quantity AFTER UPDATE OF quantity ON tools
+        WHEN COALESCE(NEW.quantity, 0) != COALESCE(OLD.quantity, 0) BEGIN
+            UPDATE stats_totals
+            SET total_quantity = total_quantity + COALESCE(NEW.quantity, 0) - COALESCE(OLD.quantity, 0);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_stats_issue_insert AFTER INSERT ON issued_tools BEGIN
+            INSERT INTO tool_stats (tool_id, issue_count, issued_now)
+            SELECT NEW.tool_id, 1, NEW.return_date IS NULL WHERE NEW.tool_id IS NOT NULL
+            ON CONFLICT(tool_id) DO UPDATE SET
+                issue_count = issue_count + 1,
+                issued_now = issued_now + excluded.issued_now;
+            UPDATE stats_totals SET issued_now = issued_now + (NEW.return_date IS NULL);
+            INSERT INTO daily_activity (day, issued)
+            VALUES (COALESCE(date(NEW.issue_date), date('now')), 1)
+            ON CONFLICT(day) DO UPDATE SET issued = issued + 1;
+            INSERT INTO daily_activity (day, returned)
+            SELECT date(NEW.return_date), 1 WHERE NEW.return_date IS NOT NULL
+            ON CONFLICT(day) DO UPDATE SET returned = returned + 1;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_stats_issue_return AFTER UPDATE OF return_date ON issued_tools
+        WHEN OLD.return_date IS NULL AND NEW.return_date IS NOT NULL BEGIN
+            UPDATE tool_stats SET issued_now = issued_now - 1 WHERE tool_id = NEW.tool_id;
+            UPDATE stats_totals SET issued_now = issued_now - 1;
+            INSERT INTO daily_activity (day, returned)
+            VALUES (COALESCE(date(NEW.return_date), date('now')), 1)
+            ON CONFLICT(day) DO UPDATE SET returned = returned + 1;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_stats_issue_reopen AFTER UPDATE OF return_date ON issued_tools
+        WHEN OLD.return_date IS NOT NULL AND NEW.return_date IS NULL BEGIN
+            UPDATE tool_stats SET issued_now = issued_now + 1 WHERE tool_id = NEW.tool_id;
+            UPDATE stats_totals SET issued_now = issued_now + 1;
+            UPDATE daily_activity SET returned = returned - 1 WHERE day = date(OLD.return_date);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_stats_issue_delete AFTER DELETE ON issued_tools BEGIN
+            UPDATE tool_stats
+            SET issue_count = issue_count - 1,
+                issued_now = issued_now - (OLD.return_date IS NULL)
+            WHERE tool_id = OLD.tool_id;
+            UPDATE stats_totals SET issued_now = issued_now - (OLD.return_date IS NULL);
+            UPDATE daily_activity SET issued = issued - 1
+            WHERE day = COALESCE(date(OLD.issue_date), date('now'));
+            UPDATE daily_activity SET returned = returned - 1
+            WHERE OLD.return_date IS NOT NULL AND day = date(OLD.return_date);
+        END
+        ''',
+    ]),
+    (7, 'Индексы истории по инструменту и сотруднику', [
+        # Выборка истории инструмента или сотрудника за период - диапазон по индексу
+        '''
+        CREATE INDEX IF NOT EXISTS idx_tool_history_tool
+        ON tool_history(tool_id, timestamp)
+        ''',
+        '''
+        CREATE INDEX IF NOT EXISTS idx_tool_history_employee
+        ON tool_history(employee_name, timestamp)
+        ''',
+    ]),
+    (8, 'Напоминания о просроченных выдачах', [
+        # Чат сотрудника для напоминания и время отправленного напоминания
+        _add_column('issued_tools', 'chat_id', 'INTEGER'),
+        _add_column('issued_tools', 'overdue_notified_at', 'DATETIME'),
+        # Только выдачи, ожидающие напоминания: ближайший срок - первая строка индекса
+        '''
+        CREATE INDEX IF NOT EXISTS idx_issued_tools_due_pending
+        ON issued_tools(expected_return_date)
+        WHERE return_date IS NULL AND overdue_notified_at IS NULL
+        ''',
+    ]),
+    (9, 'Хранилище фотографий и кэш file_id', [
+        # Файлы в хранилище по SHA-256 содержимого: одинаковые фото хранятся один раз
+        '''
+        CREATE TABLE IF NOT EXISTS media (
+            sha256 TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            has_thumbnail INTEGER NOT NULL DEFAULT 0,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        ) WITHOUT ROWID
+        ''',
+        # file_id, под которым Telegram уже хранит файл с этим содержимым
+        '''
+        CREATE TABLE IF NOT EXISTS telegram_files (
+            sha256 TEXT PRIMARY KEY,
+            file_id TEXT NOT NULL,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        ) WITHOUT ROWID
+        ''',
+        _add_column('issued_tools', 'return_photo_sha', 'TEXT'),
+        _add_column('tools', 'image', 'TEXT'),
+        # Только фото возврата, еще не скачанные в хранилище
+        '''
+        CREATE INDEX IF NOT EXISTS idx_issued_tools_photo_pending
+        ON issued_tools(return_photo)
+        WHERE return_photo IS NOT NULL AND return_photo_sha IS NULL
+        ''',
+    ]),
+    (10, 'Учет единиц по типу инструмента', [
+        # quantity - сколько единиц всего, reserved - сколько сейчас выдано
+        _add_column('tools', 'reserved', 'INTEGER NOT NULL DEFAULT 0'),
+        _merge_tool_units,
+        '''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_tools_name_unique
+        ON tools(name)
+        ''',
+        # Уникальный индекс по name уже упорядочен по (name, id) и заменяет прежний
+        'DROP INDEX IF EXISTS idx_tools_name_id',
+        # Выдать больше, чем есть, нельзя при любом способе записи
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_tools_stock_check
+        BEFORE UPDATE OF quantity, reserved ON tools
+        WHEN NEW.reserved < 0 OR NEW.reserved > COALESCE(NEW.quantity, 0) BEGIN
+            SELECT RAISE(ABORT, 'reserved out of range');
+        END
+        ''',
+        # Число типов и единиц изменилось при объединении строк
+        _backfill_stats,
+    ]),
+]
+
+
+def get_schema_version(cursor) -> int:
+    """Возвращает номер последней примененной миграции"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            description TEXT,
+            applied_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute('SELECT COALESCE(MAX(version), 0) FROM schema_version')
+    return cursor.fetchone()[0]
+
+
+def apply_migrations(conn) -> int:
+    """
+    Применяет недостающие миграции, каждую в своей транзакции.
+    Повторный вызов ничего не делает. Возвращает текущую версию схемы.
+    """
+    cursor = conn.cursor()
+    try:
+        current = get_schema_version(cursor)
+        conn.commit()
+        for version, description, steps in MIGRATIONS:
+            if version <= current:
+                continue
+            logger.info(f"Применение миграции {version}: {description}")
+            try:
+                # DDL в sqlite3 не открывает транзакцию сам, открываем явно.
+                # IMMEDIATE и повторная проверка защищают от одновременного запуска нескольких процессов.
+                cursor.execute('BEGIN IMMEDIATE')
+                if get_schema_version(cursor) >= version:
+                    conn.commit()
+                    current = version
+                    continue
+                for step in steps:
+                    if callable(step):
+                        step(cursor)
+                    else:
+                        cursor.execute(step)
+                cursor.execute(
+                    'INSERT INTO schema_version (version, description) VALUES (?, ?)',
+                    (version, description)
+                )
+                conn.commit()
+            except sqlite3.Error as e:
+                conn.rollback()
+                logger.error(f"Ошибка при применении миграции {version}: {e}")
+                raise
+            current = version
+        return current
+    finally:
+        cursor.close()
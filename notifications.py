@@ -0,0 +1,198 @@
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+
+from aiogram.utils.exceptions import BadRequest, RetryAfter, Unauthorized
+
+from ingestion import _percentile
+from throttling import TokenBucketLimiter
+
+logger = logging.getLogger(__name__)
+
+# Сколько сообщений в секунду отправлять в один чат (ограничение Telegram - около 1)
+NOTIFY_CHAT_RATE = float(os.getenv('NOTIFY_CHAT_RATE', '1'))
+
+# Сколько сообщений в секунду отправлять всего (ограничение Telegram - около 30)
+NOTIFY_GLOBAL_RATE = float(os.getenv('NOTIFY_GLOBAL_RATE', '30'))
+
+# Сколько раз повторять отправку при сетевых ошибках и ошибках Telegram
+NOTIFY_MAX_RETRIES = int(os.getenv('NOTIFY_MAX_RETRIES', '5'))
+
+# Максимальная длина текста сообщения в Telegram
+MESSAGE_LIMIT = 4096
+
+# Сколько последних задержек доставки хранится для перцентилей
+_LATENCY_WINDOW = 1000
+
+
+class Notification:
+    """Одно уведомление: текст или фото с подписью"""
+
+    __slots__ = ('text', 'photo', 'created_at', 'attempts')
+
+    def __init__(self, text, photo=None):
+        self.text = text
+        self.photo = photo
+        self.created_at = time.perf_counter()
+        self.attempts = 0
+
+
+class NotificationSender:
+    """
+    Фоновая отправка уведомлений (например, админу о выдаче и возврате).
+    Обработчик ставит уведомление в очередь и сразу отвечает пользователю.
+    Отправка соблюдает ограничения Telegram на чат и на бота в целом; пока чат
+    ждет своей очереди, накопившиеся текстовые уведомления объединяются в одну
+    сводку. При ошибках отправка повторяется с растущей паузой.
+    """
+
+    def __init__(self, bot, chat_rate=NOTIFY_CHAT_RATE, global_rate=NOTIFY_GLOBAL_RATE,
+                 max_retries=NOTIFY_MAX_RETRIES):
+        self.bot = bot
+        self.max_retries = max_retries
+        self._chat_limiter = TokenBucketLimiter(chat_rate, 1)
+        self._global_limiter = TokenBucketLimiter(global_rate, max(1, int(global_rate)))
+        self._pending = {}       # chat_id -> deque[Notification]
+        self._not_before = {}    # chat_id -> время, раньше которого не отправлять (повтор)
+        self._sending = {}       # chat_id -> задача отправки; в один чат отправляем по одному сообщению
+        self._wakeup = None
+        self._task = None
+        self._latencies = deque(maxlen=_LATENCY_WINDOW)
+        self._stats = {'queued': 0, 'delivered': 0, 'messages': 0, 'coalesced': 0,
+                       'retries': 0, 'failed': 0}
+
+    def notify(self, chat_id, text, photo=None):
+        """Ставит уведомление в очередь; не ждет отправки"""
+        self._pending.setdefault(chat_id, deque()).append(Notification(text, photo))
+        self._stats['queued'] += 1
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def start(self):
+        """Запускает отправку в текущем цикле событий"""
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            if self._pending:
+                self._wakeup.set()
+            self._task = asyncio.create_task(self._run())
+
+    def _next_chat(self):
+        """Возвращает (чат, готовый к отправке, или None; через сколько секунд проверить снова)"""
+        now = time.monotonic()
+        wait = None
+        global_delay = self._global_limiter.delay('all', now)
+        for chat_id in self._pending:
+            if chat_id in self._sending:
+                continue
+            delay = max(global_delay, self._chat_limiter.delay(chat_id, now),
+                        self._not_before.get(chat_id, now) - now)
+            if delay <= 0:
+                return chat_id, 0
+            wait = delay if wait is None else min(wait, delay)
+        return None, wait
+
+    async def _run(self):
+        while True:
+            if len(self._sending) == len(self._pending):
+                # Нечего отправлять или все чаты уже отправляют
+                await self._wakeup.wait()
+            self._wakeup.clear()
+            chat_id, wait = self._next_chat()
+            if chat_id is None:
+                # Ждем, пока освободится ограничение, или нового уведомления
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            self._chat_limiter.allow(chat_id)
+            self._global_limiter.allow('all')
+            # Разные чаты отправляются параллельно, чтобы задержка Bot API не ограничивала общий темп
+            self._sending[chat_id] = asyncio.create_task(self._deliver(chat_id))
+
+    def _take(self, items):
+        """Забирает из начала очереди чата одно фото или несколько текстов подряд (сводку)"""
+        if items[0].photo is not None:
+            return [items.popleft()]
+        batch = [items.popleft()]
+        length = len(batch[0].text)
+        while items and items[0].photo is None and length + len(items[0].text) + 2 <= MESSAGE_LIMIT - 100:
+            length += len(items[0].text) + 2
+            batch.append(items.popleft())
+        return batch
+
+    async def _send(self, chat_id, batch):
+        if batch[0].photo is not None:
+            await self.bot.send_photo(chat_id, batch[0].photo, caption=batch[0].text)
+        elif len(batch) == 1:
+            await self.bot.send_message(chat_id, batch[0].text)
+        else:
+            header = f"📬 Уведомлений: {len(batch)}\n\n"
+            await self.bot.send_message(chat_id, header + "\n\n".join(item.text for item in batch))
+
+    async def _deliver(self, chat_id):
+        items = self._pending[chat_id]
+        batch = self._take(items)
+        try:
+            await self._send(chat_id, batch)
+        except (BadRequest, Unauthorized) as e:
+            # Чат недоступен или сообщение некорректно: повтор не поможет
+            self._stats['failed'] += len(batch)
+            logger.error(f"Уведомление в чат {chat_id} не доставлено: {e}")
+        except Exception as e:
+            attempts = max(item.attempts for item in batch) + 1
+            if attempts > self.max_retries:
+                self._stats['failed'] += len(batch)
+                logger.error(f"Уведомление в чат {chat_id} не доставлено после {self.max_retries} повторов: {e}")
+            else:
+                for item in batch:
+                    item.attempts = attempts
+                items.extendleft(reversed(batch))
+                pause = e.timeout if isinstance(e, RetryAfter) else min(60, 2 ** (attempts - 1))
+                self._not_before[chat_id] = time.monotonic() + pause
+                self._stats['retries'] += 1
+                logger.warning(f"Ошибка отправки уведомления в чат {chat_id}, повтор через {pause} с: {e}")
+        else:
+            now = time.perf_counter()
+            self._latencies.extend(now - item.created_at for item in batch)
+            self._stats['delivered'] += len(batch)
+            self._stats['messages'] += 1
+            self._stats['coalesced'] += len(batch) - 1
+            self._not_before.pop(chat_id, None)
+        if not items:
+            del self._pending[chat_id]
+        del self._sending[chat_id]
+        self._wakeup.set()
+
+    async def close(self, timeout=10):
+        """Дожидается отправки очереди (не дольше timeout) и останавливает отправку"""
+        if self._task is None:
+            return
+        deadline = time.monotonic() + timeout
+        while self._pending and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        if self._pending:
+            left = sum(len(items) for items in self._pending.values())
+            logger.warning(f"Не отправлено уведомлений при остановке: {left}")
+        tasks = [self._task, *self._sending.values()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._task = None
+        self._sending = {}
+
+    def depth(self) -> int:
+        """Количество уведомлений, ожидающих отправки"""
+        return sum(len(items) for items in self._pending.values())
+
+    def get_stats(self):
+        """Счетчики отправки и задержка от постановки до доставки (секунды)"""
+        latencies = list(self._latencies)
+        stats = dict(self._stats)
+        stats['depth'] = self.depth()
+        stats['latency_p50'] = _percentile(latencies, 50)
+        stats['latency_p99'] = _percentile(latencies, 99)
+        stats['latency_max'] = max(latencies, default=0.0)
+        return stats
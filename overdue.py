@@ -0,0 +1,170 @@
+import asyncio
+import heapq
+import logging
+import os
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from async_db import repo
+
+logger = logging.getLogger(__name__)
+
+# На сколько вперед загружать сроки возврата в расписание, часы
+OVERDUE_LOOKAHEAD_HOURS = float(os.getenv('OVERDUE_LOOKAHEAD_HOURS', '24'))
+
+# Не чаще чем раз в столько секунд: сроки, наступившие за это время, попадают в одно напоминание
+OVERDUE_BATCH_SECONDS = int(os.getenv('OVERDUE_BATCH_SECONDS', '300'))
+
+# Сколько строк выводить в одном напоминании админу
+OVERDUE_ADMIN_LIMIT = 30
+
+
+def _parse_due(value) -> datetime:
+    """Срок возврата из базы: 'ГГГГ-ММ-ДД ЧЧ:ММ:СС[.ffffff]' или только дата"""
+    if isinstance(value, datetime):
+        return value
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        return datetime.strptime(value[:10], '%Y-%m-%d')
+
+
+def _format_due(value) -> str:
+    return _parse_due(value).strftime('%d.%m.%Y')
+
+
+class OverdueScheduler:
+    """
+    Напоминания о просроченных выдачах.
+    Сроки возврата на ближайшие OVERDUE_LOOKAHEAD_HOURS часов лежат в куче (min-heap),
+    и задача спит до ближайшего срока; следующие сроки подгружаются по индексу
+    по мере продвижения окна, новые выдачи добавляются через track().
+    Когда срок наступил, выдачи, о которых еще не напоминали, забираются из базы
+    одной транзакцией: сотрудники получают по одному сообщению со своими
+    инструментами, админ - общую сводку. Проверки идут не чаще раза в
+    OVERDUE_BATCH_SECONDS, поэтому близкие сроки объединяются в одно напоминание.
+    """
+
+    def __init__(self, notifier, admin_id=None, lookahead_hours=OVERDUE_LOOKAHEAD_HOURS,
+                 batch_seconds=OVERDUE_BATCH_SECONDS):
+        self.notifier = notifier
+        self.admin_id = admin_id
+        self.lookahead = timedelta(hours=lookahead_hours)
+        self.batch_interval = timedelta(seconds=batch_seconds)
+        self._heap = []
+        self._loaded_until = None   # сроки раньше этого момента уже в куче
+        self._last_check = None
+        self._wakeup = None
+        self._task = None
+        self._stats = {'wakeups': 0, 'reminded': 0, 'borrower_messages': 0, 'admin_messages': 0}
+
+    def track(self, due: datetime):
+        """Добавляет срок новой выдачи; будит задачу, если он раньше текущего ближайшего"""
+        if self._loaded_until is None or due >= self._loaded_until:
+            # Попадет в кучу при подгрузке следующего окна
+            return
+        earliest = self._heap[0] if self._heap else None
+        heapq.heappush(self._heap, due)
+        if self._wakeup is not None and (earliest is None or due < earliest):
+            self._wakeup.set()
+
+    async def _load_window(self, now):
+        # Первая загрузка - без нижней границы: подхватывает просроченное до запуска.
+        # Границу сдвигаем до запроса: выдачи, оформленные во время него, придут через track()
+        since, until = self._loaded_until, now + self.lookahead
+        self._loaded_until = until
+        try:
+            due_dates = await repo.get_pending_due_dates(since, until)
+        except Exception:
+            self._loaded_until = since
+            raise
+        for value in due_dates:
+            heapq.heappush(self._heap, _parse_due(value))
+
+    def _next_wakeup(self, now) -> float:
+        """Через сколько секунд проверить: ближайший срок или конец окна, но не раньше конца пачки"""
+        wake_at = self._loaded_until
+        if self._heap and self._heap[0] < wake_at:
+            wake_at = self._heap[0]
+        if self._last_check is not None:
+            wake_at = max(wake_at, self._last_check + self.batch_interval)
+        return max(0.0, (wake_at - now).total_seconds())
+
+    async def check(self, now=None):
+        """Забирает наступившие сроки и отправляет напоминания; возвращает число выдач"""
+        now = now or datetime.now()
+        self._last_check = now
+        if self._loaded_until is None or self._loaded_until <= now:
+            await self._load_window(now)
+        due = False
+        while self._heap and self._heap[0] <= now:
+            heapq.heappop(self._heap)
+            due = True
+        if not due:
+            return 0
+        loans = await repo.claim_overdue_loans(now)
+        if loans:
+            self._send_reminders(loans)
+        return len(loans)
+
+    def _send_reminders(self, loans):
+        by_chat = defaultdict(list)
+        for _, name, _, chat_id, expected in loans:
+            if chat_id is not None:
+                by_chat[chat_id].append(f"🔧 {name} (срок: {_format_due(expected)})")
+        for chat_id, lines in by_chat.items():
+            self.notifier.notify(chat_id, "⏰ Пора вернуть инструменты:\n" + "\n".join(lines))
+        self._stats['borrower_messages'] += len(by_chat)
+
+        if self.admin_id:
+            lines = [
+                f"🔧 {name} - {employee} (срок: {_format_due(expected)})"
+                for _, name, employee, _, expected in loans[:OVERDUE_ADMIN_LIMIT]
+            ]
+            if len(loans) > OVERDUE_ADMIN_LIMIT:
+                lines.append(f"... и еще {len(loans) - OVERDUE_ADMIN_LIMIT}, см. /overdue")
+            self.notifier.notify(self.admin_id, f"⚠️ Новые просрочки: {len(loans)}\n" + "\n".join(lines))
+            self._stats['admin_messages'] += 1
+        self._stats['reminded'] += len(loans)
+        logger.info(f"Напоминания о просрочке: {len(loans)} выдач, {len(by_chat)} сотрудников")
+
+    async def _run(self):
+        while True:
+            try:
+                await self.check()
+            except Exception as e:
+                logger.error(f"Ошибка при проверке просроченных выдач: {e}")
+                # Не повторяем ошибку в цикле без паузы
+                await asyncio.sleep(60)
+                continue
+            self._stats['wakeups'] += 1
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self._next_wakeup(datetime.now()))
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self, track_only=False):
+        """
+        Запускает проверку в текущем цикле событий.
+        track_only=True: сроки из базы не загружаются, расписание - только выдачи
+        этого процесса из track() (процессы-обработчики кроме ведущего).
+        """
+        if self._task is None:
+            if track_only:
+                self._loaded_until = datetime.max
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def get_stats(self):
+        """Счетчики пробуждений и напоминаний, размер расписания и ближайший срок"""
+        stats = dict(self._stats)
+        stats['scheduled'] = len(self._heap)
+        stats['next_due'] = self._heap[0].isoformat(' ') if self._heap else None
+        return stats
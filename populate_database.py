@@ -1,6 +1,79 @@
+import argparse
+import shutil
 import sqlite3
 import os
-from db import create_tables
+from db import INVENTORY_SYNC_INTERVAL, create_tables, get_meta, inventory, run_write, set_meta
+from history_archive import archive_dir
+from media import media_dir
+
+# Версия начальных данных: увеличить при изменении SEED_TOOLS или SEED_IMAGES
+SEED_VERSION = 2
+
+# Список инструментов и их количество
+SEED_TOOLS = [
+    ("Milwaukee - Болгарка", 5),
+    ("Milwaukee - Перфоратор", 3),
+    ("Milwaukee - Сабельная пила", 4),
+    ("Milwaukee - Шуруповёрт", 6),
+    ("Milwaukee - Пылеуловитель для перфоратора", 2),
+    ("Milwaukee - Зарядка для аккумуляторов", 3),
+    ("Milwaukee - Аккумулятор", 10),
+    ("Toua Газовый монтажный пистолет", 2),
+    ("Bosch - Перфоратор", 3),
+    ("Makita - Перфоратор", 3),
+    ("Makita - Сабельная пила", 2),
+    ("Makita - Болгарка xLock", 4),
+    ("Makita - Проводная болгарка", 3),
+    ("Пылесос для модулей Makita", 1),
+    ("Makita - Станция", 1),
+    ("Makita - Зарядная станция", 2),
+    ("SHTOK - Лестница 2.6м", 2),
+    ("Лестница - 6 ступеней", 2),
+    ("Лестница - 7 ступеней", 2),
+    ("Лестница 3 секции - 7 ступеней", 1),
+    ("Удлинитель - 50 метров", 2),
+    ("Удлинитель - 30 метров", 2),
+    ("Стол для производства", 1),
+    ("Насадка для перфоратора", 5),
+    ("CONDTROL - Лазерный уровень", 1),
+    ("ROCODIL - Лазерный уровень", 1),
+    ("Пылесос", 1),
+    ("REXANT - Инфракрасный пирометр", 2),
+    ("LIXE - Пороховой монтажный пистолет", 1)
+]
+
+# Картинки каталога из tools_images/ для инструментов SEED_TOOLS
+SEED_IMAGES = {
+    "Milwaukee - Болгарка": "milwaukee_grinder.jpg",
+    "Milwaukee - Перфоратор": "milwaukee_perforator.jpg",
+    "Milwaukee - Сабельная пила": "milwaukee_saw.jpg",
+    "Milwaukee - Шуруповёрт": "milwaukee_screwdriver.jpg",
+    "Milwaukee - Пылеуловитель для перфоратора": "milwaukee_dust_collector.jpg",
+    "Milwaukee - Зарядка для аккумуляторов": "milwaukee_charger.jpg",
+    "Milwaukee - Аккумулятор": "milwaukee_battery.jpg",
+    "Toua Газовый монтажный пистолет": "toua_gas_gun.jpg",
+    "Bosch - Перфоратор": "bosch_perforator.jpg",
+    "Makita - Перфоратор": "makita_perforator.jpg",
+    "Makita - Сабельная пила": "makita_saw.jpg",
+    "Makita - Болгарка xLock": "makita_xlock_grinder.jpg",
+    "Makita - Проводная болгарка": "makita_corded_grinder.jpg",
+    "Пылесос для модулей Makita": "makita_vacuum.jpg",
+    "Makita - Станция": "makita_station.jpg",
+    "Makita - Зарядная станция": "makita_charger.jpg",
+    "SHTOK - Лестница 2.6м": "shtok_ladder_2_6m.jpg",
+    "Лестница - 6 ступеней": "ladder_6_steps.jpg",
+    "Лестница - 7 ступеней": "ladder_7_steps.jpg",
+    "Лестница 3 секции - 7 ступеней": "ladder_3_sections.jpg",
+    "Удлинитель - 50 метров": "extension_50m.jpg",
+    "Удлинитель - 30 метров": "extension_30m.jpg",
+    "Стол для производства": "production_table.jpg",
+    "Насадка для перфоратора": "perforator_nozzle.jpg",
+    "CONDTROL - Лазерный уровень": "condtrol_laser_level.jpg",
+    "ROCODIL - Лазерный уровень": "rocodil_laser_level.jpg",
+    "Пылесос": "vacuum.jpg",
+    "REXANT - Инфракрасный пирометр": "rexant_thermometer.jpg",
+    "LIXE - Пороховой монтажный пистолет": "lixe_powder_gun.jpg",
+}
 
 def clear_database():
     """Очищает все таблицы в базе данных"""
@@ -17,11 +90,25 @@ def clear_database():
         cursor.execute('DROP TABLE IF EXISTS issued_tools')
         cursor.execute('DROP TABLE IF EXISTS issue_requests')
         cursor.execute('DROP TABLE IF EXISTS tools')
+        cursor.execute('DROP TABLE IF EXISTS stats_totals')
+        cursor.execute('DROP TABLE IF EXISTS tool_stats')
+        cursor.execute('DROP TABLE IF EXISTS daily_activity')
+        cursor.execute('DROP TABLE IF EXISTS media')
+        cursor.execute('DROP TABLE IF EXISTS telegram_files')
+        cursor.execute('DROP TABLE IF EXISTS fsm_states')
+        # Вместе с данными сбрасываем версии схемы и начальных данных
+        cursor.execute('DROP TABLE IF EXISTS app_meta')
+        cursor.execute('DROP TABLE IF EXISTS schema_version')
         
-        # Сбрасываем автоинкремент
-        cursor.execute('DELETE FROM sqlite_sequence')
+        # Сбрасываем автоинкремент (sqlite_sequence появляется только после первой вставки с AUTOINCREMENT)
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'sqlite_sequence'")
+        if cursor.fetchone():
+            cursor.execute('DELETE FROM sqlite_sequence')
         
         conn.commit()
+        # Архивы истории относятся к удаленным данным
+        shutil.rmtree(archive_dir(), ignore_errors=True)
+        shutil.rmtree(media_dir(), ignore_errors=True)
         print("База данных очищена")
     except Exception as e:
         print(f"Ошибка при очистке базы данных: {str(e)}")
@@ -29,76 +116,67 @@ def clear_database():
     finally:
         conn.close()
 
-def populate_database():
-    """Заполняет базу данных начальными данными"""
-    print("Начало заполнения базы данных...")
-    # Очищаем базу данных
-    clear_database()
-    
-    # Создаем таблицы
-    print("Создание таблиц...")
+def seed_database() -> bool:
+    """
+    Идемпотентно добавляет начальные данные.
+    Если версия в app_meta не меньше SEED_VERSION, выполняется один запрос без записи.
+    Добавляются только инструменты, которых еще нет в базе; существующие данные не трогаются,
+    кроме назначения картинок каталога инструментам без картинки.
+    Возвращает True, если данные были добавлены.
+    """
     create_tables()
-    
-    # Список инструментов и их количество
-    tools = [
-        ("Milwaukee - Болгарка", 5),
-        ("Milwaukee - Перфоратор", 3),
-        ("Milwaukee - Сабельная пила", 4),
-        ("Milwaukee - Шуруповёрт", 6),
-        ("Milwaukee - Пылеуловитель для перфоратора", 2),
-        ("Milwaukee - Зарядка для аккумуляторов", 3),
-        ("Milwaukee - Аккумулятор", 10),
-        ("Toua Газовый монтажный пистолет", 2),
-        ("Bosch - Перфоратор", 3),
-        ("Makita - Перфоратор", 3),
-        ("Makita - Сабельная пила", 2),
-        ("Makita - Болгарка xLock", 4),
-        ("Makita - Проводная болгарка", 3),
-        ("Пылесос для модулей Makita", 1),
-        ("Makita - Станция", 1),
-        ("Makita - Зарядная станция", 2),
-        ("SHTOK - Лестница 2.6м", 2),
-        ("Лестница - 6 ступеней", 2),
-        ("Лестница - 7 ступеней", 2),
-        ("Лестница 3 секции - 7 ступеней", 1),
-        ("Удлинитель - 50 метров", 2),
-        ("Удлинитель - 30 метров", 2),
-        ("Стол для производства", 1),
-        ("Насадка для перфоратора", 5),
-        ("CONDTROL - Лазерный уровень", 1),
-        ("ROCODIL - Лазерный уровень", 1),
-        ("Пылесос", 1),
-        ("REXANT - Инфракрасный пирометр", 2),
-        ("LIXE - Пороховой монтажный пистолет", 1)
-    ]
-    
-    # Добавляем инструменты
-    data_dir = os.getenv('DATA_DIR', '.')
-    db_path = os.path.join(data_dir, 'tools.db')
-    print(f"Путь к базе данных для добавления инструментов: {db_path}")
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-    
-    try:
-        for tool_name, quantity in tools:
-            # Добавляем инструменты напрямую в базу данных
-            for _ in range(quantity):
-                cursor.execute('''
-                    INSERT INTO tools (name, status)
-                    VALUES (?, 'available')
-                ''', (tool_name,))
-            print(f"✅ Добавлен инструмент: {tool_name} (количество: {quantity})")
-        
-        conn.commit()
-        print(f"Добавлено {len(tools)} инструментов")
-    except Exception as e:
-        print(f"❌ Ошибка при добавлении инструментов: {str(e)}")
-        conn.rollback()
-    finally:
-        conn.close()
+    if int(get_meta('seed_version', '0')) >= SEED_VERSION:
+        return False
+
+    def _write(cursor):
+        # Повторная проверка в транзакции записи: другой процесс мог успеть раньше
+        cursor.execute("SELECT value FROM app_meta WHERE key = 'seed_version'")
+        row = cursor.fetchone()
+        if row and int(row[0]) >= SEED_VERSION:
+            return []
+
+        cursor.execute('SELECT DISTINCT name FROM tools')
+        existing = {name for name, in cursor.fetchall()}
+        missing = [(name, quantity) for name, quantity in SEED_TOOLS if name not in existing]
+        # Одна запись на тип инструмента, quantity - число единиц
+        cursor.executemany('''
+            INSERT INTO tools (name, quantity)
+            VALUES (?, ?)
+        ''', missing)
+        # Картинка назначается только инструментам без нее: выбранные вручную не перезаписываются
+        cursor.executemany('''
+            UPDATE tools SET image = ?
+            WHERE name = ? AND image IS NULL
+        ''', [(image, name) for name, image in SEED_IMAGES.items()])
+        set_meta(cursor, 'seed_version', SEED_VERSION)
+        return missing
+
+    def _refresh_cache(missing):
+        # Нужно, когда seed_database вызывает сам бот при запуске: запись идет через его
+        # же соединение-писатель, и data_version ее не отражает. Из командной строки это
+        # кэш только этого процесса, запущенный бот сбросит свой по data_version
+        if missing:
+            inventory.invalidate()
+
+    missing = run_write(_write, _refresh_cache)
+    for name, quantity in missing:
+        print(f"✅ Добавлен инструмент: {name} (количество: {quantity})")
+    print(f"Начальные данные версии {SEED_VERSION}: добавлено {len(missing)} инструментов")
+    return bool(missing)
+
+def populate_database(reset=False):
+    """Заполняет базу данных начальными данными; reset=True предварительно удаляет все данные"""
+    print("Начало заполнения базы данных...")
+    if reset:
+        clear_database()
+    seed_database()
     print("Заполнение базы данных завершено")
+    print(f"Запущенный бот подхватит изменения в течение {INVENTORY_SYNC_INTERVAL:.0f} с")
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Заполнение базы данных начальными данными")
+    parser.add_argument('--reset', action='store_true',
+                        help="удалить все данные (включая историю и выдачи) и заполнить заново")
+    args = parser.parse_args()
     print("Запуск populate_database.py")
-    populate_database()
-    print("Скрипт populate_database.py завершен")
\ No newline at end of file
+    populate_database(reset=args.reset)
@@ -0,0 +1,235 @@
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Режим профилирования запросов: соединения пула и потока-писателя замеряют каждый запрос
+DB_PROFILE = os.getenv('DB_PROFILE', '').lower() in ('1', 'true', 'yes', 'on')
+
+# Запросы дольше порога (миллисекунды) пишутся в лог вместе с EXPLAIN QUERY PLAN
+DB_SLOW_QUERY_MS = float(os.getenv('DB_SLOW_QUERY_MS', '100'))
+
+# Сколько разных текстов запросов хранится в сводке; новые сверх лимита не учитываются
+DB_PROFILE_MAX_STATEMENTS = int(os.getenv('DB_PROFILE_MAX_STATEMENTS', '500'))
+
+# Для этих запросов план имеет смысл; BEGIN, SAVEPOINT, PRAGMA и т.п. не объясняются
+_EXPLAINABLE = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH', 'REPLACE')
+
+_WHITESPACE = re.compile(r'\s+')
+
+
+def normalize_sql(sql: str) -> str:
+    """Текст запроса в одну строку: по нему запросы объединяются в сводке"""
+    return _WHITESPACE.sub(' ', sql).strip()
+
+
+class QueryProfiler:
+    """
+    Сводка по запросам: количество, суммарное и наибольшее время, строки.
+    Запросы дольше slow_ms пишутся в лог с планом выполнения; план
+    каждого текста запроса получается один раз.
+    """
+
+    def __init__(self, enabled=DB_PROFILE, slow_ms=DB_SLOW_QUERY_MS, max_statements=DB_PROFILE_MAX_STATEMENTS):
+        self.enabled = enabled
+        self.slow_seconds = slow_ms / 1000
+        self.max_statements = max_statements
+        self._lock = threading.Lock()
+        self._statements = {}  # текст -> [количество, суммарное время, наибольшее время, строки, медленных]
+        self._plans = {}
+        self._stats = {'queries': 0, 'slow_queries': 0, 'dropped_statements': 0}
+
+    def record(self, sql: str, duration: float, rows: int):
+        """Учитывает выполненный запрос; возвращает True, если он медленный"""
+        slow = duration >= self.slow_seconds
+        key = normalize_sql(sql)
+        with self._lock:
+            self._stats['queries'] += 1
+            if slow:
+                self._stats['slow_queries'] += 1
+            entry = self._statements.get(key)
+            if entry is None:
+                if len(self._statements) >= self.max_statements:
+                    self._stats['dropped_statements'] += 1
+                    return slow
+                entry = self._statements[key] = [0, 0.0, 0.0, 0, 0]
+            entry[0] += 1
+            entry[1] += duration
+            entry[2] = max(entry[2], duration)
+            entry[3] += rows
+            if slow:
+                entry[4] += 1
+        return slow
+
+    def explain(self, connection, sql: str, params):
+        """План выполнения запроса (EXPLAIN QUERY PLAN) на том же соединении; кэшируется по тексту"""
+        key = normalize_sql(sql)
+        with self._lock:
+            plan = self._plans.get(key)
+        if plan is not None:
+            return plan
+        if params is None or not key.upper().startswith(_EXPLAINABLE):
+            return None
+        # Обычный курсор: сам запрос плана не должен попадать в сводку
+        cursor = sqlite3.Cursor(connection)
+        try:
+            cursor.execute(f'EXPLAIN QUERY PLAN {sql}', params)
+            plan = '; '.join(row[3] for row in cursor.fetchall())
+        except sqlite3.Error as e:
+            logger.error(f"Не удалось получить план запроса: {e}")
+            return None
+        finally:
+            cursor.close()
+        with self._lock:
+            if len(self._plans) < self.max_statements:
+                self._plans[key] = plan
+        return plan
+
+    def log_slow(self, connection, sql: str, params, duration: float, rows: int):
+        plan = self.explain(connection, sql, params)
+        logger.warning(
+            f"Медленный запрос: {duration * 1000:.1f} мс, строк: {rows}: {normalize_sql(sql)}"
+            + (f" | план: {plan}" if plan else "")
+        )
+
+    def top(self, limit=10):
+        """
+        Самые затратные запросы по суммарному времени:
+        [(текст, количество, суммарное время, среднее время, наибольшее время, строки, медленных)]
+        """
+        with self._lock:
+            items = [(sql, *entry) for sql, entry in self._statements.items()]
+        items.sort(key=lambda item: item[2], reverse=True)
+        return [
+            (sql, count, total, total / count, longest, rows, slow)
+            for sql, count, total, longest, rows, slow in items[:limit]
+        ]
+
+    def reset(self):
+        """Очищает сводку (планы запросов сохраняются)"""
+        with self._lock:
+            self._statements.clear()
+            self._stats = {'queries': 0, 'slow_queries': 0, 'dropped_statements': 0}
+
+    def get_stats(self):
+        """Возвращает количество учтенных и медленных запросов"""
+        with self._lock:
+            stats = dict(self._stats)
+        stats['statements'] = len(self._statements)
+        stats['enabled'] = self.enabled
+        return stats
+
+
+profiler = QueryProfiler()
+
+
+class ProfilingCursor(sqlite3.Cursor):
+    """
+    Курсор, замеряющий запросы. Для SELECT время и количество строк
+    накапливаются до конца выборки (fetchall, исчерпание fetchone/fetchmany
+    или итерации, следующий execute, close), для остальных запросов
+    учитывается rowcount.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._query = None  # [текст, параметры, время, строки]
+
+    def _finish(self):
+        query, self._query = self._query, None
+        if query is None:
+            return
+        sql, params, duration, rows = query
+        if profiler.record(sql, duration, rows):
+            profiler.log_slow(self.connection, sql, params, duration, rows)
+
+    def _start(self, method, sql, params):
+        self._finish()
+        started = time.perf_counter()
+        try:
+            method(sql, params)
+        finally:
+            duration = time.perf_counter() - started
+            if self.description is None:
+                self._query = [sql, params, duration, max(self.rowcount, 0)]
+                self._finish()
+            else:
+                self._query = [sql, params, duration, 0]
+        return self
+
+    def execute(self, sql, parameters=()):
+        return self._start(super().execute, sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        # Параметры пачки не сохраняются: план строится без них
+        self._finish()
+        started = time.perf_counter()
+        try:
+            super().executemany(sql, seq_of_parameters)
+        finally:
+            self._query = [sql, None, time.perf_counter() - started, max(self.rowcount, 0)]
+            self._finish()
+        return self
+
+    def _fetched(self, started, rows, exhausted):
+        query = self._query
+        if query is not None:
+            query[2] += time.perf_counter() - started
+            query[3] += rows
+            if exhausted:
+                self._finish()
+
+    def fetchone(self):
+        started = time.perf_counter()
+        row = super().fetchone()
+        self._fetched(started, row is not None, row is None)
+        return row
+
+    def fetchmany(self, size=None):
+        size = self.arraysize if size is None else size
+        started = time.perf_counter()
+        rows = super().fetchmany(size)
+        self._fetched(started, len(rows), len(rows) < size)
+        return rows
+
+    def fetchall(self):
+        started = time.perf_counter()
+        rows = super().fetchall()
+        self._fetched(started, len(rows), True)
+        return rows
+
+    def __next__(self):
+        started = time.perf_counter()
+        try:
+            row = super().__next__()
+        except StopIteration:
+            self._fetched(started, 0, True)
+            raise
+        self._fetched(started, 1, False)
+        return row
+
+    def close(self):
+        self._finish()
+        super().close()
+
+
+class ProfilingConnection(sqlite3.Connection):
+    """Соединение, все курсоры которого (в том числе у execute) - ProfilingCursor"""
+
+    def cursor(self, factory=ProfilingCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+def connection_factory():
+    """Класс соединения для sqlite3.connect: с профилированием, если оно включено"""
+    return ProfilingConnection if profiler.enabled else sqlite3.Connection
@@ -0,0 +1,174 @@
+import bisect
+import heapq
+import re
+from collections import defaultdict
+
+# Транслитерация кириллицы в латиницу: "макита" и "makita" дают один ключ
+_TRANSLIT = {
+    'а': 'a', 'б': 'b', 'в': 'v', 'г': 'g', 'д': 'd', 'е': 'e', 'ё': 'e',
+    'ж': 'zh', 'з': 'z', 'и': 'i', 'й': 'i', 'к': 'k', 'л': 'l', 'м': 'm',
+    'н': 'n', 'о': 'o', 'п': 'p', 'р': 'r', 'с': 's', 'т': 't', 'у': 'u',
+    'ф': 'f', 'х': 'h', 'ц': 'ts', 'ч': 'ch', 'ш': 'sh', 'щ': 'sh', 'ъ': '',
+    'ы': 'i', 'ь': '', 'э': 'e', 'ю': 'yu', 'я': 'ya',
+}
+
+# Упрощение латинского написания, чтобы сблизить варианты транслитерации
+_LATIN_RULES = (
+    ('sch', 'sh'), ('ck', 'k'), ('ph', 'f'), ('kh', 'h'), ('ch', '4'),
+    ('c', 'k'), ('q', 'k'), ('w', 'v'), ('x', 'ks'), ('y', 'i'), ('j', 'i'),
+    ('ee', 'i'), ('oo', 'u'), ('4', 'ch'),
+)
+
+_TOKEN_RE = re.compile(r'\w+')
+
+# Минимальное сходство по триграммам, при котором слово считается совпадением
+MIN_SIMILARITY = 0.35
+
+
+def normalize(text: str) -> str:
+    """Приводит текст к ключу поиска: регистр (включая кириллицу), транслитерация, упрощение"""
+    text = text.casefold()
+    text = ''.join(_TRANSLIT.get(char, char) for char in text)
+    for old, new in _LATIN_RULES:
+        text = text.replace(old, new)
+    return text
+
+
+def tokenize(text: str):
+    """Разбивает нормализованный текст на слова"""
+    return _TOKEN_RE.findall(normalize(text))
+
+
+def trigrams(token: str):
+    """Триграммы слова с отступами по краям"""
+    padded = f'  {token} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class ToolSearchIndex:
+    """
+    Индекс названий инструментов в памяти: триграммы слов + отсортированный словарь для префиксов.
+    Поддерживает нечеткий поиск (опечатки), транслитерацию и ранжирование.
+    Не потокобезопасен: вызывающий код отвечает за блокировки.
+    """
+
+    def __init__(self):
+        self._names = {}                        # tool_id -> название
+        self._doc_tokens = {}                   # tool_id -> слова названия
+        self._token_docs = defaultdict(set)     # слово -> tool_id
+        self._token_trigrams = {}               # слово -> триграммы
+        self._trigram_tokens = defaultdict(set)  # триграмма -> слова
+        self._vocabulary = []                   # отсортированные слова для поиска по префиксу
+
+    def __len__(self):
+        return len(self._names)
+
+    def rebuild(self, items):
+        """Перестраивает индекс по парам (tool_id, название)"""
+        self.__init__()
+        for tool_id, name in items:
+            self._add(tool_id, name)
+        self._vocabulary = sorted(self._token_docs)
+
+    def _add(self, tool_id, name):
+        tokens = set(tokenize(name))
+        self._names[tool_id] = name
+        self._doc_tokens[tool_id] = tokens
+        new_tokens = []
+        for token in tokens:
+            if token not in self._token_docs:
+                grams = trigrams(token)
+                self._token_trigrams[token] = grams
+                for gram in grams:
+                    self._trigram_tokens[gram].add(token)
+                new_tokens.append(token)
+            self._token_docs[token].add(tool_id)
+        return new_tokens
+
+    def add(self, tool_id, name):
+        """Добавляет инструмент или обновляет его название"""
+        if self._names.get(tool_id) == name:
+            return
+        self.remove(tool_id)
+        for token in self._add(tool_id, name):
+            bisect.insort(self._vocabulary, token)
+
+    def remove(self, tool_id):
+        """Удаляет инструмент из индекса"""
+        if tool_id not in self._names:
+            return
+        del self._names[tool_id]
+        for token in self._doc_tokens.pop(tool_id):
+            docs = self._token_docs[token]
+            docs.discard(tool_id)
+            if not docs:
+                del self._token_docs[token]
+                for gram in self._token_trigrams.pop(token):
+                    self._trigram_tokens[gram].discard(token)
+                index = bisect.bisect_left(self._vocabulary, token)
+                if index < len(self._vocabulary) and self._vocabulary[index] == token:
+                    del self._vocabulary[index]
+
+    def _match_token(self, query_token):
+        """Возвращает {слово индекса: оценка} для одного слова запроса"""
+        matches = {}
+
+        # Префикс: "бол" -> "болгарка"
+        start = bisect.bisect_left(self._vocabulary, query_token)
+        for token in self._vocabulary[start:]:
+            if not token.startswith(query_token):
+                break
+            matches[token] = 1.0 if token == query_token else 0.9
+
+        # Триграммы: опечатки и совпадения внутри слова
+        query_grams = trigrams(query_token)
+        common = defaultdict(int)
+        for gram in query_grams:
+            for token in self._trigram_tokens.get(gram, ()):
+                common[token] += 1
+        for token, count in common.items():
+            if token in matches:
+                continue
+            token_grams = len(self._token_trigrams[token])
+            similarity = count / (len(query_grams) + token_grams - count)
+            # Доля триграмм запроса, найденных в слове (подстрока внутри длинного слова)
+            containment = count / len(query_grams)
+            score = max(similarity, 0.8 * containment if len(query_token) >= 4 else 0)
+            if score >= MIN_SIMILARITY:
+                matches[token] = score
+        return matches
+
+    def search(self, query, limit=None):
+        """
+        Ищет инструменты по запросу. Возвращает [(tool_id, оценка)] по убыванию оценки.
+        Инструмент должен совпасть со всеми словами запроса.
+        """
+        query_tokens = tokenize(query)
+        if not query_tokens:
+            return []
+
+        scores = None
+        for query_token in query_tokens:
+            token_scores = defaultdict(float)
+            for token, score in self._match_token(query_token).items():
+                for tool_id in self._token_docs[token]:
+                    if score > token_scores[tool_id]:
+                        token_scores[tool_id] = score
+            if scores is None:
+                scores = dict(token_scores)
+            else:
+                scores = {
+                    tool_id: total + token_scores[tool_id]
+                    for tool_id, total in scores.items()
+                    if tool_id in token_scores
+                }
+            if not scores:
+                return []
+
+        def rank(item):
+            return -item[1], self._names[item[0]], item[0]
+
+        if limit:
+            # Частичная сортировка: для популярных слов совпадений могут быть тысячи
+            return heapq.nsmallest(limit, scores.items(), key=rank)
+        return sorted(scores.items(), key=rank)
@@ -0,0 +1,121 @@
+import logging
+import os
+import time
+from collections import OrderedDict
+
+from aiogram import types
+from aiogram.dispatcher.handler import CancelHandler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+logger = logging.getLogger(__name__)
+
+# Сколько пользователей помнит каждый ограничитель; при переполнении забываются давно неактивные
+THROTTLE_MAX_USERS = int(os.getenv('THROTTLE_MAX_USERS', '10000'))
+
+
+class TokenBucketLimiter:
+    """
+    Ограничитель частоты "маркерная корзина" для множества ключей.
+    В корзине до burst маркеров, они восполняются со скоростью rate в секунду.
+    Память ограничена max_keys: корзина, простоявшая дольше времени полного
+    восполнения, неотличима от новой и удаляется; при переполнении удаляются
+    самые давно использованные (LRU).
+    """
+
+    def __init__(self, rate: float, burst: int, max_keys=THROTTLE_MAX_USERS):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self.idle_ttl = burst / rate
+        self._buckets = OrderedDict()  # ключ -> [маркеры, время обновления]
+
+    def allow(self, key, now=None) -> bool:
+        """Забирает маркер для key; возвращает False, если маркеров нет"""
+        now = time.monotonic() if now is None else now
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = [float(self.burst), now]
+        else:
+            self._buckets.move_to_end(key)
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+        allowed = bucket[0] >= 1
+        if allowed:
+            bucket[0] -= 1
+        self._evict(now)
+        return allowed
+
+    def delay(self, key, now=None) -> float:
+        """Через сколько секунд у key появится маркер (0 - уже есть); маркер не забирается"""
+        now = time.monotonic() if now is None else now
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            return 0.0
+        tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+        return 0.0 if tokens >= 1 else (1 - tokens) / self.rate
+
+    def _evict(self, now):
+        # В начале OrderedDict - самые давно использованные корзины
+        while self._buckets:
+            key, (_, updated_at) = next(iter(self._buckets.items()))
+            if len(self._buckets) <= self.max_keys and now - updated_at < self.idle_ttl:
+                break
+            del self._buckets[key]
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """
+    Ограничивает частоту сообщений и нажатий кнопок для каждого пользователя.
+    rules: {правило: (rate, burst)}. Правило для сообщения - команда ('/report'),
+    для кнопки - префикс callback_data ('list'); если его нет в rules,
+    используются 'message' и 'callback'.
+    """
+
+    def __init__(self, rules, max_users=THROTTLE_MAX_USERS):
+        super().__init__()
+        self._limiters = {
+            name: TokenBucketLimiter(rate, burst, max_users)
+            for name, (rate, burst) in rules.items()
+        }
+        # Предупреждаем о превышении не чаще раза в 10 секунд, чтобы не отвечать на каждый спам
+        self._warnings = TokenBucketLimiter(0.1, 1, max_users)
+        self._stats = {'passed': 0, 'throttled': 0}
+        self._throttled_by_rule = {name: 0 for name in rules}
+
+    def _check(self, rule, default_rule, user_id) -> bool:
+        if rule not in self._limiters:
+            rule = default_rule
+        if self._limiters[rule].allow(user_id):
+            self._stats['passed'] += 1
+            return True
+        self._stats['throttled'] += 1
+        self._throttled_by_rule[rule] += 1
+        logger.info("Ограничение частоты: пользователь %s, правило %s", user_id, rule)
+        return False
+
+    async def on_pre_process_message(self, message: types.Message, data: dict):
+        command = message.get_command(pure=True)
+        rule = f'/{command}' if command else 'message'
+        user_id = message.from_user.id if message.from_user else message.chat.id
+        if self._check(rule, 'message', user_id):
+            return
+        if self._warnings.allow(user_id):
+            await message.answer("⏳ Слишком много запросов, подождите немного.")
+        raise CancelHandler()
+
+    async def on_pre_process_callback_query(self, callback_query: types.CallbackQuery, data: dict):
+        rule = (callback_query.data or '').split(':', 1)[0]
+        if self._check(rule, 'callback', callback_query.from_user.id):
+            return
+        await callback_query.answer("Пожалуйста, не нажимайте кнопки так часто", show_alert=True)
+        raise CancelHandler()
+
+    def get_stats(self):
+        """Счетчики пропущенных и отклоненных обновлений, отклонения по правилам и число корзин"""
+        stats = dict(self._stats)
+        stats['throttled_by_rule'] = dict(self._throttled_by_rule)
+        stats['tracked'] = {name: len(limiter) for name, limiter in self._limiters.items()}
+        return stats
@@ -5,17 +5,11 @@ path = '/home/Rasal/telegrambot'
 if path not in sys.path:
     sys.path.append(path)
 
-from bot import dp, bot
+# Импорт bot не обращается к базе данных и сети: все это происходит в on_startup.
+# Бот работает на aiohttp, поэтому сервер должен запускать приложение асинхронным воркером:
+#     gunicorn wsgi:application --worker-class aiohttp.GunicornWebWorker
+import log_setup
+from bot import build_app
 
-async def application(environ, start_response):
-    if environ['REQUEST_METHOD'] == 'POST':
-        from aiohttp.web import Response
-        
-        # Получаем данные запроса
-        request_body_size = int(environ.get('CONTENT_LENGTH', 0))
-        request_body = environ['wsgi.input'].read(request_body_size)
-        
-        # Обрабатываем update
-        await dp.process_update(request_body)
-        
-        return Response(status=200)
+log_setup.setup_logging()
+application = build_app()